@@ -0,0 +1,568 @@
+import argparse
+import asyncio
+import email.parser
+import functools
+import json
+import logging
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer, BaseHTTPRequestHandler
+from types import SimpleNamespace
+
+# Offline end-to-end benchmark: runs bot.py's handlers against a fake Telegram Bot API and a local media
+# server, and writes timings, throughput, memory, disk and Telegram call counts to a JSON file.
+#
+#   python bench.py --users 4 --jobs-per-user 3 --output bench_results.json
+#   python bench.py --baseline bench_results.json   # compare against an earlier run
+
+logger = logging.getLogger("bench")
+
+BENCH_TOKEN = "123456:bench"
+
+# name -> ffmpeg output arguments. Each fixture exercises a different planner path.
+FIXTURES = {
+    "h264_aac_480p.mp4": [
+        "-vf", "scale=854:480", "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p", "-b:v", "800k",
+        "-c:a", "aac", "-b:a", "96k", "-movflags", "faststart",
+    ],
+    "h264_1080p.mp4": [
+        "-vf", "scale=1920:1080", "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p", "-b:v", "4000k",
+        "-c:a", "aac", "-b:a", "128k",
+    ],
+    "vp9_opus_720p.webm": [
+        "-vf", "scale=1280:720", "-c:v", "libvpx-vp9", "-deadline", "realtime", "-cpu-used", "8", "-b:v", "1500k",
+        "-c:a", "libopus", "-b:a", "96k",
+    ],
+}
+
+
+def make_fixtures(fixture_dir: str, duration: int, names: list[str]) -> dict[str, int]:
+    sizes = {}
+    for name in names:
+        path = os.path.join(fixture_dir, name)
+        if not os.path.exists(path):
+            subprocess.run(
+                [
+                    "ffmpeg", "-v", "error", "-f", "lavfi", "-i", f"testsrc2=size=1920x1080:rate=30:duration={duration}",
+                    "-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}", *FIXTURES[name], "-shortest", "-y", path,
+                ],
+                check=True,
+            )
+        sizes[name] = os.path.getsize(path)
+    return sizes
+
+
+def summarize(samples: list[float]) -> dict:
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "mean": statistics.fmean(ordered),
+        "p50": ordered[len(ordered) // 2],
+        "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        "max": ordered[-1],
+        "total": sum(ordered),
+    }
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class _QuietServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # yt-dlp drops connections once it has what it needs; that is not worth a traceback.
+        if not isinstance(sys.exc_info()[1], (ConnectionError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+
+def serve_media(fixture_dir: str) -> ThreadingHTTPServer:
+    server = _QuietServer(("127.0.0.1", 0), functools.partial(_QuietHandler, directory=fixture_dir))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class FakeTelegram:
+    # Just enough of the Bot API for bot.py's handlers. Every call is recorded; uploads can be throttled to
+    # a given bandwidth so upload-bound behaviour shows up.
+
+    def __init__(self, upload_mbps: float | None = None):
+        self.upload_mbps = upload_mbps
+        self.calls: dict[str, int] = {}
+        self.upload_bytes = 0
+        self.upload_seconds: list[float] = []
+        self.failures: list[str] = []
+        self.videos: list[dict] = [] # {"chat_id", "message", "callback_data"}
+        self.first_send_at: float | None = None # time.monotonic() of the first send* call
+        self._lock = threading.Lock()
+        self._message_id = 1000
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/bot"
+
+    def _next_message_id(self) -> int:
+        with self._lock:
+            self._message_id += 1
+            return self._message_id
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                self.do_POST()
+
+            def do_POST(self):
+                method = self.path.rsplit("/", 1)[-1]
+                started = time.monotonic()
+                body = fake._read_body(self)
+                params = fake._parse(self.headers.get("Content-Type", ""), body)
+                result = fake._answer(method, params, len(body), time.monotonic() - started)
+                payload = json.dumps({"ok": True, "result": result}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        return Handler
+
+    def _read_body(self, handler) -> bytes:
+        remaining = int(handler.headers.get("Content-Length") or 0)
+        chunks = []
+        while remaining:
+            chunk = handler.rfile.read(min(remaining, 64 * 1024))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+            if self.upload_mbps:
+                time.sleep(len(chunk) * 8 / (self.upload_mbps * 1_000_000))
+        return b"".join(chunks)
+
+    @staticmethod
+    def _parse(content_type: str, body: bytes) -> dict:
+        if content_type.startswith("multipart/form-data"):
+            message = email.parser.BytesParser().parsebytes(
+                f"Content-Type: {content_type}\r\n\r\n".encode() + body
+            )
+            params = {}
+            for part in message.get_payload():
+                name = part.get_param("name", header="content-disposition")
+                if not part.get_filename():
+                    params[name] = part.get_payload(decode=True).decode(errors="replace")
+            return params
+        if content_type.startswith("application/json"):
+            return json.loads(body or b"{}")
+        return {k: v[0] for k, v in urllib.parse.parse_qs(body.decode()).items()}
+
+    def _message(self, params: dict, **fields) -> dict:
+        chat_id = int(params.get("chat_id") or 0)
+        message_id = int(params.get("message_id") or 0) or self._next_message_id()
+        return {
+            "message_id": message_id, "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"}, **fields,
+        }
+
+    def _answer(self, method: str, params: dict, body_bytes: int, seconds: float):
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if method.startswith("send") and self.first_send_at is None:
+                self.first_send_at = time.monotonic()
+        text = params.get("text") or params.get("caption") or ""
+        if method in ("sendMessage", "editMessageText", "editMessageCaption") and text.startswith(("Failed", "❌")):
+            with self._lock:
+                self.failures.append(text)
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        if method in ("sendVideo", "sendDocument", "sendAudio", "sendMediaGroup"):
+            with self._lock:
+                self.upload_bytes += body_bytes
+                self.upload_seconds.append(seconds)
+        if method == "sendVideo":
+            message = self._message(params, video={
+                "file_id": f"video{self._message_id}", "file_unique_id": f"u{self._message_id}",
+                "width": 1280, "height": 720, "duration": 1,
+            })
+            markup = json.loads(params.get("reply_markup") or "{}")
+            callback_data = [button["callback_data"] for row in markup.get("inline_keyboard", []) for button in row]
+            with self._lock:
+                self.videos.append({"chat_id": message["chat"]["id"], "message": message, "callback_data": callback_data})
+            return message
+        if method == "sendDocument":
+            return self._message(params, document={"file_id": f"doc{self._message_id}", "file_unique_id": f"d{self._message_id}"})
+        if method == "sendAudio":
+            return self._message(params, audio={"file_id": f"audio{self._message_id}", "file_unique_id": f"a{self._message_id}", "duration": 1})
+        if method == "sendMediaGroup":
+            media = json.loads(params.get("media") or "[]")
+            return [self._message(params, document={"file_id": f"doc{i}", "file_unique_id": f"d{i}"}) for i in range(len(media))]
+        if method in ("sendMessage", "editMessageText", "editMessageCaption", "editMessageReplyMarkup"):
+            return self._message(params, text=text)
+        return True
+
+
+class DiskSampler:
+    def __init__(self, path: str, interval: float = 0.25):
+        self.path = path
+        self.interval = interval
+        self.peak_bytes = 0
+        self._task: asyncio.Task | None = None
+
+    def _usage(self) -> int:
+        total = 0
+        for dirpath, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, filename))
+                except OSError:
+                    pass
+        return total
+
+    async def _run(self) -> None:
+        while True:
+            self.peak_bytes = max(self.peak_bytes, self._usage())
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        self._task.cancel()
+        self.peak_bytes = max(self.peak_bytes, self._usage())
+
+
+class StageTimer:
+    # Wraps bot.py's blocking stage functions and records how long each call took, labelled by fixture.
+
+    def __init__(self, fixtures: list[str]):
+        self.fixtures = fixtures
+        self.samples: dict[str, dict[str, list[float]]] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _fixture_of(self, text: str) -> str:
+        for fixture in self.fixtures:
+            if os.path.splitext(fixture)[0] in text:
+                return fixture
+        return "unknown"
+
+    def record(self, stage: str, label: str, seconds: float) -> None:
+        with self._lock:
+            self.samples.setdefault(stage, {}).setdefault(self._fixture_of(label), []).append(seconds)
+
+    def wrap(self, module, name: str, stage: str, subtract_extract: bool = False) -> None:
+        original = getattr(module, name)
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            self._local.extract = 0.0
+            started = time.monotonic()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                elapsed = time.monotonic() - started
+                if subtract_extract:
+                    elapsed -= self._local.extract
+                self.record(stage, str(args[0]), elapsed)
+
+        setattr(module, name, timed)
+
+    def wrap_extract(self, module) -> None:
+        original = module._preflight
+
+        @functools.wraps(original)
+        def timed(ydl, url, *args, **kwargs):
+            started = time.monotonic()
+            try:
+                return original(ydl, url, *args, **kwargs)
+            finally:
+                elapsed = time.monotonic() - started
+                self._local.extract = getattr(self._local, "extract", 0.0) + elapsed
+                self.record("extract", url, elapsed)
+
+        module._preflight = timed
+
+    def report(self) -> tuple[dict, dict]:
+        overall = {stage: summarize([s for samples in by_fixture.values() for s in samples]) for stage, by_fixture in self.samples.items()}
+        by_fixture = {}
+        for stage, fixtures in self.samples.items():
+            for fixture, samples in fixtures.items():
+                by_fixture.setdefault(fixture, {})[stage] = summarize(samples)
+        return overall, by_fixture
+
+
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+
+async def run_benchmark(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    fixture_dir = args.fixture_dir or os.path.join(workdir, "fixtures")
+    os.makedirs(fixture_dir, exist_ok=True)
+    fixtures = args.fixtures or list(FIXTURES)
+    fixture_sizes = make_fixtures(fixture_dir, args.duration, fixtures)
+    media_server = serve_media(fixture_dir)
+    telegram = FakeTelegram(args.upload_mbps)
+
+    # bot.py reads its settings at import time and works relative to the current directory.
+    os.environ["TELEGRAM_BOT_TOKEN"] = BENCH_TOKEN
+    os.environ["STREAMING_TRANSCODE"] = "1" if args.streaming else "0"
+    os.environ["PREPARE_VARIANTS"] = "1" if args.prepare_variants else "0"
+    os.environ["GOFILE_UPLOAD"] = "0"
+    os.environ["FFMPEG_CPU_BUDGET"] = "0" if args.no_cpu_budget else "1"
+    os.environ["FFMPEG_ADAPTIVE_PRESETS"] = "0" if args.fixed_presets else "1"
+    os.chdir(workdir)
+    # Start-up is timed like a deploy: import, init_runtime, then the first job's first reply. The yt-dlp warm-up
+    # runs in the background meanwhile, as it does in production.
+    startup_began = time.monotonic()
+    import bot
+    bot_imported = time.monotonic()
+    from progress import ProgressDispatcher
+    from telegram import CallbackQuery, Update # type: ignore
+    from telegram.ext import Application # type: ignore
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    bot.init_runtime()
+    runtime_ready = time.monotonic()
+    application = Application.builder().token(BENCH_TOKEN).base_url(telegram.base_url).build()
+    tg_bot = application.bot
+    await tg_bot.initialize()
+    bot.progress_dispatcher = ProgressDispatcher(tg_bot)
+    bot.progress_dispatcher.start()
+
+    timer = StageTimer(fixtures)
+    timer.wrap_extract(bot)
+    timer.wrap(bot, "_blocking_expand_url", "expand")
+    timer.wrap(bot, "_blocking_download_video", "download", subtract_extract=True)
+    timer.wrap(bot, "_blocking_stream_and_transcode", "stream_transcode", subtract_extract=True)
+    timer.wrap(bot, "_blocking_reencode_video", "reencode")
+    timer.wrap(bot, "_blocking_convert_media", "convert")
+
+    context = SimpleNamespace(bot=tg_bot, bot_data={}, args=[])
+    media_port = media_server.server_address[1]
+    disk = DiskSampler(bot.DOWNLOAD_DIR)
+    disk.start()
+    update_id = 0
+
+    def job_url(user_id: int, job_number: int) -> str:
+        fixture = fixtures[((user_id - 1) * args.jobs_per_user + job_number) % len(fixtures)]
+        # A distinct query string per job keeps the download cache out of the measurement.
+        return f"http://127.0.0.1:{media_port}/{fixture}?job={user_id}-{job_number}"
+
+    async def url_job(user_id: int, job_numbers: list[int]) -> float:
+        nonlocal update_id
+        update_id += 1
+        text = "\n".join(job_url(user_id, job_number) for job_number in job_numbers)
+        update = Update.de_json({
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id, "date": int(time.time()), "text": text,
+                "chat": {"id": user_id, "type": "private"}, "from": _user(user_id),
+            },
+        }, tg_bot)
+        started = time.monotonic()
+        await bot.handle_url_message(update, context)
+        return time.monotonic() - started
+
+    async def convert_job(video: dict, action: str) -> float:
+        nonlocal update_id
+        update_id += 1
+        data = next((d for d in video["callback_data"] if d.startswith(f"{action}:")), None)
+        if data is None:
+            return 0.0
+        query = CallbackQuery.de_json({
+            "id": str(update_id), "from": _user(video["chat_id"]), "chat_instance": "bench",
+            "data": data, "message": video["message"],
+        }, tg_bot)
+        update = Update(update_id=update_id, callback_query=query)
+        started = time.monotonic()
+        await bot.convert_media(update, context)
+        return time.monotonic() - started
+
+    job_count = args.users * args.jobs_per_user
+    started = time.monotonic()
+    if args.batch:
+        # One message per user carrying all of that user's links; its latency counts once per link.
+        latencies = [
+            latency
+            for latency in await asyncio.gather(*(url_job(user_id, list(range(args.jobs_per_user))) for user_id in range(1, args.users + 1)))
+            for _ in range(args.jobs_per_user)
+        ]
+    else:
+        latencies = await asyncio.gather(*(
+            url_job(user_id, [job_number])
+            for user_id in range(1, args.users + 1)
+            for job_number in range(args.jobs_per_user)
+        ))
+    wall = time.monotonic() - started
+
+    conversion_latencies = []
+    conversion_wall = 0.0
+    if args.convert:
+        started = time.monotonic()
+        conversion_latencies = await asyncio.gather(*(convert_job(video, args.convert) for video in list(telegram.videos)))
+        conversion_wall = time.monotonic() - started
+
+    await disk.stop()
+    # Let the dispatcher flush what is left before counting edits.
+    await asyncio.sleep(1)
+    await bot.progress_dispatcher.stop()
+    await tg_bot.shutdown()
+    bot.scheduler.shutdown()
+    media_server.shutdown()
+    telegram.server.shutdown()
+
+    stages, stages_by_fixture = timer.report()
+    stages["upload"] = summarize(telegram.upload_seconds)
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": _git_commit(),
+        "config": {
+            "users": args.users, "jobs_per_user": args.jobs_per_user, "fixture_seconds": args.duration,
+            "fixtures": fixture_sizes, "streaming": args.streaming, "prepare_variants": args.prepare_variants,
+            "convert": args.convert, "upload_mbps": args.upload_mbps, "batch": args.batch,
+            "download_workers": bot.DOWNLOAD_WORKERS, "transcode_workers": bot.TRANSCODE_WORKERS,
+            "upload_workers": bot.UPLOAD_WORKERS, "per_user_jobs": bot.PER_USER_JOBS, "cpu_count": os.cpu_count(),
+            "cpu_budget": bot.FFMPEG_CPU_BUDGET, "adaptive_presets": bot.FFMPEG_ADAPTIVE_PRESETS,
+        },
+        "jobs": job_count,
+        "failed": len(telegram.failures),
+        "failures": telegram.failures[:20],
+        "wall_seconds": wall,
+        "jobs_per_minute": job_count / wall * 60 if wall else 0.0,
+        "latency": summarize(list(latencies)),
+        "conversions": {
+            "count": len(conversion_latencies),
+            "wall_seconds": conversion_wall,
+            "latency": summarize([latency for latency in conversion_latencies if latency]),
+        },
+        "stages": stages,
+        "stages_by_fixture": stages_by_fixture,
+        "telegram": {
+            "calls": dict(sorted(telegram.calls.items())),
+            "upload_bytes": telegram.upload_bytes,
+            "progress_edits": telegram.calls.get("editMessageText", 0) + telegram.calls.get("editMessageCaption", 0),
+        },
+        "progress_dispatcher": bot.progress_dispatcher.stats(),
+        "scheduler": bot.scheduler.stats(),
+        "ffmpeg": bot.ffmpeg_runner.stats(),
+        "ytdl_pool": bot.ytdl_pool.stats(),
+        "startup": {
+            "import_bot": bot_imported - startup_began,
+            "init_runtime": runtime_ready - bot_imported,
+            "first_response": telegram.first_send_at - startup_began if telegram.first_send_at else None,
+        },
+        "storage": bot.artifact_store.stats(),
+        # ru_maxrss is in KiB on Linux. For children it is the largest single child (usually an ffmpeg).
+        "peak_rss_mb": {"bot": self_usage.ru_maxrss / 1024, "largest_child": children_usage.ru_maxrss / 1024},
+        "cpu_seconds": {
+            "bot": self_usage.ru_utime + self_usage.ru_stime,
+            "children": children_usage.ru_utime + children_usage.ru_stime,
+        },
+        "peak_disk_mb": disk.peak_bytes / (1024 * 1024),
+    }
+    if not args.keep_workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, baseline: dict) -> list[str]:
+    # Lower is better for everything except throughput.
+    metrics = [
+        ("jobs_per_minute", lambda r: r.get("jobs_per_minute"), True),
+        ("latency p50", lambda r: r.get("latency", {}).get("p50"), False),
+        ("latency p95", lambda r: r.get("latency", {}).get("p95"), False),
+        ("time to first response", lambda r: r.get("startup", {}).get("first_response"), False),
+        ("peak RSS (bot)", lambda r: r.get("peak_rss_mb", {}).get("bot"), False),
+        ("peak disk", lambda r: r.get("peak_disk_mb"), False),
+        ("progress edits", lambda r: r.get("telegram", {}).get("progress_edits"), False),
+    ]
+    for stage in sorted(set(results.get("stages", {})) | set(baseline.get("stages", {}))):
+        metrics.append((f"{stage} mean", lambda r, stage=stage: r.get("stages", {}).get(stage, {}).get("mean"), False))
+    lines = []
+    for name, get, higher_is_better in metrics:
+        new, old = get(results), get(baseline)
+        if not new or not old:
+            continue
+        change = (new - old) / old * 100
+        worse = change < 0 if higher_is_better else change > 0
+        flag = " (worse)" if worse and abs(change) >= 10 else ""
+        lines.append(f"{name}: {old:.2f} -> {new:.2f} ({change:+.1f}%){flag}")
+    return lines
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark for bot.py")
+    parser.add_argument("--users", type=int, default=2, help="concurrent users")
+    parser.add_argument("--jobs-per-user", type=int, default=3, help="links each user sends at once")
+    parser.add_argument("--duration", type=int, default=20, help="fixture length in seconds")
+    parser.add_argument("--fixtures", nargs="*", choices=list(FIXTURES), help="fixtures to use (default: all)")
+    parser.add_argument("--fixture-dir", help="reuse fixtures from this directory instead of generating them")
+    parser.add_argument("--convert", choices=["mp3", "mp4_low"], help="press this conversion button on every result")
+    parser.add_argument("--batch", action="store_true", help="each user sends all of its links in one message (batch mode)")
+    parser.add_argument("--streaming", action="store_true", help="run with STREAMING_TRANSCODE=1")
+    parser.add_argument("--prepare-variants", action="store_true", help="run with PREPARE_VARIANTS=1")
+    parser.add_argument("--no-cpu-budget", action="store_true", help="run with FFMPEG_CPU_BUDGET=0 (ffmpeg picks its own threads)")
+    parser.add_argument("--fixed-presets", action="store_true", help="run with FFMPEG_ADAPTIVE_PRESETS=0 (no faster presets under load)")
+    parser.add_argument("--upload-mbps", type=float, help="throttle uploads to the fake Telegram API")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="earlier results file to compare against")
+    parser.add_argument("--keep-workdir", action="store_true")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    if not shutil.which("ffmpeg") or not shutil.which("ffprobe"):
+        sys.exit("ffmpeg and ffprobe must be on PATH")
+    output = os.path.abspath(args.output)
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    results = asyncio.run(run_benchmark(args))
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(
+        f"{results['jobs']} jobs in {results['wall_seconds']:.1f}s ({results['jobs_per_minute']:.1f} jobs/min), "
+        f"{results['failed']} failed, latency p50 {results['latency'].get('p50', 0):.1f}s, "
+        f"{results['telegram']['progress_edits']} progress edits, peak RSS {results['peak_rss_mb']['bot']:.0f} MB, "
+        f"peak disk {results['peak_disk_mb']:.1f} MB"
+    )
+    for stage, summary in results["stages"].items():
+        if summary["count"]:
+            print(f"  {stage}: mean {summary['mean']:.2f}s p95 {summary['p95']:.2f}s over {summary['count']}")
+    print(f"Results written to {output}")
+    if baseline:
+        with open(baseline) as f:
+            for line in compare(results, json.load(f)):
+                print(f"  {line}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,40 @@
 print(">>>> SCRIPT EXECUTION STARTED <<<<") # Prominent marker
 import logging
 import os
-import yt_dlp # type: ignore
 import asyncio
+import copy
 import re # Import regex module
 import subprocess # For ffmpeg
 from concurrent.futures import ThreadPoolExecutor # Import ThreadPoolExecutor
 import uuid # Import uuid for generating unique IDs
-import shutil # Import for file operations like copy
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile # type: ignore # Import for inline keyboards
+import tempfile
+import time
+import glob
+import functools
+import threading
+from contextlib import ExitStack
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile, InputMediaAudio, InputMediaDocument, InputMediaVideo # type: ignore # Import for inline keyboards
+from telegram.error import BadRequest # type: ignore
 from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters, CallbackQueryHandler # type: ignore # Import CallbackQueryHandler
+import metrics
+from gofile import GofileUploader
+from formats import DEFAULT_FORMAT, MetadataCache, default_selection_bytes, select_audio_format, select_format
+from media_cache import MediaCache, identify_url, make_cache_key
+from scheduler import JobScheduler, default_transcode_workers
+from storage import CACHED_KIND, ArtifactStore
+from progress import BatchProgress, ProgressDispatcher
+from ytdl import YoutubeDLPool, yt_dlp
+from transcode import (
+    CONVERSION_EXTENSIONS, EncodeAbandoned, TranscodePlan, available_cores, audio_codec_of, build_command, build_multi_output_command, conversion_output_args,
+    is_faststart_mp4, plan_for_limits, probe_duration, probe_from_info, probe_media, run_ffmpeg, split_media, telegram_output_args,
+    wait_ffmpeg, runner as ffmpeg_runner,
+)
 
 # Enable logging
 logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+    format="%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s", level=logging.INFO
 )
+metrics.install_trace_logging()
 logging.getLogger("httpx").setLevel(logging.WARNING)
 
 logger = logging.getLogger(__name__)
@@ -23,8 +43,77 @@ TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "YOUR_FALLBACK_TOKEN_IF_ANY
 DOWNLOAD_DIR = "downloads"
 TELEGRAM_FILE_LIMIT_MB = 2000
 LOCAL_SAVE_LIMIT_MB = 50
+CACHE_DIR = os.path.join(DOWNLOAD_DIR, "cache")
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", os.path.join(DOWNLOAD_DIR, "media_cache.sqlite3"))
+CACHE_MAX_MB = int(os.getenv("CACHE_MAX_MB", "2048"))
+# Part of the cache key: bump when the download selector or re-encode settings change.
+CACHE_FORMAT_PROFILE = "preflight-v1|telegram-plan-v1"
+METADATA_CACHE_TTL = int(os.getenv("METADATA_CACHE_TTL", "600"))
+# Pipe single-file downloads straight into ffmpeg instead of writing the source to disk first.
+STREAMING_TRANSCODE = os.getenv("STREAMING_TRANSCODE", "0") == "1"
+STREAM_CHUNK_SIZE = 1024 * 1024
+# Produce the MP3 and low-quality MP4 in the same ffmpeg pass as the Telegram MP4, so the conversion
+# buttons answer instantly. Skipped for long videos, where the extra encodes cost more than they save.
+PREPARE_VARIANTS = os.getenv("PREPARE_VARIANTS", "0") == "1"
+PREPARE_VARIANTS_MAX_SECONDS = int(os.getenv("PREPARE_VARIANTS_MAX_SECONDS", "600"))
+CONVERSION_ACTIONS = ("mp3", "mp4_low")
+
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "4"))
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", str(default_transcode_workers())))
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "4"))
+PER_USER_JOBS = int(os.getenv("PER_USER_JOBS", "2"))
+# Give each ffmpeg a share of ENCODE_CORES instead of letting every concurrent encode use all of them, and
+# switch to faster x264 presets while encodes are queued. 0 restores ffmpeg's own thread count, and
+# FFMPEG_ADAPTIVE_PRESETS=0 keeps the presets fixed.
+FFMPEG_CPU_BUDGET = os.getenv("FFMPEG_CPU_BUDGET", "1") == "1"
+FFMPEG_ADAPTIVE_PRESETS = os.getenv("FFMPEG_ADAPTIVE_PRESETS", "1") == "1"
+ENCODE_CORES = int(os.getenv("ENCODE_CORES", str(available_cores())))
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+# Cookies and yt-dlp's extractor cache (signature functions, tokens) live on the persistent volume when there is one.
+PERSISTENT_DATA_DIR = os.getenv("PERSISTENT_DATA_DIR", "/app/persistent_data") # Railway Volume
+COOKIES_FILE = os.getenv("COOKIES_FILE", os.path.join(PERSISTENT_DATA_DIR, "cookies.txt"))
+YTDL_CACHE_DIR = os.getenv(
+    "YTDL_CACHE_DIR", os.path.join(PERSISTENT_DATA_DIR if os.path.isdir(PERSISTENT_DATA_DIR) else DOWNLOAD_DIR, "yt-dlp-cache")
+)
+# Off by default: yt-dlp skips the delay only on an instance's first request, so with pooled instances it would
+# apply to nearly every request.
+YTDL_SLEEP_REQUESTS = float(os.getenv("YTDL_SLEEP_REQUESTS", "0"))
+# Prometheus-style metrics on http://METRICS_HOST:METRICS_PORT/metrics; port 0 turns the endpoint off.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+
+# Every file under DOWNLOAD_DIR is tracked so the directory stays under a quota and survives restarts.
+STORAGE_DB_PATH = os.getenv("STORAGE_DB_PATH", os.path.join(DOWNLOAD_DIR, "storage.sqlite3"))
+STORAGE_QUOTA_MB = int(os.getenv("STORAGE_QUOTA_MB", "5120"))
+STORAGE_TTL_HOURS = float(os.getenv("STORAGE_TTL_HOURS", "48"))
+STORAGE_SWEEP_SECONDS = int(os.getenv("STORAGE_SWEEP_SECONDS", "300"))
+
+# Results over LOCAL_SAVE_LIMIT_MB are cut into parts under the limit (stream copy, no re-encode) and sent as
+# media groups. If that fails they are uploaded to gofile and sent as a link.
+SPLIT_OVERSIZED = os.getenv("SPLIT_OVERSIZED", "1") == "1"
+MEDIA_GROUP_SIZE = 10 # Telegram's maximum
+GOFILE_UPLOAD = os.getenv("GOFILE_UPLOAD", "1") == "1"
+GOFILE_TOKEN = os.getenv("GOFILE_TOKEN")
+GOFILE_FOLDER_ID = os.getenv("GOFILE_FOLDER_ID")
+GOFILE_CONCURRENT_UPLOADS = int(os.getenv("GOFILE_CONCURRENT_UPLOADS", "2"))
+
+# A message with several links, or a playlist link, is handled as one batch: the items are downloaded, encoded
+# and uploaded as a pipeline and sent back as media groups. PLAYLIST_MAX_ITEMS=0 turns playlist links away.
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "20"))
+PLAYLIST_MAX_ITEMS = int(os.getenv("PLAYLIST_MAX_ITEMS", "20"))
+BATCH_WINDOW = 2 * MEDIA_GROUP_SIZE # Items prepared ahead: one media group uploads while the next is being made
 
-executor = ThreadPoolExecutor(max_workers=5) # Reverted to a more reasonable default
+executor = ThreadPoolExecutor(max_workers=2) # Small helper tasks only; downloads/encodes go through the scheduler pools
+media_cache: MediaCache | None = None
+ytdl_pool: YoutubeDLPool | None = None
+scheduler: JobScheduler | None = None
+progress_dispatcher: ProgressDispatcher | None = None
+artifact_store: ArtifactStore | None = None
+storage_sweeper: asyncio.Task | None = None
+gofile_uploader: GofileUploader | None = None
+metrics_server = None
+user_requests: dict[int, set[asyncio.Task]] = {} # In-flight requests per user, for /cancel
+metadata_cache = MetadataCache(METADATA_CACHE_TTL)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
@@ -32,65 +121,93 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         f"Hi {user.mention_html()}! I'm your media downloader bot. Send me a link to download!",
     )
 
-last_progress_update_time = {}
+async def cache_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    stats = media_cache.stats()
+    await update.message.reply_text(
+        f"Cache hit rate: {stats['hit_rate'] * 100:.1f}%\n"
+        f"file_id hits: {stats['file_id_hits']}, local hits: {stats['local_hits']}, misses: {stats['misses']}\n"
+        f"Download saved: {yt_dlp.utils.format_bytes(stats['bytes_saved_download'])}\n"
+        f"Upload saved: {yt_dlp.utils.format_bytes(stats['bytes_saved_upload'])}\n"
+        f"Local cache: {stats['local_files']} files, "
+        f"{yt_dlp.utils.format_bytes(stats['local_bytes'])} / {yt_dlp.utils.format_bytes(stats['max_bytes'])}"
+    )
 
-def _blocking_download_video(url: str, update: Update, context: ContextTypes.DEFAULT_TYPE, message_id: int, main_loop: asyncio.AbstractEventLoop) -> tuple[str, int]:
-    chat_id = update.effective_chat.id
-    last_progress_update_time[chat_id] = 0
-    cookies_file_path = "/app/persistent_data/cookies.txt" # Path for Railway Volume
+async def storage_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    stats = artifact_store.stats()
+    lines = [
+        f"Stored: {stats['artifacts']} files, "
+        f"{yt_dlp.utils.format_bytes(stats['bytes'])} / {yt_dlp.utils.format_bytes(stats['quota_bytes'])}",
+        f"In use by running jobs: {stats['leased']}",
+        f"Evicted: {stats['evicted']} files, {yt_dlp.utils.format_bytes(stats['evicted_bytes'])}",
+    ]
+    for kind, size in sorted(stats['bytes_by_kind'].items()):
+        lines.append(f"{kind}: {yt_dlp.utils.format_bytes(size)}")
+    await update.message.reply_text("\n".join(lines))
 
+def _reencode_kind(path: str) -> str:
+    # A re-encode moved into the media cache belongs to the cache; the artifact store only tracks it for its id.
+    return CACHED_KIND if os.path.dirname(os.path.abspath(path)) == os.path.abspath(CACHE_DIR) else "reencode"
+
+def _conversion_keyboard(artifact_id: str) -> InlineKeyboardMarkup:
+    # The artifact id outlives restarts, so old buttons keep working as long as the file is stored.
+    keyboard = [
+        [InlineKeyboardButton("Convert to MP3", callback_data=f"mp3:{artifact_id}")],
+        [InlineKeyboardButton("Convert to MP4 (Low Quality)", callback_data=f"mp4_low:{artifact_id}")],
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+async def _send_cached_file_id(update: Update, context: ContextTypes.DEFAULT_TYPE, cache_key: str, tg_file_id: str) -> bool:
+    # Resend a video Telegram already has. The local copy (if still cached) backs the conversion buttons.
+    local_path = media_cache.get_local(cache_key, count_hit=False)
+    reply_markup = None
+    if local_path:
+        reply_markup = _conversion_keyboard(artifact_store.register(local_path, CACHED_KIND))
+    try:
+        await update.message.reply_video(video=tg_file_id, reply_markup=reply_markup)
+    except Exception as e_resend:
+        logger.warning(f"Cached file_id {tg_file_id} rejected, falling back: {e_resend}")
+        media_cache.invalidate_file_id(cache_key)
+        return False
+    logger.info(f"Served {cache_key} from Telegram file_id cache")
+    if local_path:
+        await update.message.reply_text("Download complete! Choose a conversion option or ignore.")
+    return True
+
+def _make_progress_hook(chat_id: int, message_id: int):
     def progress_hook(d):
+        if not message_id:
+            return
         if d['status'] == 'downloading':
             percentage = d.get('_percent_str', 'N/A')
-            try:
-                numeric_percentage = float(percentage.strip().replace('%',''))
-            except ValueError:
-                numeric_percentage = None
-            
             eta = d.get('_eta_str', 'N/A')
             speed = d.get('_speed_str', 'N/A')
             downloaded_bytes = d.get('downloaded_bytes', 0)
             total_bytes = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
-            current_time = main_loop.time()
-
-            if message_id and \
-               (current_time - last_progress_update_time.get(chat_id, 0) > 5 or
-                (numeric_percentage is not None and
-                 (numeric_percentage % 5 < 0.1 or numeric_percentage > 99.0))):
-                progress_message = (
-                    f"Downloading: {percentage}\n"
-                    f"ETA: {eta}\n"
-                    f"Speed: {speed}\n"
-                    f"Downloaded: {yt_dlp.utils.format_bytes(downloaded_bytes)} / {yt_dlp.utils.format_bytes(total_bytes)}"
-                )
-                try:
-                    asyncio.run_coroutine_threadsafe(
-                        context.bot.edit_message_text(
-                            text=progress_message,
-                            chat_id=chat_id,
-                            message_id=message_id
-                        ),
-                        main_loop
-                    )
-                    last_progress_update_time[chat_id] = current_time
-                except Exception as e_progress:
-                    logger.warning(f"Failed to edit progress message: {e_progress}")
+            progress_message = (
+                f"Downloading: {percentage}\n"
+                f"ETA: {eta}\n"
+                f"Speed: {speed}\n"
+                f"Downloaded: {yt_dlp.utils.format_bytes(downloaded_bytes)} / {yt_dlp.utils.format_bytes(total_bytes)}"
+            )
+            # The dispatcher coalesces and rate-limits, so every hook call can simply post the latest state.
+            progress_dispatcher.update_threadsafe(chat_id, message_id, progress_message)
         elif d['status'] == 'finished':
-            try:
-                asyncio.run_coroutine_threadsafe(
-                    context.bot.edit_message_text(
-                        text="Download finished. Processing...",
-                        chat_id=chat_id,
-                        message_id=message_id
-                    ),
-                    main_loop
-                )
-            except Exception as e_finish:
-                logger.warning(f"Failed to edit 'Download finished' message: {e_finish}")
+            progress_dispatcher.update_threadsafe(chat_id, message_id, "Download finished. Processing...")
 
-    ydl_opts = {
-        'format': 'bestvideo+bestaudio/best',
-        'outtmpl': os.path.join(DOWNLOAD_DIR, f'{uuid.uuid4()}_%(id)s.%(ext)s'),
+    return progress_hook
+
+def _make_encode_progress(chat_id: int, message_id: int, label: str):
+    def on_progress(fraction: float | None, speed: str) -> None:
+        done = f"{fraction * 100:.0f}%" if fraction is not None else "in progress"
+        progress_dispatcher.update_threadsafe(chat_id, message_id, f"{label}: {done}\nSpeed: {speed}")
+
+    return on_progress
+
+def _ydl_params() -> dict:
+    # Shared by every pooled YoutubeDL. Per-job settings (output template, progress hook) are applied at checkout,
+    # and cookies come from the pool's shared jar.
+    return {
+        'format': DEFAULT_FORMAT,
         'noplaylist': True,
         'restrictfilenames': True,
         'socket_timeout': 60,
@@ -104,22 +221,273 @@ def _blocking_download_video(url: str, update: Update, context: ContextTypes.DEF
         'logger': logger,
         'prefer_https': False,
         'force_ipv4': True,
-        'sleep_interval_requests': 1,
-        'max_sleep_interval': 5,
-        'no_cache_dir': True,
-        'progress_hooks': [progress_hook],
-        'cookies': cookies_file_path, # Use the defined path
+        'sleep_interval_requests': YTDL_SLEEP_REQUESTS,
+        'cachedir': YTDL_CACHE_DIR,
+        'extract_flat': 'in_playlist', # List playlist entries without extracting each one
     }
-    logger.info(f"yt-dlp attempting to extract info for URL: {url} with progress hook and cookies from {cookies_file_path}.")
-    if not os.path.exists(cookies_file_path):
-        logger.warning(f"{cookies_file_path} not found. Downloads requiring authentication may fail.")
+
+def _job_outtmpl() -> str:
+    return os.path.join(DOWNLOAD_DIR, f'{uuid.uuid4()}_%(id)s.%(ext)s')
+
+def _queue_notifier(message, stage: str):
+    # Queue notices are progress like any other: they go through the dispatcher, so they share its rate limits
+    # and cannot land on top of a final text. Media messages (captions) get none.
+    report = _status_reporter(message)
+    async def notify(position: int | None) -> None:
+        if position is None:
+            report("⏳ Waiting for your other requests to finish...")
+        else:
+            report(f"⏳ Queued for {stage}: position {position}")
+    return notify
+
+async def queue_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    stats = scheduler.stats()
+    lines = [f"Active users: {stats['active_users']}"]
+    for stage in ("download", "transcode", "upload"):
+        pool = stats[stage]
+        lines.append(
+            f"{stage}: {pool['active']}/{pool['size']} active, {pool['queued']} queued ({pool['waiting_chats']} chats), "
+            f"wait avg {pool['avg_wait']:.1f}s max {pool['max_wait']:.1f}s, {pool['completed']} done"
+        )
+    encoder = ffmpeg_runner.stats()
+    lines.append(
+        f"ffmpeg: {encoder['running']} running on {encoder['cores']} cores "
+        f"({'shared budget' if encoder['adaptive'] else 'no budget'}), {encoder['killed']} killed for cancelled requests"
+    )
+    ytdl = ytdl_pool.stats()
+    lines.append(f"yt-dlp: {ytdl['idle']}/{ytdl['size']} instances idle, {ytdl['reused']} of {ytdl['checkouts']} checkouts reused")
+    await update.message.reply_text("\n".join(lines))
+
+def _abandonable(handler):
+    # Registers the request so /cancel can find it. When the request is cancelled (by /cancel, or by a worker
+    # that gave up draining), its ffmpeg processes are killed rather than left encoding for nobody.
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        user_id = update.effective_user.id
+        task = asyncio.current_task()
+        user_requests.setdefault(user_id, set()).add(task)
+        try:
+            await handler(update, context)
+        except asyncio.CancelledError:
+            ffmpeg_runner.abandon(metrics.trace_id.get())
+            raise
+        finally:
+            tasks = user_requests.get(user_id)
+            if tasks is not None:
+                tasks.discard(task)
+                if not tasks:
+                    del user_requests[user_id]
+    return wrapper
+
+def cancel_requests(user_id: int) -> int:
+    tasks = user_requests.get(user_id, set())
+    for task in tasks:
+        task.cancel()
+    return len(tasks)
+
+async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    cancelled = cancel_requests(update.effective_user.id)
+    text = f"Cancelled {cancelled} running requests." if cancelled else "Nothing to cancel."
+    await update.message.reply_text(text)
+
+def _input_media(path: str, f, caption: str):
+    ext = os.path.splitext(path)[1].lower()
+    media = InputFile(f, filename=os.path.basename(path))
+    if ext == ".mp4":
+        return InputMediaVideo(media=media, caption=caption, supports_streaming=True)
+    if ext in (".mp3", ".m4a"):
+        return InputMediaAudio(media=media, caption=caption)
+    return InputMediaDocument(media=media, caption=caption)
+
+def _status_reporter(status_message):
+    # Progress texts for a message the caller owns; media messages (captions) get none.
+    def report(text: str) -> None:
+        if status_message.text is not None:
+            progress_dispatcher.update(status_message.chat_id, status_message.message_id, text)
+    return report
+
+def _queue_reporter(report, stage: str):
+    # Like _queue_notifier, for callers whose status is a line in someone else's message.
+    async def notify(position: int | None) -> None:
+        report("waiting for your other requests" if position is None else f"queued for {stage}: position {position}")
+    return notify
+
+async def _send_part_batch(status_message, parts: list[str], first_number: int, report, on_wait) -> None:
+    chat_id = status_message.chat_id
+    last_number = first_number + len(parts) - 1
+    report(f"Sending part {first_number}..." if len(parts) == 1 else f"Sending parts {first_number}-{last_number}...")
+    async with scheduler.upload.slot(chat_id, on_wait=on_wait("upload")):
+        with ExitStack() as stack:
+            media = [
+                _input_media(part, stack.enter_context(open(part, 'rb')), f"Part {number}")
+                for number, part in enumerate(parts, start=first_number)
+            ]
+            if len(media) == 1:
+                # A media group needs at least two items.
+                await status_message.reply_document(document=media[0].media, caption=media[0].caption, read_timeout=600, write_timeout=600)
+            else:
+                await status_message.reply_media_group(media=media, read_timeout=600, write_timeout=600)
+
+@metrics.timed("split_and_send")
+async def _send_in_parts(status_message, filepath: str, report, on_wait) -> int:
+    # Cuts the file in the transcode pool and sends each media group as soon as its parts exist, so uploading
+    # overlaps with cutting the rest. Returns the number of parts sent.
+    loop = asyncio.get_running_loop()
+    chat_id = status_message.chat_id
+    parts_queue: asyncio.Queue[str | None] = asyncio.Queue()
+    base = os.path.splitext(os.path.basename(filepath))[0]
+    output_prefix = os.path.join(DOWNLOAD_DIR, f"{uuid.uuid4()}_{base}")
+    unwanted = threading.Event()
+
+    def on_segment(part: str) -> None:
+        # Raising here makes split_media kill ffmpeg and remove the parts it has cut.
+        if unwanted.is_set():
+            raise EncodeAbandoned(f"Split of {filepath} stopped, sending its parts failed")
+        loop.call_soon_threadsafe(parts_queue.put_nowait, part)
+
+    split_task = asyncio.ensure_future(scheduler.transcode.run(
+        chat_id, split_media, filepath, output_prefix, LOCAL_SAVE_LIMIT_MB * 1024 * 1024, on_segment,
+        on_wait=on_wait("splitting"),
+    ))
+    split_task.add_done_callback(lambda _: parts_queue.put_nowait(None))
+    sent = 0
+    batch = []
+    try:
+        while True:
+            part = await parts_queue.get()
+            if part is None:
+                # Raises if the split failed, before the leftover parts go out.
+                await split_task
+                if batch:
+                    await _send_part_batch(status_message, batch, sent + 1, report, on_wait)
+                    sent += len(batch)
+                return sent
+            batch.append(part)
+            if len(batch) == MEDIA_GROUP_SIZE:
+                await _send_part_batch(status_message, batch, sent + 1, report, on_wait)
+                sent += len(batch)
+                batch = []
+    except asyncio.CancelledError:
+        # Kill the split now rather than after it has cut the whole file.
+        ffmpeg_runner.abandon(metrics.trace_id.get())
+        raise
+    except Exception:
+        # The fallback should not wait for the rest of the file to be cut: stop at the next part.
+        unwanted.set()
+        raise
+    finally:
+        await asyncio.wait({split_task})
+        if not split_task.cancelled():
+            split_task.exception() # Retrieved here when the send failed first, so asyncio does not log it
+        for part in glob.glob(glob.escape(f"{output_prefix}_part") + "*"):
+            os.remove(part)
+
+async def _deliver_oversized(status_message, filepath: str, file_size_mb: float, report=None) -> str:
+    # Delivers a file Telegram won't take in one piece: split into parts, or else a gofile link.
+    # Returns the text to show the user. Progress goes to report(text); by default that edits status_message,
+    # which this then owns. A batch passes its own, so its shared status message is not overwritten.
+    saved_text = (
+        f"File size ({file_size_mb:.2f} MB) exceeds upload limit of {LOCAL_SAVE_LIMIT_MB} MB. "
+        f"File saved to local storage: {os.path.basename(filepath)} (Note: This path is on the server)"
+    )
+    chat_id = status_message.chat_id
+    owns_status = report is None
+    if owns_status:
+        report = _status_reporter(status_message)
+        on_wait = functools.partial(_queue_notifier, status_message)
     else:
-        logger.info(f"{cookies_file_path} found. Size: {os.path.getsize(cookies_file_path)} bytes.")
+        on_wait = functools.partial(_queue_reporter, report)
+    if SPLIT_OVERSIZED:
+        try:
+            part_count = await _send_in_parts(status_message, filepath, report, on_wait)
+            return f"File size ({file_size_mb:.2f} MB) exceeds Telegram's upload limit of {LOCAL_SAVE_LIMIT_MB} MB, sent in {part_count} parts."
+        except Exception as e_split:
+            logger.warning(f"Sending {filepath} in parts failed, falling back: {e_split}", exc_info=True)
+        finally:
+            if owns_status:
+                await progress_dispatcher.forget(chat_id, status_message.message_id)
+    if not gofile_uploader:
+        return saved_text
+
+    def on_progress(sent: int, total: int) -> None:
+        report(
+            f"Uploading to gofile: {sent / total * 100:.0f}% "
+            f"({yt_dlp.utils.format_bytes(sent)} / {yt_dlp.utils.format_bytes(total)})"
+        )
+
+    try:
+        async with scheduler.upload.slot(chat_id, on_wait=on_wait("upload")):
+            data = await gofile_uploader.upload(filepath, GOFILE_FOLDER_ID, on_progress)
+        metrics.UPLOADED_BYTES.inc(os.path.getsize(filepath), destination="gofile")
+    except Exception as e_gofile:
+        logger.error(f"gofile upload of {filepath} failed: {e_gofile}", exc_info=True)
+        return saved_text
+    finally:
+        if owns_status:
+            await progress_dispatcher.forget(chat_id, status_message.message_id)
+    return (
+        f"File size ({file_size_mb:.2f} MB) exceeds Telegram's upload limit of {LOCAL_SAVE_LIMIT_MB} MB.\n"
+        f"Download it here: {data.get('downloadPage')}"
+    )
 
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=True)
-        if info is None:
-            raise ValueError("yt-dlp failed to extract video information.")
+def _extract_unprocessed(ydl, url: str) -> dict:
+    # The extractor's result before any format selection (process=False), so it can be processed exactly once
+    # with the selector the preflight picks. Redirects to another extractor are followed the way
+    # process_ie_result would, fields of a url_transparent result overriding the target's.
+    info = ydl.extract_info(url, download=False, process=False)
+    while info is not None and info.get('_type') in ('url', 'url_transparent'):
+        outer = info
+        info = ydl.extract_info(yt_dlp.utils.sanitize_url(outer['url']), download=False, ie_key=outer.get('ie_key'), process=False)
+        if info is not None and outer['_type'] == 'url_transparent':
+            exempted = {'_type', 'url', 'ie_key'}
+            if not outer.get('section_end') and outer.get('section_start') is None:
+                exempted |= {'id', 'extractor', 'extractor_key'}
+            info = {**info, **{key: value for key, value in outer.items() if value is not None and key not in exempted}}
+            if info.get('_type') == 'url':
+                info['_type'] = 'url_transparent'
+    if info is None:
+        raise ValueError("yt-dlp failed to extract video information.")
+    return info
+
+@metrics.timed("extract")
+def _preflight(ydl, url: str, audio_only: bool = False) -> dict:
+    # Extracts metadata (or reuses a recent extraction) and points the YoutubeDL's format selector at the smallest
+    # format that still meets the Telegram target. Returns the unprocessed info dict to hand to process_ie_result.
+    info = metadata_cache.get(url)
+    if info is None:
+        info = _extract_unprocessed(ydl, url)
+        if info.get('_type') == 'playlist':
+            raise ValueError("This link is a playlist, not a single video.")
+        if info.get('_type', 'video') == 'video':
+            metadata_cache.put(url, info)
+    else:
+        logger.info(f"Metadata cache hit for {url}")
+    # A dry run on a copy gives yt-dlp's normalised format list and what DEFAULT_FORMAT would fetch; the info
+    # handed back stays unprocessed, so nothing from the default selection leaks into the real run.
+    default_info = ydl.process_ie_result(copy.deepcopy(info), download=False)
+    choice = select_audio_format(default_info) if audio_only else select_format(default_info, LOCAL_SAVE_LIMIT_MB * 1024 * 1024)
+    if choice is None:
+        logger.info(f"No preflight choice for {url}, keeping {DEFAULT_FORMAT}")
+        return info
+    default_bytes = default_selection_bytes(default_info)
+    saved = "unknown"
+    if default_bytes is not None and choice.expected_bytes is not None:
+        difference = default_bytes - choice.expected_bytes
+        saved = yt_dlp.utils.format_bytes(difference) if difference >= 0 else f"-{yt_dlp.utils.format_bytes(-difference)}"
+    logger.info(
+        f"Preflight format for {url}: {choice.spec} ({choice.reason}, re-encode free: {choice.reencode_free}), "
+        f"expected {yt_dlp.utils.format_bytes(choice.expected_bytes)} vs default "
+        f"{yt_dlp.utils.format_bytes(default_bytes)}, saved {saved}"
+    )
+    ydl.format_selector = ydl.build_format_selector(choice.spec)
+    return info
+
+@metrics.timed("download")
+def _blocking_download_video(url: str, update: Update, context: ContextTypes.DEFAULT_TYPE, message_id: int, audio_only: bool = False, progress_hook=None) -> tuple[str, int]:
+    progress_hook = progress_hook or _make_progress_hook(update.effective_chat.id, message_id)
+    logger.info(f"yt-dlp attempting to extract info for URL: {url} with progress hook.")
+    with ytdl_pool.checkout(progress_hook, outtmpl=_job_outtmpl()) as ydl:
+        info = ydl.process_ie_result(_preflight(ydl, url, audio_only), download=True)
         filepath = ydl.prepare_filename(info)
         logger.info(f"yt-dlp prepared filename: {filepath}")
         if not os.path.exists(filepath):
@@ -133,133 +501,540 @@ def _blocking_download_video(url: str, update: Update, context: ContextTypes.DEF
                     logger.error(f"Expected file {filepath} not found. {DOWNLOAD_DIR} does not exist.")
                 raise FileNotFoundError(f"Downloaded file not found at expected path: {filepath}")
         file_size = os.path.getsize(filepath)
+        metrics.DOWNLOADED_BYTES.inc(file_size)
         return filepath, file_size
 
-def _blocking_convert_media(input_filepath: str, action: str) -> tuple[str, int]:
-    base, orig_ext = os.path.splitext(input_filepath)
-    output_filepath = ""
-    if action == "mp3":
-        output_filepath = f"{base}_{action}.mp3"
-        command = ["ffmpeg", "-i", input_filepath, "-vn", "-ab", "128k", "-ar", "44100", "-y", output_filepath]
-    elif action == "mp4_low":
-        output_filepath = f"{base}_{action}.mp4"
-        command = ["ffmpeg", "-i", input_filepath, "-vf", "scale=640:-1", "-crf", "28", "-y", output_filepath]
-    else:
+@metrics.timed("expand")
+def _blocking_expand_url(url: str) -> list[str] | None:
+    # Returns the entry URLs of a playlist link (at most PLAYLIST_MAX_ITEMS), or None for a single video. A single
+    # video's extraction goes into the metadata cache, so its download does not repeat it.
+    with ytdl_pool.checkout(playlistend=PLAYLIST_MAX_ITEMS) as ydl:
+        info = _extract_unprocessed(ydl, url)
+        if info.get('_type') != 'playlist':
+            # Cached unprocessed, like the preflight's own extractions, so the download selects its format once.
+            # Other multi-entry results may hold a lazy entry generator, which cannot be cached.
+            if info.get('_type', 'video') == 'video':
+                metadata_cache.put(url, info)
+            return None
+        # Only applies playlistend; with extract_flat the entries themselves are not extracted.
+        info = ydl.process_ie_result(info, download=False)
+    entries = [entry.get('url') or entry.get('webpage_url') for entry in info.get('entries') or [] if entry]
+    logger.info(f"Playlist {url} lists {len(entries)} entries (cap {PLAYLIST_MAX_ITEMS})")
+    return [entry for entry in entries if entry]
+
+def _is_streamable(info: dict) -> bool:
+    # Takes the info processed with the pre-flight selector, so it judges the format that will actually be fetched.
+    # Merged bestvideo+bestaudio downloads and fragmented protocols (HLS/DASH) need yt-dlp's own downloaders.
+    return not info.get('requested_formats') and info.get('protocol') in ('http', 'https') and bool(info.get('url'))
+
+@metrics.timed("stream_transcode")
+def _blocking_stream_and_transcode(url: str, update: Update, context: ContextTypes.DEFAULT_TYPE, message_id: int) -> tuple[str, int, int] | None:
+    # Returns (reencoded_filepath, reencoded_size, downloaded_bytes), or None when the caller should fall back
+    # to the regular download-then-transcode path.
+    progress_hook = _make_progress_hook(update.effective_chat.id, message_id)
+    with ytdl_pool.checkout(progress_hook) as ydl:
+        info = ydl.process_ie_result(_preflight(ydl, url), download=False)
+        if not _is_streamable(info):
+            logger.info(f"Format {info.get('format_id')} for {url} is not streamable, using the regular path.")
+            return None
+
+        total_bytes = info.get('filesize') or info.get('filesize_approx') or 0
+        plan = plan_for_limits(
+            probe_from_info(info), total_bytes, False,
+            LOCAL_SAVE_LIMIT_MB * 1024 * 1024, TELEGRAM_FILE_LIMIT_MB * 1024 * 1024,
+        )
+        if plan.mode == "none":
+            plan = TranscodePlan("remux", "streamed input still has to be written out")
+        settings = ffmpeg_runner.settings()
+        logger.info(f"Streaming transcode plan for {url}: {plan}, {settings}")
+        reencoded_filepath = os.path.join(DOWNLOAD_DIR, f"{uuid.uuid4()}_{info['id']}_telegram.mp4")
+
+        # stderr goes to a file so a chatty ffmpeg can never block while we are writing its stdin.
+        with tempfile.TemporaryFile() as ffmpeg_stderr, ffmpeg_runner.popen(
+            build_command("pipe:0", reencoded_filepath, plan, settings),
+            stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=ffmpeg_stderr,
+        ) as process:
+            downloaded_bytes = 0
+            started = time.monotonic()
+            try:
+                # The YoutubeDL goes back to the pool afterwards, so close the response here rather than with it.
+                with ydl.urlopen(yt_dlp.networking.Request(info['url'], headers=info.get('http_headers') or {})) as response:
+                    total_bytes = int(response.headers.get('Content-Length') or 0) or total_bytes
+                    while chunk := response.read(STREAM_CHUNK_SIZE):
+                        process.stdin.write(chunk)
+                        downloaded_bytes += len(chunk)
+                        elapsed = time.monotonic() - started
+                        speed = downloaded_bytes / elapsed if elapsed > 0 else None
+                        eta = (total_bytes - downloaded_bytes) / speed if speed and total_bytes else None
+                        progress_hook({
+                            'status': 'downloading',
+                            '_percent_str': f"{downloaded_bytes / total_bytes * 100:.1f}%" if total_bytes else 'N/A',
+                            '_eta_str': yt_dlp.utils.formatSeconds(eta) if eta is not None else 'N/A',
+                            '_speed_str': f"{yt_dlp.utils.format_bytes(speed)}/s" if speed else 'N/A',
+                            'downloaded_bytes': downloaded_bytes,
+                            'total_bytes': total_bytes,
+                        })
+                process.stdin.close()
+            except BrokenPipeError:
+                logger.warning(f"ffmpeg closed its input early while streaming {url}")
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass # The buffered tail cannot be flushed; the pipe is closed all the same
+            except Exception:
+                process.kill()
+                wait_ffmpeg(process, started)
+                if os.path.exists(reencoded_filepath):
+                    os.remove(reencoded_filepath)
+                raise
+            finally:
+                metrics.DOWNLOADED_BYTES.inc(downloaded_bytes)
+            wait_ffmpeg(process, started, info.get('duration'))
+            if ffmpeg_runner.was_killed(process):
+                if os.path.exists(reencoded_filepath):
+                    os.remove(reencoded_filepath)
+                raise EncodeAbandoned(f"Streaming transcode of {url} was killed, its request was abandoned")
+            if process.returncode != 0 or not os.path.exists(reencoded_filepath):
+                ffmpeg_stderr.seek(0)
+                logger.warning(
+                    f"Streaming transcode failed for {url} (exit {process.returncode}), falling back. "
+                    f"FFmpeg output: {ffmpeg_stderr.read().decode(errors='replace')[-2000:]}"
+                )
+                if os.path.exists(reencoded_filepath):
+                    os.remove(reencoded_filepath)
+                return None
+
+    progress_hook({'status': 'finished'})
+    return reencoded_filepath, os.path.getsize(reencoded_filepath), downloaded_bytes
+
+@metrics.timed("convert")
+def _blocking_convert_media(input_filepath: str, action: str, on_progress=None) -> tuple[str, int]:
+    # input_filepath is shared (cache entries, other users' buttons) and only ever read; the output gets a unique name.
+    if action not in CONVERSION_EXTENSIONS:
         raise ValueError(f"Unsupported conversion type: {action}")
-    result = subprocess.run(command, check=True, capture_output=True)
-    logger.info(f"FFmpeg stdout: {result.stdout.decode()}")
-    logger.info(f"FFmpeg stderr: {result.stderr.decode()}")
-    if not output_filepath or not os.path.exists(output_filepath):
-        raise RuntimeError(f"Conversion failed or output file not found. FFmpeg output: {result.stderr.decode()}")
+    base = os.path.splitext(os.path.basename(input_filepath))[0]
+    output_filepath = os.path.join(DOWNLOAD_DIR, f"{uuid.uuid4()}_{base}_{action}{CONVERSION_EXTENSIONS[action]}")
+    audio_codec = None
+    duration = None
+    try:
+        probe = probe_media(input_filepath)
+        audio_codec = audio_codec_of(probe)
+        duration = probe_duration(probe)
+    except (subprocess.CalledProcessError, ValueError) as e_probe:
+        logger.warning(f"ffprobe failed for {input_filepath}: {e_probe}")
+    settings = ffmpeg_runner.settings()
+    command = ["ffmpeg", *settings.thread_args(), "-i", input_filepath, *conversion_output_args(action, output_filepath, audio_codec, settings)]
+    try:
+        ffmpeg_stderr = run_ffmpeg(command, duration, on_progress)
+    except Exception:
+        if os.path.exists(output_filepath):
+            os.remove(output_filepath)
+        raise
+    if not os.path.exists(output_filepath):
+        raise RuntimeError(f"Conversion failed or output file not found. FFmpeg output: {ffmpeg_stderr}")
     file_size = os.path.getsize(output_filepath)
     return output_filepath, file_size
 
-def _blocking_reencode_video(original_filepath: str, resolution: str | None = None) -> tuple[str, int]:
+@metrics.timed("reencode")
+def _blocking_reencode_video(original_filepath: str, on_progress=None, variants: tuple[str, ...] = ()) -> tuple[str, int, dict[str, str]]:
+    # Returns (reencoded_filepath, size, prepared conversion variants by action).
     base, ext = os.path.splitext(original_filepath)
     reencoded_filepath = base + "_telegram.mp4"
-    command = [
-        "ffmpeg", "-i", original_filepath,
-        "-vf", "scale=1280:-1", # Downscale to 1280p width, keep aspect ratio
-        "-c:v", "libx264", "-preset", "fast",
-        "-crf", "28", "-maxrate", "1000k", "-bufsize", "2000k", "-c:a", "aac",
-        "-b:a", "64k", "-movflags", "faststart", "-y", reencoded_filepath
-    ]
-    if resolution:
-        # This is a bit of a hack, but it works.
-        # The scale filter is already in the command, so we just need to replace the value.
-        try:
-            index_of_vf = command.index("-vf")
-            command[index_of_vf+1] = f"scale={resolution}"
-        except ValueError:
-            # If -vf is not in the command for some reason, add it.
-            command.insert(-1, "-vf")
-            command.insert(-1, f"scale={resolution}")
+    file_size = os.path.getsize(original_filepath)
+    duration = None
+    audio_codec = None
+    ffmpeg_stderr = ""
+    try:
+        probe = probe_media(original_filepath)
+        duration = probe_duration(probe)
+        audio_codec = audio_codec_of(probe)
+        plan = plan_for_limits(
+            probe, file_size, is_faststart_mp4(original_filepath),
+            LOCAL_SAVE_LIMIT_MB * 1024 * 1024, TELEGRAM_FILE_LIMIT_MB * 1024 * 1024,
+        )
+    except (subprocess.CalledProcessError, ValueError) as e_probe:
+        logger.warning(f"ffprobe failed for {original_filepath}, falling back to a full encode: {e_probe}")
+        plan = TranscodePlan("encode", "probe failed", width=1280, video_kbps=1000)
+    settings = ffmpeg_runner.settings()
+    logger.info(f"Transcode plan for {original_filepath}: {plan}, {settings}")
 
+    if variants and (duration is None or duration > PREPARE_VARIANTS_MAX_SECONDS or audio_codec is None):
+        variants = ()
+    outputs = []
+    if plan.mode != "none":
+        outputs.append(telegram_output_args(reencoded_filepath, plan, settings))
+    variant_paths = {}
+    for action in variants:
+        variant_paths[action] = f"{base}_{action}{CONVERSION_EXTENSIONS[action]}"
+        outputs.append(conversion_output_args(action, variant_paths[action], audio_codec, settings))
 
-    result = subprocess.run(command, check=True, capture_output=True)
-    logger.info(f"FFmpeg stdout: {result.stdout.decode()}")
-    logger.info(f"FFmpeg stderr: {result.stderr.decode()}")
+    if outputs:
+        try:
+            ffmpeg_stderr = run_ffmpeg(build_multi_output_command(original_filepath, outputs, settings), duration, on_progress)
+        except Exception:
+            for variant_path in [reencoded_filepath, *variant_paths.values()]:
+                if os.path.exists(variant_path):
+                    os.remove(variant_path)
+            raise
+    if plan.mode == "none":
+        os.replace(original_filepath, reencoded_filepath)
     if not os.path.exists(reencoded_filepath):
-        raise RuntimeError(f"Re-encoding failed or output file not found. FFmpeg output: {result.stderr.decode()}")
+        raise RuntimeError(f"Re-encoding failed or output file not found. FFmpeg output: {ffmpeg_stderr}")
     file_size = os.path.getsize(reencoded_filepath)
-    return reencoded_filepath, file_size
+    return reencoded_filepath, file_size, variant_paths
 
+def _batch_download_hook(batch: BatchProgress, index: int):
+    def progress_hook(d):
+        if d['status'] == 'downloading':
+            batch.set(index, f"downloading {d.get('_percent_str', '').strip()}")
+        elif d['status'] == 'finished':
+            batch.set(index, "downloaded, waiting to encode")
+
+    return progress_hook
+
+def _batch_encode_progress(batch: BatchProgress, index: int):
+    def on_progress(fraction: float | None, speed: str) -> None:
+        batch.set(index, f"encoding {fraction * 100:.0f}%" if fraction is not None else "encoding")
+
+    return on_progress
+
+async def _expand_batch_url(chat_id: int, url: str) -> list[str]:
+    # Links already in the cache are not looked up again; a link that cannot be listed stays a single item and
+    # fails with its real error when it is downloaded.
+    extractor, video_id = await asyncio.get_running_loop().run_in_executor(executor, identify_url, url)
+    cache_key = make_cache_key(extractor, video_id, CACHE_FORMAT_PROFILE)
+    if media_cache.get_file_id(cache_key, count_hit=False) or media_cache.get_local(cache_key, count_hit=False):
+        return [url]
+    try:
+        entries = await scheduler.download.run(chat_id, _blocking_expand_url, url)
+    except Exception as e_expand:
+        logger.warning(f"Could not list {url}: {e_expand}")
+        return [url]
+    return [url] if entries is None else entries
+
+async def _prepare_batch_item(update: Update, url: str, index: int, batch: BatchProgress) -> dict:
+    # Downloads and encodes one batch item, each step in its own pool, so later items download while earlier
+    # ones encode. A stored result comes back leased until it has been sent.
+    chat_id = update.effective_chat.id
+    user_id = update.effective_user.id
+    extractor, video_id = await asyncio.get_running_loop().run_in_executor(executor, identify_url, url)
+    cache_key = make_cache_key(extractor, video_id, CACHE_FORMAT_PROFILE)
+    item = {"index": index, "url": url, "cache_key": cache_key, "extractor": extractor, "video_id": video_id, "lease": ExitStack()}
+    item["file_id"] = media_cache.get_file_id(cache_key)
+    if item["file_id"]:
+        batch.set(index, "cached")
+        return item
+    reencoded_filepath = media_cache.get_local(cache_key)
+    if not reencoded_filepath:
+        media_cache.record_miss()
+        filepath, file_size = await scheduler.download.run(
+            chat_id, _blocking_download_video, url, update, None, 0, False, _batch_download_hook(batch, index),
+        )
+        try:
+            artifact_store.register(filepath, "source", user_id)
+            batch.set(index, "downloaded, waiting to encode")
+            reencoded_filepath, reencoded_file_size, _ = await scheduler.transcode.run(
+                chat_id, _blocking_reencode_video, filepath, _batch_encode_progress(batch, index),
+            )
+        finally:
+            artifact_store.remove_path(filepath)
+        if reencoded_file_size <= LOCAL_SAVE_LIMIT_MB * 1024 * 1024:
+            reencoded_filepath = media_cache.put_local(
+                cache_key, extractor, video_id, CACHE_FORMAT_PROFILE, reencoded_filepath, source_size=file_size
+            )
+    item["path"] = reencoded_filepath
+    item["lease"].enter_context(artifact_store.lease(artifact_store.register(reencoded_filepath, _reencode_kind(reencoded_filepath), user_id)))
+    batch.set(index, "ready")
+    return item
+
+async def _send_batch_items(update: Update, items: list[dict], batch: BatchProgress) -> None:
+    # Sends the items as one media group (a single item as a plain video). If the group is refused, each item is
+    # sent on its own so one bad file or stale file_id does not sink the rest.
+    chat_id = update.effective_chat.id
+    for item in items:
+        batch.set(item["index"], "uploading")
+    try:
+        async with scheduler.upload.slot(chat_id):
+            with ExitStack() as stack:
+                media = []
+                for item in items:
+                    caption = f"#{item['index'] + 1} {item['url']}"
+                    if item["file_id"]:
+                        media.append(InputMediaVideo(media=item["file_id"], caption=caption, supports_streaming=True))
+                    else:
+                        media.append(_input_media(item["path"], stack.enter_context(open(item["path"], 'rb')), caption))
+                if len(media) == 1:
+                    sent_messages = [await update.message.reply_video(
+                        video=media[0].media, caption=media[0].caption, read_timeout=600, write_timeout=600,
+                    )]
+                else:
+                    sent_messages = await update.message.reply_media_group(media=media, read_timeout=600, write_timeout=600)
+    except Exception as e_send:
+        if len(items) > 1:
+            logger.warning(f"Media group of {len(items)} batch items refused, sending them one by one: {e_send}")
+            for item in items:
+                await _send_batch_items(update, [item], batch)
+            return
+        item = items[0]
+        logger.error(f"Error uploading batch item {item['url']}: {e_send}")
+        if item["file_id"]:
+            media_cache.invalidate_file_id(item["cache_key"])
+        batch.set(item["index"], "failed")
+        await update.message.reply_text(f"Failed to upload {item['url']}. Error: {e_send}")
+        return
+    for item, sent_message in zip(items, sent_messages):
+        sent_media = sent_message.video or sent_message.document
+        if sent_media and not item["file_id"]:
+            media_cache.put_file_id(item["cache_key"], item["extractor"], item["video_id"], CACHE_FORMAT_PROFILE, sent_media.file_id)
+        batch.set(item["index"], "sent")
+
+async def _run_batch(update: Update, urls: list[str], status_message, expand: bool = True) -> None:
+    # Handles several links (or a playlist's entries) as one request. Every item runs through the download,
+    # transcode and upload pools on its own, so the stages overlap across items, while results go out in
+    # order and in media groups. status_message shows the progress of the whole batch.
+    chat_id = update.effective_chat.id
+    if expand and PLAYLIST_MAX_ITEMS:
+        expanded = await asyncio.gather(*(_expand_batch_url(chat_id, url) for url in urls))
+        urls = [entry for entries in expanded for entry in entries]
+    urls = list(dict.fromkeys(urls))
+    skipped = max(0, len(urls) - BATCH_MAX_ITEMS)
+    urls = urls[:BATCH_MAX_ITEMS]
+    if not urls:
+        await status_message.edit_text("Nothing to download: the playlist is empty.")
+        return
+    logger.info(f"Batch of {len(urls)} items for chat {chat_id} ({skipped} over the limit skipped)")
+    batch = BatchProgress(progress_dispatcher, chat_id, status_message.message_id, len(urls))
+    window = asyncio.Semaphore(BATCH_WINDOW)
+
+    async def prepare(index: int, url: str) -> dict:
+        # The window is released by the sending loop below, once the item is sent or has failed.
+        await window.acquire()
+        return await _prepare_batch_item(update, url, index, batch)
+
+    async def send_group() -> None:
+        if group:
+            await _send_batch_items(update, group, batch)
+            for item in group:
+                item["lease"].close()
+                window.release()
+            group.clear()
+
+    tasks = [asyncio.create_task(prepare(index, url)) for index, url in enumerate(urls)]
+    group = []
+    try:
+        for index, task in enumerate(tasks):
+            try:
+                item = await task
+            except Exception as e_item:
+                logger.error(f"Error downloading batch item {urls[index]}: {e_item}", exc_info=True)
+                batch.set(index, "failed")
+                window.release()
+                await update.message.reply_text(f"Failed to download {urls[index]}. Error: {e_item}")
+                continue
+            file_size = os.path.getsize(item["path"]) if not item["file_id"] else 0
+            if file_size > LOCAL_SAVE_LIMIT_MB * 1024 * 1024:
+                # Too large for a media group: sent on its own in parts, or as a link.
+                await send_group()
+                batch.set(index, "sending in parts")
+                text = await _deliver_oversized(status_message, item["path"], file_size / (1024 * 1024), functools.partial(batch.set, index))
+                item["lease"].close()
+                window.release()
+                batch.set(index, "sent")
+                await update.message.reply_text(f"#{index + 1} {item['url']}: {text}")
+                continue
+            group.append(item)
+            if len(group) == MEDIA_GROUP_SIZE:
+                await send_group()
+        await send_group()
+    finally:
+        await progress_dispatcher.forget(chat_id, status_message.message_id)
+        for task in tasks:
+            task.cancel()
+        await asyncio.wait(tasks)
+        for task in tasks:
+            if not task.cancelled() and task.exception() is None:
+                task.result()["lease"].close()
+    summary = f"Batch finished: {batch.count('sent')} of {len(urls)} sent, {batch.count('failed')} failed."
+    if skipped:
+        summary += f"\nOnly the first {BATCH_MAX_ITEMS} links are taken per message, {skipped} skipped."
+    await status_message.edit_text(summary)
+
+@metrics.traced("url")
+@_abandonable
 async def handle_url_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     text = update.message.text
     logger.info(f"Received message text: {text}")
-    url_match = re.search(r"https?://\S+", text)
-    if url_match:
-        url = url_match.group(0)
+    urls = list(dict.fromkeys(re.findall(r"https?://\S+", text)))
+    if len(urls) > 1:
+        logger.info(f"Detected {len(urls)} URLs, handling them as a batch")
+        status_message = await update.message.reply_text(f"Preparing a batch of {len(urls)} links...")
+        async with scheduler.job(update.effective_user.id, on_wait=_queue_notifier(status_message, "processing")):
+            try:
+                await _run_batch(update, urls, status_message)
+            except Exception as e:
+                logger.error(f"Error handling batch of {len(urls)} links: {e}", exc_info=True)
+                await update.message.reply_text(f"Failed to handle your links. Error: {e}")
+    elif urls:
+        url = urls[0]
         logger.info(f"Detected URL: {url}")
         progress_message = await update.message.reply_text(f"Initializing download for: {url}")
         progress_message_id = progress_message.message_id
+        chat_id = update.effective_chat.id
+        # Matching against every extractor regex takes a noticeable fraction of a second, keep it off the loop.
+        extractor, video_id = await asyncio.get_running_loop().run_in_executor(executor, identify_url, url)
+        cache_key = make_cache_key(extractor, video_id, CACHE_FORMAT_PROFILE)
+        tg_file_id = media_cache.get_file_id(cache_key)
+        if tg_file_id and await _send_cached_file_id(update, context, cache_key, tg_file_id):
+            await progress_message.edit_text("Served from cache.")
+            return
+        user_id = update.effective_user.id
+        async with scheduler.job(user_id, on_wait=_queue_notifier(progress_message, "processing")):
+            filepath = ""
+            variant_paths = {}
+            try:
+                if PLAYLIST_MAX_ITEMS and not media_cache.get_local(cache_key, count_hit=False):
+                    # For a single video this is the extraction its download needs anyway, kept in the metadata cache.
+                    entries = await scheduler.download.run(
+                        chat_id, _blocking_expand_url, url, on_wait=_queue_notifier(progress_message, "download"),
+                    )
+                    if entries is not None:
+                        await _run_batch(update, entries, progress_message, expand=False)
+                        return
+                reencoded_filepath = media_cache.get_local(cache_key)
+                if reencoded_filepath:
+                    reencoded_file_size = os.path.getsize(reencoded_filepath)
+                    file_size_mb = reencoded_file_size / (1024 * 1024)
+                    logger.info(f"Local cache hit for {extractor}:{video_id}: {reencoded_filepath}")
+                else:
+                    media_cache.record_miss()
+                    streamed = None
+                    if STREAMING_TRANSCODE:
+                        # Network- and CPU-bound at once, so it holds a slot in both pools.
+                        async with scheduler.download.slot(chat_id, on_wait=_queue_notifier(progress_message, "download")):
+                            streamed = await scheduler.transcode.run(
+                                chat_id, _blocking_stream_and_transcode, url, update, context, progress_message_id,
+                                on_wait=_queue_notifier(progress_message, "transcode"),
+                            )
+                    if streamed:
+                        reencoded_filepath, reencoded_file_size, file_size = streamed
+                    else:
+                        filepath, file_size = await scheduler.download.run(
+                            chat_id, _blocking_download_video, url, update, context, progress_message_id,
+                            on_wait=_queue_notifier(progress_message, "download"),
+                        )
+                        artifact_store.register(filepath, "source", user_id)
+                        reencoded_filepath, reencoded_file_size, variant_paths = await scheduler.transcode.run(
+                            chat_id, _blocking_reencode_video, filepath,
+                            _make_encode_progress(chat_id, progress_message_id, "Encoding for Telegram"),
+                            CONVERSION_ACTIONS if PREPARE_VARIANTS else (),
+                            on_wait=_queue_notifier(progress_message, "transcode"),
+                        )
+                    file_size_mb = reencoded_file_size / (1024 * 1024)
+                    logger.info(f"File: {reencoded_filepath}, Size: {reencoded_file_size} bytes ({file_size_mb:.2f} MB)")
+                    if file_size_mb <= LOCAL_SAVE_LIMIT_MB:
+                        reencoded_filepath = media_cache.put_local(
+                            cache_key, extractor, video_id, CACHE_FORMAT_PROFILE, reencoded_filepath, source_size=file_size
+                        )
+
+                reencoded_id = artifact_store.register(reencoded_filepath, _reencode_kind(reencoded_filepath), user_id)
+
+                logger.info(f"Checking file size: {file_size_mb:.2f} MB vs limit {TELEGRAM_FILE_LIMIT_MB} MB and local save limit {LOCAL_SAVE_LIMIT_MB} MB")
+                if file_size_mb > LOCAL_SAVE_LIMIT_MB:
+                    with artifact_store.lease(reencoded_id):
+                        await update.message.reply_text(await _deliver_oversized(progress_message, reencoded_filepath, file_size_mb))
+                else:
+                    reply_markup = _conversion_keyboard(reencoded_id)
+                    logger.info(f"Attempting to send document: {reencoded_filepath}")
+                    try:
+                        async with scheduler.upload.slot(chat_id, on_wait=_queue_notifier(progress_message, "upload")):
+                            with artifact_store.lease(reencoded_id), open(reencoded_filepath, 'rb') as f:
+                                unique_filename = f"{os.path.basename(reencoded_filepath)}?v={uuid.uuid4()}"
+                                sent_message = await update.message.reply_video(video=InputFile(f, filename=unique_filename), reply_markup=reply_markup, read_timeout=600, write_timeout=600)
+                        logger.info(f"Document sent successfully: {unique_filename}")
+                        sent_media = sent_message.video or sent_message.document or sent_message.animation
+                        if sent_media:
+                            media_cache.put_file_id(cache_key, extractor, video_id, CACHE_FORMAT_PROFILE, sent_media.file_id)
+                        for action, variant_path in variant_paths.items():
+                            artifact_store.register(variant_path, f"conversion:{action}", user_id, parent_id=reencoded_id)
+                        variant_paths = {}
+                        await update.message.reply_text("Download complete! Choose a conversion option or ignore.")
+                    except Exception as upload_e:
+                        logger.error(f"Error uploading document {reencoded_filepath}: {upload_e}")
+                        await update.message.reply_text(f"Failed to upload file. Error: {upload_e}")
+            except Exception as e:
+                logger.error(f"Error downloading {url}: {e}", exc_info=True)
+                await update.message.reply_text(f"Failed to download {url}. Error: {e}")
+            finally:
+                await progress_dispatcher.forget(chat_id, progress_message_id)
+                if filepath:
+                    artifact_store.remove_path(filepath)
+                # Variants nobody can ask for (upload failed or file too large) are not worth keeping.
+                for variant_path in variant_paths.values():
+                    artifact_store.remove_path(variant_path)
+    else:
+        await update.message.reply_text("Please send a valid URL to download.")
+
+@metrics.traced("mp3")
+@_abandonable
+async def handle_mp3_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Audio-only fast path: downloads just the audio stream instead of a full video plus a conversion.
+    url_match = re.search(r"https?://\S+", " ".join(context.args or []))
+    if not url_match:
+        await update.message.reply_text("Usage: /mp3 <link>")
+        return
+    url = url_match.group(0)
+    chat_id = update.effective_chat.id
+    progress_message = await update.message.reply_text(f"Initializing audio download for: {url}")
+    progress_message_id = progress_message.message_id
+    async with scheduler.job(update.effective_user.id, on_wait=_queue_notifier(progress_message, "processing")):
+        filepath = ""
+        converted_filepath = ""
         try:
-            main_loop = asyncio.get_running_loop()
-            filepath, file_size = await main_loop.run_in_executor(
-                executor, _blocking_download_video, url, update, context, progress_message_id, main_loop
+            filepath, _ = await scheduler.download.run(
+                chat_id, _blocking_download_video, url, update, context, progress_message_id, True,
+                on_wait=_queue_notifier(progress_message, "download"),
             )
-            reencoded_filepath, reencoded_file_size = await asyncio.get_running_loop().run_in_executor(
-                executor, _blocking_reencode_video, filepath
+            converted_filepath, converted_file_size = await scheduler.transcode.run(
+                chat_id, _blocking_convert_media, filepath, "mp3",
+                _make_encode_progress(chat_id, progress_message_id, "Converting to MP3"),
+                on_wait=_queue_notifier(progress_message, "conversion"),
             )
-            file_size_mb = reencoded_file_size / (1024 * 1024)
-            logger.info(f"File: {reencoded_filepath}, Size: {reencoded_file_size} bytes ({file_size_mb:.2f} MB)")
-            if file_size_mb > TELEGRAM_FILE_LIMIT_MB:
-                logger.info(f"Re-encoded file still too large ({file_size_mb:.2f} MB). Attempting lower resolution re-encode.")
-                if os.path.exists(reencoded_filepath):
-                    os.remove(reencoded_filepath)
-                reencoded_filepath, reencoded_file_size = await asyncio.get_running_loop().run_in_executor(
-                    executor, _blocking_reencode_video, filepath, "640:-1"
-                )
-                file_size_mb = reencoded_file_size / (1024 * 1024)
-                logger.info(f"File (low res): {reencoded_filepath}, Size: {reencoded_file_size} bytes ({file_size_mb:.2f} MB)")
-            
-            logger.info(f"Checking file size: {file_size_mb:.2f} MB vs limit {TELEGRAM_FILE_LIMIT_MB} MB and local save limit {LOCAL_SAVE_LIMIT_MB} MB")
-            if file_size_mb > LOCAL_SAVE_LIMIT_MB:
-                await update.message.reply_text(
-                    f"File size ({file_size_mb:.2f} MB) exceeds upload limit of {LOCAL_SAVE_LIMIT_MB} MB. "
-                    f"File saved to local storage: {os.path.basename(reencoded_filepath)} (Note: This path is on the server)"
-                )
-                if os.path.exists(filepath):
-                    os.remove(filepath)
+            converted_file_size_mb = converted_file_size / (1024 * 1024)
+            if converted_file_size_mb > LOCAL_SAVE_LIMIT_MB:
+                await update.message.reply_text(await _deliver_oversized(progress_message, converted_filepath, converted_file_size_mb))
             else:
-                file_id = str(uuid.uuid4())
-                context.bot_data[file_id] = reencoded_filepath
-                keyboard = [
-                    [InlineKeyboardButton("Convert to MP3", callback_data=f"mp3:{file_id}")],
-                    [InlineKeyboardButton("Convert to MP4 (Low Quality)", callback_data=f"mp4_low:{file_id}")],
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                logger.info(f"Attempting to send document: {reencoded_filepath}")
-                try:
-                    with open(reencoded_filepath, 'rb') as f:
-                        unique_filename = f"{os.path.basename(reencoded_filepath)}?v={uuid.uuid4()}"
-                        await update.message.reply_video(video=InputFile(f, filename=unique_filename), reply_markup=reply_markup, read_timeout=600, write_timeout=600)
-                    logger.info(f"Document sent successfully: {unique_filename}")
-                    await update.message.reply_text("Download complete! Choose a conversion option or ignore.")
-                except Exception as upload_e:
-                    logger.error(f"Error uploading document {reencoded_filepath}: {upload_e}")
-                    await update.message.reply_text(f"Failed to upload file. Error: {upload_e}")
-                finally:
-                    if os.path.exists(filepath):
-                        os.remove(filepath)
+                async with scheduler.upload.slot(chat_id, on_wait=_queue_notifier(progress_message, "upload")):
+                    with open(converted_filepath, 'rb') as f:
+                        await update.message.reply_document(document=InputFile(f, filename=os.path.basename(converted_filepath)))
+                logger.info(f"MP3 sent successfully: {converted_filepath}")
         except Exception as e:
-            logger.error(f"Error downloading {url}: {e}", exc_info=True)
+            logger.error(f"Error downloading audio for {url}: {e}", exc_info=True)
             await update.message.reply_text(f"Failed to download {url}. Error: {e}")
-    else:
-        await update.message.reply_text("Please send a valid URL to download.")
+        finally:
+            await progress_dispatcher.forget(chat_id, progress_message_id)
+            for path in (filepath, converted_filepath):
+                if path and os.path.exists(path):
+                    os.remove(path)
 
+@metrics.traced("convert")
+@_abandonable
 async def convert_media(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.info("Entered convert_media function.")
     query = update.callback_query
-    await query.answer()
+    try:
+        await query.answer()
+    except BadRequest as e_answer:
+        # In worker mode the front end has already answered, or the query expired while the job was queued.
+        logger.info(f"Callback query not answered: {e_answer}")
     logger.info(f"Callback query data: {query.data}")
     data = query.data.split(":")
     action = data[0]
-    file_id = data[1]
-    original_filepath_from_botdata = context.bot_data.get(file_id)
+    artifact_id = data[1]
+    original_filepath = artifact_store.get(artifact_id)
+    prepared_filepath = artifact_store.find_child(artifact_id, f"conversion:{action}")
 
-    if not original_filepath_from_botdata or not os.path.exists(original_filepath_from_botdata):
-        logger.error(f"Original file not found for file_id: {file_id}. Path: {original_filepath_from_botdata}")
+    if not prepared_filepath and not original_filepath:
+        logger.error(f"Original file not found for artifact {artifact_id}")
         message_text = "Original file not found. It might have been removed or the request is old. Please try downloading again."
         try:
             if hasattr(query.message, 'caption') and query.message.caption is not None:
@@ -271,47 +1046,64 @@ async def convert_media(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             await query.edit_message_text(text=message_text) # Fallback
         return
 
-    temp_source_for_conversion = ""
+    async with scheduler.job(query.from_user.id, on_wait=_queue_notifier(query.message, "processing")):
+        with artifact_store.lease(artifact_id):
+            await _convert_media_job(query, action, artifact_id, original_filepath, prepared_filepath)
+
+async def _convert_on_demand(edit_target_message, action: str, source_filepath: str) -> tuple[str, int]:
+    chat_id = edit_target_message.chat_id
+    converting_message_text = f"⏳ Converting {os.path.basename(source_filepath)} to {action.upper()}..."
+    if hasattr(edit_target_message, 'caption') and edit_target_message.caption is not None:
+        await edit_target_message.edit_caption(caption=converting_message_text, reply_markup=edit_target_message.reply_markup)
+    else:
+        await edit_target_message.edit_text(text=converting_message_text, reply_markup=edit_target_message.reply_markup)
+    logger.info(f"Message edited to 'Converting...' for {os.path.basename(source_filepath)}")
+
+    on_progress = None
+    if edit_target_message.text is not None:
+        # Media messages can only have their caption edited; the dispatcher only edits text.
+        on_progress = _make_encode_progress(chat_id, edit_target_message.message_id, f"Converting to {action.upper()}")
+    return await scheduler.transcode.run(
+        chat_id, _blocking_convert_media, source_filepath, action, on_progress,
+        on_wait=_queue_notifier(edit_target_message, "conversion"),
+    )
+
+async def _convert_media_job(query, action: str, artifact_id: str, original_filepath: str | None, prepared_filepath: str | None = None) -> None:
+    chat_id = query.message.chat_id
     converted_filepath = ""
     converted_file_size_mb = 0 
     final_text = "An error occurred during conversion processing."
     edit_target_message = query.message
 
     try:
-        base, ext = os.path.splitext(os.path.basename(original_filepath_from_botdata))
-        temp_source_for_conversion = os.path.join(DOWNLOAD_DIR, f"{base}_{uuid.uuid4()}_tempcopy{ext}")
-        shutil.copy(original_filepath_from_botdata, temp_source_for_conversion)
-        logger.info(f"Created temporary copy for conversion: {temp_source_for_conversion}")
-        
-        converting_message_text = f"⏳ Converting {os.path.basename(original_filepath_from_botdata)} to {action.upper()}..."
-        if hasattr(edit_target_message, 'caption') and edit_target_message.caption is not None:
-            await edit_target_message.edit_caption(caption=converting_message_text, reply_markup=edit_target_message.reply_markup)
+        if prepared_filepath:
+            converted_filepath = prepared_filepath
+            converted_file_size = os.path.getsize(converted_filepath)
+            logger.info(f"Using prepared {action} variant: {converted_filepath}")
         else:
-            await edit_target_message.edit_text(text=converting_message_text, reply_markup=edit_target_message.reply_markup)
-        logger.info(f"Message edited to 'Converting...' for {os.path.basename(original_filepath_from_botdata)}")
-
-        converted_filepath, converted_file_size = await asyncio.get_running_loop().run_in_executor(
-            executor, _blocking_convert_media, temp_source_for_conversion, action
-        )
+            converted_filepath, converted_file_size = await _convert_on_demand(edit_target_message, action, original_filepath)
+            # Kept next to the original so the next press of the same button is answered without converting.
+            artifact_store.register(converted_filepath, f"conversion:{action}", query.from_user.id, parent_id=artifact_id)
         logger.info(f"Finished blocking conversion. Converted file: {converted_filepath}, Size: {converted_file_size}")
         converted_file_size_mb = converted_file_size / (1024 * 1024)
 
         if converted_file_size_mb > LOCAL_SAVE_LIMIT_MB:
-            final_text = (
-                f"⚠️ Converted file size ({converted_file_size_mb:.2f} MB) exceeds upload limit.\n"
-                f"File saved to local storage: {os.path.basename(converted_filepath)} (Note: This path is on the server)"
-            )
-            logger.info(f"Converted file saved locally: {converted_filepath}")
+            final_text = f"⚠️ {await _deliver_oversized(edit_target_message, converted_filepath, converted_file_size_mb)}"
+            logger.info(f"Converted file too large for Telegram: {converted_filepath}")
         else:
             logger.info(f"Attempting to send converted document: {converted_filepath}")
             try:
-                await query.message.reply_document(document=InputFile(open(converted_filepath, 'rb'), filename=os.path.basename(converted_filepath)))
+                async with scheduler.upload.slot(chat_id, on_wait=_queue_notifier(edit_target_message, "upload")):
+                    with open(converted_filepath, 'rb') as f:
+                        await query.message.reply_document(document=InputFile(f, filename=os.path.basename(converted_filepath)))
                 logger.info(f"Converted document sent successfully: {converted_filepath}")
                 final_text = f"✅ Conversion to {action.upper()} complete! New file sent."
             except Exception as upload_e:
                 logger.error(f"Error uploading converted document {converted_filepath}: {upload_e}", exc_info=True)
                 final_text = f"❌ Failed to upload converted file. Error: {upload_e}"
-        
+
+        # Progress edits still queued or in flight must not land on top of the result.
+        await progress_dispatcher.forget(chat_id, edit_target_message.message_id)
         if hasattr(edit_target_message, 'caption') and edit_target_message.caption is not None:
             await edit_target_message.edit_caption(caption=final_text, reply_markup=edit_target_message.reply_markup)
         else:
@@ -326,6 +1118,7 @@ async def convert_media(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
              error_text = f"❌ Error during conversion: A file was not found."
         
         try:
+            await progress_dispatcher.forget(chat_id, edit_target_message.message_id)
             if hasattr(edit_target_message, 'caption') and edit_target_message.caption is not None:
                 await edit_target_message.edit_caption(caption=error_text, reply_markup=edit_target_message.reply_markup)
             else:
@@ -333,17 +1126,88 @@ async def convert_media(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         except Exception as e_report:
             logger.error(f"Failed to report conversion error to user: {e_report}")
     finally:
-        if converted_filepath and os.path.exists(converted_filepath):
-            if not (converted_file_size_mb > LOCAL_SAVE_LIMIT_MB and final_text.startswith("⚠️")):
-                 os.remove(converted_filepath)
-                 logger.info(f"Cleaned up converted file: {converted_filepath}")
-        if temp_source_for_conversion and os.path.exists(temp_source_for_conversion):
-            os.remove(temp_source_for_conversion)
-            logger.info(f"Cleaned up temporary source copy: {temp_source_for_conversion}")
+        await progress_dispatcher.forget(chat_id, edit_target_message.message_id)
 
-def main() -> None:
-    logger.info(">>>> MAIN FUNCTION STARTED <<<<")
-    logger.info(f"Current working directory: {os.getcwd()}")
+async def _sweep_storage() -> None:
+    while True:
+        await asyncio.sleep(STORAGE_SWEEP_SECONDS)
+        try:
+            freed = await asyncio.get_running_loop().run_in_executor(executor, artifact_store.enforce)
+            if freed:
+                logger.info(f"Storage sweep freed {yt_dlp.utils.format_bytes(freed)}: {artifact_store.stats()}")
+        except Exception as e_sweep:
+            logger.error(f"Storage sweep failed: {e_sweep}", exc_info=True)
+
+def _collect_metrics() -> None:
+    # Copies state the other components keep for themselves into the metrics registry before a scrape.
+    for pool, stats in scheduler.stats().items():
+        if isinstance(stats, dict):
+            metrics.POOL_QUEUED.set(stats['queued'], pool=pool)
+            metrics.POOL_ACTIVE.set(stats['active'], pool=pool)
+            metrics.POOL_SIZE.set(stats['size'], pool=pool)
+    cache = media_cache.stats()
+    for outcome in ("file_id_hits", "local_hits", "misses"):
+        metrics.CACHE_EVENTS.set(cache[outcome], cache="media", outcome=outcome)
+    metrics.CACHE_HIT_RATIO.set(cache['hit_rate'], cache="media")
+    metrics.CACHE_EVENTS.set(metadata_cache.hits, cache="metadata", outcome="hits")
+    metrics.CACHE_EVENTS.set(metadata_cache.misses, cache="metadata", outcome="misses")
+    lookups = metadata_cache.hits + metadata_cache.misses
+    metrics.CACHE_HIT_RATIO.set(metadata_cache.hits / lookups if lookups else 0.0, cache="metadata")
+    if progress_dispatcher:
+        dispatcher = progress_dispatcher.stats()
+        for outcome in ("sent", "coalesced", "unchanged", "rate_limited"):
+            metrics.PROGRESS_EDITS.set(dispatcher[outcome], outcome=outcome)
+    for kind, size in artifact_store.stats()['bytes_by_kind'].items():
+        metrics.STORAGE_BYTES.set(size, kind=kind)
+
+async def start_services(bot, metrics_port: int = METRICS_PORT) -> None:
+    # Everything the handlers need that lives on the event loop. Used by post_init and by worker.py.
+    global progress_dispatcher, storage_sweeper, gofile_uploader, metrics_server
+    progress_dispatcher = ProgressDispatcher(bot)
+    progress_dispatcher.start()
+    storage_sweeper = asyncio.create_task(_sweep_storage())
+    if GOFILE_UPLOAD:
+        gofile_uploader = GofileUploader(GOFILE_TOKEN, max_concurrent=GOFILE_CONCURRENT_UPLOADS)
+    if metrics_port:
+        metrics.add_collector(_collect_metrics)
+        metrics_server = metrics.serve(METRICS_HOST, metrics_port, asyncio.get_running_loop())
+    metrics.startup_milestone("serving")
+
+async def stop_services() -> None:
+    await progress_dispatcher.stop()
+    logger.info(f"Progress dispatcher stats: {progress_dispatcher.stats()}")
+    storage_sweeper.cancel()
+    logger.info(f"Storage stats: {artifact_store.stats()}")
+    if gofile_uploader:
+        await gofile_uploader.close()
+        logger.info(f"gofile uploader stats: {gofile_uploader.stats()}")
+    if metrics_server:
+        metrics_server.shutdown()
+    logger.info(f"yt-dlp pool stats: {ytdl_pool.stats()}")
+    ytdl_pool.close()
+
+async def post_init(application: Application) -> None:
+    await start_services(application.bot)
+
+async def post_shutdown(application: Application) -> None:
+    await stop_services()
+
+def _warm_up_ytdl() -> None:
+    # Imports yt-dlp, builds the pooled instances and compiles every extractor's URL pattern (identify_url's
+    # first call) while the Telegram side starts up, instead of during the first request.
+    started = time.monotonic()
+    try:
+        ytdl_pool.warm_up()
+        identify_url("https://example.com/")
+    except Exception as e_warm:
+        logger.warning(f"yt-dlp warm-up failed, instances will be built on demand: {e_warm}", exc_info=True)
+        return
+    metrics.startup_milestone("ytdl_ready")
+    logger.info(f"yt-dlp warmed up in {time.monotonic() - started:.2f}s: {ytdl_pool.stats()}")
+
+def init_runtime(keep_paths: tuple[str, ...] = (), orphan_min_age_seconds: float = 0) -> None:
+    # Storage, cache and scheduler setup shared by main() and worker.py. Workers share DOWNLOAD_DIR with each
+    # other, so they pass orphan_min_age_seconds to leave files of jobs still running elsewhere alone.
     download_dir_absolute_path = os.path.abspath(DOWNLOAD_DIR)
     logger.info(f"Download directory target (relative): {DOWNLOAD_DIR}")
     logger.info(f"Attempting to ensure download directory exists at absolute path: {download_dir_absolute_path}")
@@ -361,9 +1225,58 @@ def main() -> None:
     except Exception as e_makedirs:
         logger.error(f"CRITICAL FAILURE: Error during os.makedirs for '{DOWNLOAD_DIR}': {e_makedirs}", exc_info=True)
 
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).concurrent_updates(1).build()
+    global artifact_store
+    artifact_store = ArtifactStore(STORAGE_DB_PATH, DOWNLOAD_DIR, STORAGE_QUOTA_MB * 1024 * 1024, STORAGE_TTL_HOURS * 3600)
+    # Anything untracked (and old enough) is a leftover from a crash or an older version.
+    # The media cache manages its own directory.
+    orphans = artifact_store.cleanup_orphans(
+        keep_paths=(STORAGE_DB_PATH, CACHE_DB_PATH, CACHE_DIR, YTDL_CACHE_DIR) + keep_paths, min_age_seconds=orphan_min_age_seconds
+    )
+    artifact_store.retag(CACHE_DIR, CACHED_KIND)
+    freed = artifact_store.enforce()
+    logger.info(f"Artifact store ready at {STORAGE_DB_PATH}: removed {orphans} orphaned files, freed {freed} bytes, {artifact_store.stats()}")
+
+    global ytdl_pool
+    # One instance per download slot; the streaming path and overflow get extra instances when needed.
+    ytdl_pool = YoutubeDLPool(_ydl_params(), DOWNLOAD_WORKERS, COOKIES_FILE)
+    threading.Thread(target=_warm_up_ytdl, name="ytdl-warmup", daemon=True).start()
+
+    global media_cache
+    # Cached files being uploaded or converted (by any worker) are leased in the artifact store.
+    media_cache = MediaCache(CACHE_DB_PATH, CACHE_DIR, CACHE_MAX_MB * 1024 * 1024, in_use=artifact_store.is_leased)
+    logger.info(f"Media cache ready at {CACHE_DB_PATH}: {media_cache.stats()}")
+
+    global scheduler
+    scheduler = JobScheduler(DOWNLOAD_WORKERS, TRANSCODE_WORKERS, UPLOAD_WORKERS, PER_USER_JOBS)
+    logger.info(f"Scheduler pools: download={DOWNLOAD_WORKERS} transcode={TRANSCODE_WORKERS} upload={UPLOAD_WORKERS}, per-user cap {PER_USER_JOBS}")
+    if FFMPEG_CPU_BUDGET or FFMPEG_ADAPTIVE_PRESETS:
+        ffmpeg_runner.configure(
+            ENCODE_CORES, lambda: (scheduler.transcode.active, scheduler.transcode.queued, scheduler.transcode.size),
+            share_threads=FFMPEG_CPU_BUDGET, adaptive_presets=FFMPEG_ADAPTIVE_PRESETS,
+        )
+        logger.info(
+            f"ffmpeg thread budget: {f'{ENCODE_CORES} cores shared by up to {TRANSCODE_WORKERS} encodes' if FFMPEG_CPU_BUDGET else 'off'}, "
+            f"x264 presets {'adaptive' if FFMPEG_ADAPTIVE_PRESETS else 'fixed'}"
+        )
+
+def main() -> None:
+    logger.info(">>>> MAIN FUNCTION STARTED <<<<")
+    logger.info(f"Current working directory: {os.getcwd()}")
+    init_runtime()
+
+    # Updates are handled concurrently; the scheduler pools are what bound the actual work.
+    application = (
+        Application.builder().token(TELEGRAM_BOT_TOKEN).concurrent_updates(CONCURRENT_UPDATES)
+        .request(metrics.MetricsRequest(connection_pool_size=256)) # Same pool size the builder would pick
+        .post_init(post_init).post_shutdown(post_shutdown).build()
+    )
 
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("cachestats", cache_stats))
+    application.add_handler(CommandHandler("queuestats", queue_stats))
+    application.add_handler(CommandHandler("storagestats", storage_stats))
+    application.add_handler(CommandHandler("mp3", handle_mp3_command))
+    application.add_handler(CommandHandler("cancel", cancel_command))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_url_message))
     application.add_handler(CallbackQueryHandler(convert_media))
 
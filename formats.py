@@ -0,0 +1,184 @@
+import copy
+import logging
+import threading
+import time
+from dataclasses import dataclass
+
+from transcode import MAX_COPY_AUDIO_KBPS, MAX_SHORT_SIDE, MAX_WIDTH
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FORMAT = "bestvideo+bestaudio/best"
+MP3_TARGET_KBPS = 128
+
+# Formats whose codecs the transcode planner can pass through without a re-encode.
+NO_REENCODE_VIDEO_PREFIXES = ("avc1", "avc3", "h264")
+NO_REENCODE_AUDIO_PREFIXES = ("mp4a", "aac")
+
+
+@dataclass
+class FormatChoice:
+    spec: str
+    expected_bytes: int | None
+    reencode_free: bool
+    reason: str
+
+
+class MetadataCache:
+    # yt-dlp info dicts keyed by URL. Entries expire before the signed media URLs inside them do.
+    def __init__(self, ttl: float, max_entries: int = 256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: dict[str, tuple[float, dict]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url: str) -> dict | None:
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(url, None)
+                self.misses += 1
+                return None
+            self.hits += 1
+            # Processing an info dict mutates it; hand out copies.
+            return copy.deepcopy(entry[1])
+
+    def put(self, url: str, info: dict) -> None:
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                now = time.monotonic()
+                self._entries = {k: v for k, v in self._entries.items() if v[0] >= now}
+                while len(self._entries) >= self.max_entries:
+                    self._entries.pop(next(iter(self._entries)))
+            self._entries[url] = (time.monotonic() + self.ttl, copy.deepcopy(info))
+
+
+def _has(codec: str | None) -> bool:
+    return codec != "none"
+
+
+def _codec_is(codec: str | None, prefixes: tuple[str, ...]) -> bool:
+    return (codec or "").lower().startswith(prefixes)
+
+
+def estimate_size(fmt: dict, duration: float | None) -> int | None:
+    size = fmt.get("filesize") or fmt.get("filesize_approx")
+    if size:
+        return int(size)
+    if fmt.get("tbr") and duration:
+        return int(fmt["tbr"] * 1000 / 8 * duration)
+    return None
+
+
+def _short_side(fmt: dict) -> int | None:
+    sides = [side for side in (fmt.get("width"), fmt.get("height")) if side]
+    return min(sides) if sides else None
+
+
+def _long_side(fmt: dict) -> int | None:
+    sides = [side for side in (fmt.get("width"), fmt.get("height")) if side]
+    return max(sides) if sides else None
+
+
+def _usable(fmt: dict) -> bool:
+    return (
+        bool(fmt.get("url") or fmt.get("fragments"))
+        and not fmt.get("has_drm")
+        and fmt.get("protocol") != "mhtml" # storyboards
+    )
+
+
+def _pick_pairing_audio(audios: list[dict]) -> dict | None:
+    # Prefer AAC that the planner can copy, at the best bitrate that is still worth copying.
+    if not audios:
+        return None
+    aac = [a for a in audios if _codec_is(a.get("acodec"), NO_REENCODE_AUDIO_PREFIXES)]
+    pool = aac or audios
+    copyable = [a for a in pool if (a.get("abr") or 0) <= MAX_COPY_AUDIO_KBPS]
+    if copyable:
+        return max(copyable, key=lambda a: a.get("abr") or 0)
+    return min(pool, key=lambda a: a.get("abr") or 0)
+
+
+def select_format(info: dict, max_bytes: int) -> FormatChoice | None:
+    formats = [f for f in info.get("formats") or [] if _usable(f)]
+    if not formats:
+        return None
+    duration = info.get("duration")
+    videos = [f for f in formats if _has(f.get("vcodec"))]
+    audios = [f for f in formats if not _has(f.get("vcodec")) and _has(f.get("acodec"))]
+    audio = _pick_pairing_audio(audios)
+
+    candidates = []
+    for video in videos:
+        if _has(video.get("acodec")):
+            parts = [video]
+        elif audio:
+            parts = [video, audio]
+        else:
+            continue
+        sizes = [estimate_size(part, duration) for part in parts]
+        size = sum(sizes) if None not in sizes else None
+        long_side = _long_side(video)
+        reencode_free = (
+            _codec_is(video.get("vcodec"), NO_REENCODE_VIDEO_PREFIXES)
+            and all(_codec_is(part.get("acodec"), NO_REENCODE_AUDIO_PREFIXES) for part in parts if _has(part.get("acodec")))
+            and long_side is not None and long_side <= MAX_WIDTH
+            and size is not None and size <= max_bytes
+        )
+        candidates.append((parts, size, reencode_free))
+    if not candidates:
+        return None
+
+    # Smallest download that still reaches the output resolution (or the best the site has, if lower).
+    available_sides = [_short_side(parts[0]) for parts, _, _ in candidates if _short_side(parts[0])]
+    target_side = min(MAX_SHORT_SIDE, max(available_sides)) if available_sides else None
+
+    def rank(candidate):
+        parts, size, reencode_free = candidate
+        short_side = _short_side(parts[0])
+        meets_target = target_side is None or (short_side is not None and short_side >= target_side)
+        return (
+            not meets_target,
+            not reencode_free,
+            size if size is not None else float("inf"),
+            short_side if short_side is not None else float("inf"),
+        )
+
+    parts, size, reencode_free = min(candidates, key=rank)
+    spec = "+".join(part["format_id"] for part in parts)
+    video = parts[0]
+    reason = f"{video.get('resolution') or 'unknown resolution'} {video.get('vcodec') or 'unknown codec'}"
+    if len(parts) > 1:
+        reason += f" + {parts[1].get('acodec')}"
+    return FormatChoice(f"{spec}/{DEFAULT_FORMAT}", size, reencode_free, reason)
+
+
+def select_audio_format(info: dict) -> FormatChoice | None:
+    formats = [f for f in info.get("formats") or [] if _usable(f)]
+    duration = info.get("duration")
+    audios = [f for f in formats if not _has(f.get("vcodec")) and _has(f.get("acodec"))]
+    if not audios:
+        # No separate audio streams: take the smallest muxed format and extract from it.
+        muxed = [f for f in formats if _has(f.get("acodec"))]
+        if not muxed:
+            return None
+        choice = min(muxed, key=lambda f: estimate_size(f, duration) or float("inf"))
+        return FormatChoice(f"{choice['format_id']}/bestaudio/best", estimate_size(choice, duration), False, "smallest muxed format")
+    mp3 = [a for a in audios if _codec_is(a.get("acodec"), ("mp3",))]
+    if mp3:
+        choice = max(mp3, key=lambda a: a.get("abr") or 0)
+        return FormatChoice(f"{choice['format_id']}/bestaudio/best", estimate_size(choice, duration), True, "MP3 stream, copied as-is")
+    # Lowest bitrate that still carries what a 128k MP3 can hold.
+    enough = [a for a in audios if (a.get("abr") or 0) >= MP3_TARGET_KBPS]
+    choice = min(enough, key=lambda a: a.get("abr") or 0) if enough else max(audios, key=lambda a: a.get("abr") or 0)
+    return FormatChoice(f"{choice['format_id']}/bestaudio/best", estimate_size(choice, duration), False, f"{choice.get('acodec')} {choice.get('abr')}k")
+
+
+def default_selection_bytes(info: dict) -> int | None:
+    # Size of what DEFAULT_FORMAT picked when the info was extracted, for before/after logging.
+    parts = info.get("requested_formats") or [info]
+    sizes = [estimate_size(part, info.get("duration")) for part in parts]
+    return sum(sizes) if None not in sizes else None
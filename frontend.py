@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import os
+
+from telegram import Update # type: ignore
+from telegram.error import BadRequest # type: ignore
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, ContextTypes, MessageHandler, filters # type: ignore
+
+from jobqueue import open_queue
+
+# The receiving half of worker mode: takes updates by long polling or webhook and puts them on the job queue
+# for worker.py. Imports neither yt-dlp nor the media pipeline, so it starts in a moment and stays responsive
+# however busy the workers are.
+
+logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "YOUR_FALLBACK_TOKEN_IF_ANY")
+JOB_QUEUE_URL = os.getenv("JOB_QUEUE_URL", "sqlite:///downloads/jobs.sqlite3")
+# Set WEBHOOK_URL (the public https URL Telegram should call) to receive updates by webhook instead of polling.
+# Needs python-telegram-bot[webhooks].
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8443")))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+job_queue = None
+
+
+async def _enqueue(kind: str, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    payload = {"update": update.to_dict(), "args": context.args or []}
+    job_id, ahead = await asyncio.to_thread(job_queue.enqueue, kind, payload, update.effective_chat.id)
+    logger.info(f"Queued {kind} job {job_id} for chat {update.effective_chat.id}, {ahead} ahead")
+    return ahead
+
+
+def _enqueuing(kind: str):
+    async def handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        ahead = await _enqueue(kind, update, context)
+        if ahead and update.message:
+            await update.message.reply_text(f"⏳ Queued: {ahead} requests ahead of yours.")
+    return handler
+
+
+async def enqueue_conversion(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Answered here so the button stops spinning right away, not when a worker gets to it.
+    query = update.callback_query
+    ahead = await _enqueue("convert", update, context)
+    try:
+        await query.answer(f"Queued: {ahead} requests ahead of yours." if ahead else None)
+    except BadRequest as e_answer:
+        logger.info(f"Callback query not answered: {e_answer}")
+
+
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Queued jobs are dropped here; running ones are stopped by their worker at its next heartbeat.
+    cancelled = await asyncio.to_thread(job_queue.cancel, update.effective_chat.id)
+    await update.message.reply_text(f"Cancelled {cancelled} requests." if cancelled else "Nothing to cancel.")
+
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    await update.message.reply_html(
+        f"Hi {user.mention_html()}! I'm your media downloader bot. Send me a link to download!",
+    )
+
+
+async def job_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    stats = await asyncio.to_thread(job_queue.stats)
+    await update.message.reply_text(
+        f"Jobs queued: {stats['queued']}, running: {stats['running']}\n"
+        f"Finished: {stats['done']}, failed: {stats['failed']}, cancelled: {stats['cancelled']}\n"
+        f"Oldest queued job waiting: {stats['oldest_queued_seconds']:.0f}s"
+    )
+
+
+def main() -> None:
+    global job_queue
+    job_queue = open_queue(JOB_QUEUE_URL)
+    logger.info(f"Job queue ready at {JOB_QUEUE_URL}: {job_queue.stats()}")
+
+    application = Application.builder().token(TELEGRAM_BOT_TOKEN).concurrent_updates(True).build()
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("jobstats", job_stats))
+    application.add_handler(CommandHandler("cancel", cancel))
+    for command in ("cachestats", "queuestats", "storagestats", "mp3"):
+        application.add_handler(CommandHandler(command, _enqueuing(command)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, _enqueuing("url")))
+    application.add_handler(CallbackQueryHandler(enqueue_conversion))
+
+    if WEBHOOK_URL:
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES, drop_pending_updates=True,
+        )
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,21 @@
-import requests
+import asyncio
 import json
+import logging
+import os
+import random
+import time
+import uuid
+
+import httpx
+import requests
+
+logger = logging.getLogger(__name__)
+
+API_URL = "https://api.gofile.io"
+UPLOAD_URL = "https://{server}.gofile.io/contents/uploadfile"
+SERVER_TTL = 600
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+RETRY_STATUSES = {429, 500, 502, 503, 504}
 
 def getServer():
     try:
@@ -27,17 +43,186 @@ def uploadFile(file: str, token: str = None, folderId: str = None, description:
         "expire": expire
     }
 
-    _file = {
-        "file": open(file, "rb")
-    }
-
-    response = requests.post(
-        url=f"https://{server}.gofile.io/uploadFile",
-        data=_data,
-        files=_file
-    ).json()
+    with open(file, "rb") as f:
+        response = requests.post(
+            url=f"https://{server}.gofile.io/uploadFile",
+            data=_data,
+            files={"file": f}
+        ).json()
 
     if response.get("status") == "ok":
         return response["data"]
     else:
         raise Exception(f"Failed to upload file: {response}")
+
+
+class GofileError(Exception):
+    pass
+
+
+class _RetryableError(GofileError):
+    pass
+
+
+class GofileUploader:
+    # One pooled client for every upload. The upload server is looked up once and reused for server_ttl
+    # seconds (or until an upload to it fails), and file bodies are streamed from disk chunk by chunk.
+    # gofile has no ranged/resumable uploads, so a retry sends the file again from the start, to a freshly
+    # selected server after a failure.
+
+    def __init__(
+        self,
+        token: str | None = None,
+        api_url: str = API_URL,
+        upload_url: str = UPLOAD_URL,
+        max_concurrent: int = 2,
+        retries: int = 3,
+        backoff: float = 2.0,
+        server_ttl: float = SERVER_TTL,
+        chunk_size: int = UPLOAD_CHUNK_SIZE,
+    ):
+        self.token = token
+        self.api_url = api_url.rstrip("/")
+        self.upload_url = upload_url
+        self.retries = retries
+        self.backoff = backoff
+        self.server_ttl = server_ttl
+        self.chunk_size = chunk_size
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(30.0, read=600.0, write=600.0),
+            limits=httpx.Limits(max_connections=max_concurrent + 2, max_keepalive_connections=max_concurrent + 2),
+            headers={"Authorization": f"Bearer {token}"} if token else None,
+        )
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._server: str | None = None
+        self._server_expires = 0.0
+        self._server_lock = asyncio.Lock()
+        self.uploaded = 0
+        self.uploaded_bytes = 0
+        self.retried = 0
+        self.failed = 0
+        self.server_lookups = 0
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+    async def get_server(self) -> str:
+        async with self._server_lock:
+            if self._server and time.monotonic() < self._server_expires:
+                return self._server
+            self.server_lookups += 1
+            try:
+                response = await self._client.get(f"{self.api_url}/servers")
+            except httpx.TransportError as e_server:
+                raise _RetryableError(f"Server lookup failed: {e_server}") from e_server
+            if response.status_code in RETRY_STATUSES:
+                raise _RetryableError(f"Server lookup failed with HTTP {response.status_code}")
+            try:
+                payload = response.json()
+            except ValueError:
+                raise _RetryableError(f"Server lookup returned invalid JSON (HTTP {response.status_code})")
+            if payload.get("status") != "ok":
+                raise GofileError(f"Failed to get a server: {payload}")
+            data = payload.get("data") or {}
+            # The older getServer endpoint returned a single name, /servers returns a list.
+            servers = [s["name"] for s in data.get("servers") or [] if s.get("name")]
+            server = random.choice(servers) if servers else data.get("server")
+            if not server:
+                raise GofileError(f"No upload server in response: {payload}")
+            self._server = server
+            self._server_expires = time.monotonic() + self.server_ttl
+            return server
+
+    def _forget_server(self, server: str) -> None:
+        if self._server == server:
+            self._server = None
+
+    async def _body(self, f, preamble: bytes, epilogue: bytes, on_progress):
+        yield preamble
+        sent = 0
+        while chunk := await asyncio.to_thread(f.read, self.chunk_size):
+            yield chunk
+            sent += len(chunk)
+            if on_progress:
+                on_progress(sent)
+        yield epilogue
+
+    async def _upload_once(self, filepath: str, filename: str, size: int, fields: dict, on_progress) -> dict:
+        server = await self.get_server()
+        boundary = uuid.uuid4().hex
+        preamble = b"".join(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+            for name, value in fields.items()
+        )
+        quoted_filename = filename.replace('"', "%22")
+        preamble += (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{quoted_filename}"\r\n'
+            f"Content-Type: application/octet-stream\r\n\r\n"
+        ).encode()
+        epilogue = f"\r\n--{boundary}--\r\n".encode()
+        headers = {
+            "Content-Type": f"multipart/form-data; boundary={boundary}",
+            "Content-Length": str(len(preamble) + size + len(epilogue)),
+        }
+        try:
+            with open(filepath, "rb") as f:
+                response = await self._client.post(
+                    self.upload_url.format(server=server),
+                    content=self._body(f, preamble, epilogue, on_progress),
+                    headers=headers,
+                )
+        except httpx.TransportError as e_upload:
+            self._forget_server(server)
+            raise _RetryableError(f"Upload to {server} failed: {e_upload}") from e_upload
+        if response.status_code in RETRY_STATUSES:
+            self._forget_server(server)
+            raise _RetryableError(f"Upload to {server} failed with HTTP {response.status_code}")
+        try:
+            payload = response.json()
+        except ValueError:
+            self._forget_server(server)
+            raise _RetryableError(f"Upload to {server} returned invalid JSON (HTTP {response.status_code})")
+        if payload.get("status") != "ok":
+            raise GofileError(f"Failed to upload file: {payload}")
+        return payload["data"]
+
+    async def upload(self, filepath: str, folder_id: str | None = None, on_progress=None) -> dict:
+        # Returns gofile's data dict (downloadPage, fileId, ...). on_progress(sent_bytes, total_bytes) is called
+        # on the event loop after every chunk.
+        size = os.path.getsize(filepath)
+        filename = os.path.basename(filepath)
+        fields = {"folderId": folder_id} if folder_id else {}
+        report = (lambda sent: on_progress(sent, size)) if on_progress else None
+        async with self._slots:
+            for attempt in range(self.retries + 1):
+                try:
+                    data = await self._upload_once(filepath, filename, size, fields, report)
+                except _RetryableError as e_retry:
+                    if attempt == self.retries:
+                        self.failed += 1
+                        raise GofileError(f"Giving up on {filename} after {attempt + 1} attempts: {e_retry}") from e_retry
+                    delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                    self.retried += 1
+                    logger.warning(f"gofile upload of {filename} failed ({e_retry}), retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+                    continue
+                except GofileError:
+                    self.failed += 1
+                    raise
+                self.uploaded += 1
+                self.uploaded_bytes += size
+                logger.info(f"Uploaded {filename} ({size} bytes) to gofile: {data.get('downloadPage')}")
+                return data
+
+    async def upload_many(self, filepaths: list[str], folder_id: str | None = None) -> list[dict | BaseException]:
+        # Runs up to max_concurrent uploads at a time; failures are returned in place of their result.
+        return await asyncio.gather(*(self.upload(path, folder_id) for path in filepaths), return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "uploaded": self.uploaded,
+            "uploaded_bytes": self.uploaded_bytes,
+            "retried": self.retried,
+            "failed": self.failed,
+            "server_lookups": self.server_lookups,
+        }
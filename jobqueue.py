@@ -0,0 +1,396 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+# A durable queue between the front end (which receives updates) and the worker processes (which run them).
+# A claimed job carries a lease that its worker keeps extending. If the worker dies, the lease runs out and the
+# job goes back to the queue, until it has been attempted max_attempts times. Jobs a draining worker could not
+# finish are released without counting as an attempt. cancel() drops a chat's queued jobs and flags its running
+# ones; workers learn about the flag from their next heartbeat.
+
+MAX_ATTEMPTS = 3
+DONE_RETENTION_SECONDS = 24 * 3600
+
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    payload: dict
+    chat_id: int | None
+    attempts: int
+
+
+class SQLiteJobQueue:
+    # For any number of processes on one host (WAL mode needs shared memory, so not over a network filesystem).
+    # Claims take the write lock with BEGIN IMMEDIATE, so a job is handed to one worker only.
+
+    def __init__(self, db_path: str, max_attempts: int = MAX_ATTEMPTS):
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._lock:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY, kind TEXT NOT NULL, payload TEXT NOT NULL, chat_id INTEGER,"
+                " status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, worker_id TEXT, lease_expires REAL,"
+                " created REAL NOT NULL, started REAL, finished REAL, error TEXT)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+
+    def _transaction(self, fn):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn()
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    def enqueue(self, kind: str, payload: dict, chat_id: int | None = None) -> tuple[str, int]:
+        # Returns the job id and the number of queued jobs ahead of it.
+        job_id = uuid.uuid4().hex
+
+        def insert():
+            ahead = self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            self._conn.execute(
+                "INSERT INTO jobs (id, kind, payload, chat_id, status, created) VALUES (?, ?, ?, ?, 'queued', ?)",
+                (job_id, kind, json.dumps(payload), chat_id, time.time()),
+            )
+            return ahead
+
+        return job_id, self._transaction(insert)
+
+    def claim(self, worker_id: str, lease_seconds: float) -> Job | None:
+        def take():
+            row = self._conn.execute(
+                "SELECT id, kind, payload, chat_id, attempts FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1"
+            ).fetchone()
+            if not row:
+                return None
+            now = time.time()
+            self._conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, worker_id = ?, lease_expires = ?, started = ?"
+                " WHERE id = ?",
+                (worker_id, now + lease_seconds, now, row[0]),
+            )
+            return Job(row[0], row[1], json.loads(row[2]), row[3], row[4] + 1)
+
+        return self._transaction(take)
+
+    def heartbeat(self, worker_id: str, job_ids: list[str], lease_seconds: float) -> list[str]:
+        # Extends the leases of the worker's running jobs. Returns the ones that have been cancelled.
+        if not job_ids:
+            return []
+        expires = time.time() + lease_seconds
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE jobs SET lease_expires = ? WHERE id = ? AND worker_id = ? AND status IN ('running', 'cancelling')",
+                [(expires, job_id, worker_id) for job_id in job_ids],
+            )
+            rows = self._conn.execute("SELECT id FROM jobs WHERE worker_id = ? AND status = 'cancelling'", (worker_id,)).fetchall()
+        return [row[0] for row in rows if row[0] in job_ids]
+
+    def cancel(self, chat_id: int) -> int:
+        # Returns the number of jobs cancelled or flagged for cancellation.
+        def flag():
+            now = time.time()
+            dropped = self._conn.execute(
+                "UPDATE jobs SET status = 'cancelled', finished = ? WHERE chat_id = ? AND status = 'queued'", (now, chat_id)
+            ).rowcount
+            flagged = self._conn.execute(
+                "UPDATE jobs SET status = 'cancelling' WHERE chat_id = ? AND status = 'running'", (chat_id,)
+            ).rowcount
+            return dropped + flagged
+
+        return self._transaction(flag)
+
+    def complete(self, job_id: str, worker_id: str) -> bool:
+        return self._finish(job_id, worker_id, "done", None)
+
+    def fail(self, job_id: str, worker_id: str, error: str) -> bool:
+        return self._finish(job_id, worker_id, "failed", error)
+
+    def mark_cancelled(self, job_id: str, worker_id: str) -> bool:
+        return self._finish(job_id, worker_id, "cancelled", None)
+
+    def _finish(self, job_id: str, worker_id: str, status: str, error: str | None) -> bool:
+        # Only the worker holding the lease may finish a job. Returns False if the lease ran out and the job was
+        # requeued (or given up) meanwhile; its outcome then belongs to whoever has it now.
+        with self._lock:
+            finished = self._conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished = ?, lease_expires = NULL"
+                " WHERE id = ? AND worker_id = ? AND status IN ('running', 'cancelling')",
+                (status, error, time.time(), job_id, worker_id),
+            ).rowcount
+        if not finished:
+            logger.warning(f"Job {job_id} is no longer leased to worker {worker_id}, not marking it {status}")
+        return bool(finished)
+
+    def release(self, job_id: str, worker_id: str) -> None:
+        # Hands an unfinished job back without counting the attempt (the worker is shutting down).
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'queued', attempts = MAX(attempts - 1, 0), worker_id = NULL, lease_expires = NULL"
+                " WHERE id = ? AND worker_id = ? AND status = 'running'",
+                (job_id, worker_id),
+            )
+            self._conn.execute(
+                "UPDATE jobs SET status = 'cancelled', finished = ?, lease_expires = NULL"
+                " WHERE id = ? AND worker_id = ? AND status = 'cancelling'",
+                (time.time(), job_id, worker_id),
+            )
+
+    def requeue_expired(self) -> list[Job]:
+        # Puts jobs of dead workers back in the queue. Returns the ones that ran out of attempts and were failed.
+        def reap():
+            now = time.time()
+            rows = self._conn.execute(
+                "SELECT id, kind, payload, chat_id, attempts, worker_id FROM jobs WHERE status = 'running' AND lease_expires < ?",
+                (now,),
+            ).fetchall()
+            self._conn.execute(
+                "UPDATE jobs SET status = 'cancelled', finished = ?, lease_expires = NULL WHERE status = 'cancelling' AND lease_expires < ?",
+                (now, now),
+            )
+            given_up = []
+            for job_id, kind, payload, chat_id, attempts, worker_id in rows:
+                if attempts >= self.max_attempts:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'failed', error = ?, finished = ?, lease_expires = NULL WHERE id = ?",
+                        (f"worker {worker_id} stopped responding ({attempts} attempts)", now, job_id),
+                    )
+                    given_up.append(Job(job_id, kind, json.loads(payload), chat_id, attempts))
+                else:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'queued', worker_id = NULL, lease_expires = NULL WHERE id = ?", (job_id,)
+                    )
+                logger.warning(f"Job {job_id} ({kind}) lost its worker {worker_id} after attempt {attempts}")
+            self._conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed', 'cancelled') AND finished < ?", (now - DONE_RETENTION_SECONDS,)
+            )
+            return given_up
+
+        return self._transaction(reap)
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = dict(self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+            oldest = self._conn.execute("SELECT MIN(created) FROM jobs WHERE status = 'queued'").fetchone()[0]
+        return {
+            "queued": counts.get("queued", 0),
+            "running": counts.get("running", 0),
+            "done": counts.get("done", 0),
+            "failed": counts.get("failed", 0),
+            "cancelled": counts.get("cancelled", 0),
+            "oldest_queued_seconds": time.time() - oldest if oldest else 0.0,
+        }
+
+
+class RedisJobQueue:
+    # Same interface on a Redis-compatible server, for workers on hosts that share no filesystem. Needs the
+    # redis package. Queued ids live in a list, running ones in a sorted set scored by lease expiry, and each
+    # job in its own hash. Claiming, reaping and finishing are Lua scripts so they are atomic.
+
+    _CLAIM = """
+    local job_id = redis.call('RPOP', KEYS[1])
+    if not job_id then return nil end
+    local job_key = ARGV[3] .. job_id
+    redis.call('ZADD', KEYS[2], ARGV[2], job_id)
+    redis.call('HSET', job_key, 'status', 'running', 'worker_id', ARGV[1], 'started', ARGV[4])
+    redis.call('HINCRBY', job_key, 'attempts', 1)
+    return {job_id, redis.call('HGET', job_key, 'kind'), redis.call('HGET', job_key, 'payload'),
+            redis.call('HGET', job_key, 'chat_id') or '', redis.call('HGET', job_key, 'attempts')}
+    """
+
+    _REAP = """
+    local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+    local given_up = {}
+    for _, job_id in ipairs(expired) do
+        redis.call('ZREM', KEYS[2], job_id)
+        local job_key = ARGV[3] .. job_id
+        if redis.call('HGET', job_key, 'status') == 'cancelling' then
+            redis.call('HSET', job_key, 'status', 'cancelled', 'finished', ARGV[1])
+            redis.call('EXPIRE', job_key, ARGV[4])
+            redis.call('HINCRBY', KEYS[3], 'cancelled', 1)
+        elseif tonumber(redis.call('HGET', job_key, 'attempts') or '0') >= tonumber(ARGV[2]) then
+            redis.call('HSET', job_key, 'status', 'failed', 'finished', ARGV[1])
+            redis.call('EXPIRE', job_key, ARGV[4])
+            redis.call('HINCRBY', KEYS[3], 'failed', 1)
+            table.insert(given_up, job_id)
+        else
+            redis.call('HSET', job_key, 'status', 'queued')
+            redis.call('RPUSH', KEYS[1], job_id)
+        end
+    end
+    return given_up
+    """
+
+    _CANCEL = """
+    local count = 0
+    for _, job_id in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+        local job_key = ARGV[2] .. job_id
+        if redis.call('HGET', job_key, 'chat_id') == ARGV[1] then
+            redis.call('LREM', KEYS[1], 0, job_id)
+            redis.call('HSET', job_key, 'status', 'cancelled', 'finished', ARGV[3])
+            redis.call('EXPIRE', job_key, ARGV[4])
+            redis.call('HINCRBY', KEYS[3], 'cancelled', 1)
+            count = count + 1
+        end
+    end
+    for _, job_id in ipairs(redis.call('ZRANGE', KEYS[2], 0, -1)) do
+        local job_key = ARGV[2] .. job_id
+        if redis.call('HGET', job_key, 'chat_id') == ARGV[1] then
+            redis.call('HSET', job_key, 'status', 'cancelling')
+            count = count + 1
+        end
+    end
+    return count
+    """
+
+    _FINISH = """
+    local job_key = ARGV[1] .. ARGV[2]
+    local status = redis.call('HGET', job_key, 'status')
+    if redis.call('HGET', job_key, 'worker_id') ~= ARGV[3] or (status ~= 'running' and status ~= 'cancelling') then
+        return 0
+    end
+    redis.call('ZREM', KEYS[1], ARGV[2])
+    redis.call('HSET', job_key, 'status', ARGV[4], 'finished', ARGV[5], 'error', ARGV[6])
+    redis.call('EXPIRE', job_key, ARGV[7])
+    redis.call('HINCRBY', KEYS[2], ARGV[4], 1)
+    return 1
+    """
+
+    def __init__(self, url: str, prefix: str = "mediabot", max_attempts: int = MAX_ATTEMPTS):
+        import redis # type: ignore # Optional dependency, only needed for this backend
+        self.max_attempts = max_attempts
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self._queued = f"{prefix}:queued"
+        self._running = f"{prefix}:running"
+        self._counters = f"{prefix}:counters"
+        self._job_prefix = f"{prefix}:job:"
+        self._claim = self._redis.register_script(self._CLAIM)
+        self._reap = self._redis.register_script(self._REAP)
+        self._cancel = self._redis.register_script(self._CANCEL)
+        self._finish_script = self._redis.register_script(self._FINISH)
+
+    def enqueue(self, kind: str, payload: dict, chat_id: int | None = None) -> tuple[str, int]:
+        job_id = uuid.uuid4().hex
+        pipe = self._redis.pipeline()
+        pipe.hset(self._job_prefix + job_id, mapping={
+            "kind": kind, "payload": json.dumps(payload), "chat_id": "" if chat_id is None else str(chat_id),
+            "status": "queued", "attempts": 0, "created": time.time(),
+        })
+        pipe.lpush(self._queued, job_id)
+        ahead = pipe.execute()[1] - 1
+        return job_id, ahead
+
+    def claim(self, worker_id: str, lease_seconds: float) -> Job | None:
+        now = time.time()
+        row = self._claim(keys=[self._queued, self._running], args=[worker_id, now + lease_seconds, self._job_prefix, now])
+        if not row:
+            return None
+        job_id, kind, payload, chat_id, attempts = row
+        return Job(job_id, kind, json.loads(payload), int(chat_id) if chat_id else None, int(attempts))
+
+    def heartbeat(self, worker_id: str, job_ids: list[str], lease_seconds: float) -> list[str]:
+        if not job_ids:
+            return []
+        pipe = self._redis.pipeline()
+        # XX: only extend leases that still exist, a reaped job must not come back to life.
+        pipe.zadd(self._running, {job_id: time.time() + lease_seconds for job_id in job_ids}, xx=True)
+        for job_id in job_ids:
+            pipe.hget(self._job_prefix + job_id, "status")
+        statuses = pipe.execute()[1:]
+        return [job_id for job_id, status in zip(job_ids, statuses) if status == "cancelling"]
+
+    def cancel(self, chat_id: int) -> int:
+        return self._cancel(
+            keys=[self._queued, self._running, self._counters],
+            args=[str(chat_id), self._job_prefix, time.time(), DONE_RETENTION_SECONDS],
+        )
+
+    def complete(self, job_id: str, worker_id: str) -> bool:
+        return self._finish(job_id, worker_id, "done", None)
+
+    def fail(self, job_id: str, worker_id: str, error: str) -> bool:
+        return self._finish(job_id, worker_id, "failed", error)
+
+    def mark_cancelled(self, job_id: str, worker_id: str) -> bool:
+        return self._finish(job_id, worker_id, "cancelled", None)
+
+    def _finish(self, job_id: str, worker_id: str, status: str, error: str | None) -> bool:
+        finished = self._finish_script(
+            keys=[self._running, self._counters],
+            args=[self._job_prefix, job_id, worker_id, status, time.time(), error or "", DONE_RETENTION_SECONDS],
+        )
+        if not finished:
+            logger.warning(f"Job {job_id} is no longer leased to worker {worker_id}, not marking it {status}")
+        return bool(finished)
+
+    def release(self, job_id: str, worker_id: str) -> None:
+        job_key = self._job_prefix + job_id
+        if self._redis.hget(job_key, "worker_id") != worker_id:
+            return
+        if self._redis.hget(job_key, "status") == "cancelling":
+            self._finish(job_id, worker_id, "cancelled", None)
+        elif self._redis.zrem(self._running, job_id):
+            pipe = self._redis.pipeline()
+            pipe.hset(job_key, "status", "queued")
+            pipe.hincrby(job_key, "attempts", -1)
+            pipe.rpush(self._queued, job_id) # Front of the queue: claims pop from the right
+            pipe.execute()
+
+    def requeue_expired(self) -> list[Job]:
+        given_up = []
+        ids = self._reap(
+            keys=[self._queued, self._running, self._counters],
+            args=[time.time(), self.max_attempts, self._job_prefix, DONE_RETENTION_SECONDS],
+        )
+        for job_id in ids:
+            data = self._redis.hgetall(self._job_prefix + job_id)
+            logger.warning(f"Job {job_id} ({data.get('kind')}) lost its worker {data.get('worker_id')} after attempt {data.get('attempts')}")
+            chat_id = data.get("chat_id")
+            given_up.append(Job(job_id, data.get("kind", ""), json.loads(data.get("payload", "{}")), int(chat_id) if chat_id else None, int(data.get("attempts", 0))))
+        return given_up
+
+    def stats(self) -> dict:
+        pipe = self._redis.pipeline()
+        pipe.llen(self._queued)
+        pipe.zcard(self._running)
+        pipe.hgetall(self._counters)
+        pipe.lindex(self._queued, -1)
+        queued, running, counters, oldest_id = pipe.execute()
+        oldest = self._redis.hget(self._job_prefix + oldest_id, "created") if oldest_id else None
+        return {
+            "queued": queued,
+            "running": running,
+            "done": int(counters.get("done", 0)),
+            "failed": int(counters.get("failed", 0)),
+            "cancelled": int(counters.get("cancelled", 0)),
+            "oldest_queued_seconds": time.time() - float(oldest) if oldest else 0.0,
+        }
+
+
+def open_queue(url: str) -> SQLiteJobQueue | RedisJobQueue:
+    # sqlite:///relative/path.sqlite3, sqlite:////absolute/path.sqlite3, redis://host:port/db (or rediss://).
+    if url.startswith("sqlite:///"):
+        return SQLiteJobQueue(url[len("sqlite:///"):])
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisJobQueue(url)
+    raise ValueError(f"Unsupported JOB_QUEUE_URL: {url}")
@@ -0,0 +1,181 @@
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+from ytdl import yt_dlp
+
+logger = logging.getLogger(__name__)
+
+# Cache tiers, checked in order:
+#   1. Telegram file_id from an earlier reply_video -> resend with no download/encode/upload
+#   2. Locally cached re-encoded file -> skip download/encode, upload only
+# Local files are evicted least-recently-used once the cache grows past max_bytes, skipping any that in_use(path)
+# reports as still being read (uploads, conversions).
+
+COUNTER_NAMES = ("file_id_hits", "local_hits", "misses", "bytes_saved_download", "bytes_saved_upload")
+
+
+def identify_url(url: str) -> tuple[str, str]:
+    # Resolve extractor + video id offline (no network), the same way yt-dlp builds archive ids.
+    for ie in yt_dlp.extractor.gen_extractor_classes():
+        if ie.suitable(url):
+            video_id = ie.get_temp_id(url)
+            if video_id:
+                return ie.ie_key(), str(video_id)
+            break
+    # Generic/unknown sites: fall back to the URL itself as the identity.
+    return "url", hashlib.sha256(url.encode()).hexdigest()[:32]
+
+
+def make_cache_key(extractor: str, video_id: str, fmt: str) -> str:
+    return hashlib.sha256(f"{extractor}\0{video_id}\0{fmt}".encode()).hexdigest()
+
+
+class MediaCache:
+    def __init__(self, db_path: str, cache_dir: str, max_bytes: int, in_use=None):
+        self.db_path = db_path
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.in_use = in_use
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        # Shared by the bot's worker processes: WAL lets readers work alongside a writer, and writers wait for the
+        # lock instead of failing with "database is locked".
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " key TEXT PRIMARY KEY, extractor TEXT, video_id TEXT, format TEXT,"
+                " tg_file_id TEXT, path TEXT, size INTEGER NOT NULL DEFAULT 0, source_size INTEGER NOT NULL DEFAULT 0,"
+                " created REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            for name in COUNTER_NAMES:
+                self._conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES (?, 0)", (name,))
+        self._drop_missing_files()
+
+    def _drop_missing_files(self) -> None:
+        # Files may have been removed behind our back (redeploy, manual cleanup).
+        with self._lock, self._conn:
+            rows = self._conn.execute("SELECT key, path FROM entries WHERE path IS NOT NULL").fetchall()
+            for key, path in rows:
+                if not os.path.exists(path):
+                    self._conn.execute("UPDATE entries SET path = NULL WHERE key = ?", (key,))
+
+    def _bump(self, name: str, amount: int = 1) -> None:
+        self._conn.execute("UPDATE counters SET value = value + ? WHERE name = ?", (amount, name))
+
+    def _ensure_row(self, key: str, extractor: str, video_id: str, fmt: str) -> None:
+        now = time.time()
+        self._conn.execute(
+            "INSERT OR IGNORE INTO entries (key, extractor, video_id, format, created, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+            (key, extractor, video_id, fmt, now, now),
+        )
+
+    def get_file_id(self, key: str, count_hit: bool = True) -> str | None:
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT tg_file_id, size, source_size FROM entries WHERE key = ?", (key,)).fetchone()
+            if not row or not row[0]:
+                return None
+            self._conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+            if count_hit:
+                self._bump("file_id_hits")
+                self._bump("bytes_saved_download", row[2])
+                self._bump("bytes_saved_upload", row[1])
+            return row[0]
+
+    def get_local(self, key: str, count_hit: bool = True) -> str | None:
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT path, source_size FROM entries WHERE key = ?", (key,)).fetchone()
+            if not row or not row[0]:
+                return None
+            if not os.path.exists(row[0]):
+                self._conn.execute("UPDATE entries SET path = NULL WHERE key = ?", (key,))
+                return None
+            self._conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+            if count_hit:
+                self._bump("local_hits")
+                self._bump("bytes_saved_download", row[1])
+            return row[0]
+
+    def record_miss(self) -> None:
+        with self._lock, self._conn:
+            self._bump("misses")
+
+    def put_file_id(self, key: str, extractor: str, video_id: str, fmt: str, tg_file_id: str) -> None:
+        with self._lock, self._conn:
+            self._ensure_row(key, extractor, video_id, fmt)
+            self._conn.execute(
+                "UPDATE entries SET tg_file_id = ?, last_access = ? WHERE key = ?", (tg_file_id, time.time(), key)
+            )
+
+    def put_local(self, key: str, extractor: str, video_id: str, fmt: str, filepath: str, source_size: int = 0) -> str:
+        # Moves filepath into the cache directory and returns the new path.
+        _, ext = os.path.splitext(filepath)
+        cached_path = os.path.join(self.cache_dir, f"{key}{ext}")
+        if os.path.abspath(filepath) != os.path.abspath(cached_path):
+            shutil.move(filepath, cached_path)
+        size = os.path.getsize(cached_path)
+        with self._lock, self._conn:
+            self._ensure_row(key, extractor, video_id, fmt)
+            self._conn.execute(
+                "UPDATE entries SET path = ?, size = ?, source_size = ?, last_access = ? WHERE key = ?",
+                (cached_path, size, source_size, time.time(), key),
+            )
+            self._evict(keep_key=key)
+        return cached_path
+
+    def invalidate_file_id(self, key: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE entries SET tg_file_id = NULL WHERE key = ?", (key,))
+
+    def _evict(self, keep_key: str | None = None) -> None:
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries WHERE path IS NOT NULL").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute(
+            "SELECT key, path, size FROM entries WHERE path IS NOT NULL ORDER BY last_access ASC"
+        ).fetchall()
+        for key, path, size in rows:
+            if total <= self.max_bytes:
+                break
+            if key == keep_key or (self.in_use and self.in_use(path)):
+                continue
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+                logger.info(f"Evicted cached file {path} ({size} bytes)")
+            except OSError as e_remove:
+                logger.warning(f"Failed to evict cached file {path}: {e_remove}")
+                continue
+            # The Telegram file_id stays valid after the local copy is gone.
+            self._conn.execute("UPDATE entries SET path = NULL WHERE key = ?", (key,))
+            total -= size
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self._conn.execute("SELECT name, value FROM counters").fetchall())
+            entries, with_file_id, local_files, local_bytes = self._conn.execute(
+                "SELECT COUNT(*), COUNT(tg_file_id), COUNT(path),"
+                " COALESCE(SUM(CASE WHEN path IS NOT NULL THEN size ELSE 0 END), 0) FROM entries"
+            ).fetchone()
+        lookups = counters["file_id_hits"] + counters["local_hits"] + counters["misses"]
+        hits = counters["file_id_hits"] + counters["local_hits"]
+        return {
+            **counters,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "entries_with_file_id": with_file_id,
+            "local_files": local_files,
+            "local_bytes": local_bytes,
+            "max_bytes": self.max_bytes,
+        }
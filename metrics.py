@@ -0,0 +1,295 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram.request import HTTPXRequest # type: ignore
+
+logger = logging.getLogger(__name__)
+
+# A minimal Prometheus text-format registry, plus per-request trace ids for log lines.
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+SPEED_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+
+_imported_at = time.monotonic()
+_registry: list["_Metric"] = []
+_collectors = []
+_lock = threading.Lock()
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values: dict[tuple, float] = {}
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _label_text(self, key: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{self._label_text(key)} {value:g}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value: float, **labels) -> None:
+        # For totals that are counted elsewhere (cache stats, dispatcher stats) and copied in at scrape time.
+        with _lock:
+            self._values[self._key(labels)] = value
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        with _lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = buckets
+        self._counts: dict[tuple, list[int]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with _lock:
+            counts = self._counts.setdefault(key, [0] * len(self.buckets))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            # For histograms _values holds (count, sum).
+            total = self._values.get(key, (0, 0.0))
+            self._values[key] = (total[0] + 1, total[1] + value)
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for key, (count, total) in sorted(self._values.items()):
+            for bound, bucket_count in zip(self.buckets, self._counts[key]):
+                le = f'le="{bound:g}"'
+                lines.append(f"{self.name}_bucket{self._label_text(key, le)} {bucket_count}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{self._label_text(key, le)} {count}")
+            lines.append(f"{self.name}_sum{self._label_text(key)} {total:g}")
+            lines.append(f"{self.name}_count{self._label_text(key)} {count}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+STAGE_SECONDS = Histogram("bot_stage_duration_seconds", "Time spent in each processing stage.", ("stage",))
+REQUEST_SECONDS = Histogram("bot_request_duration_seconds", "End-to-end handling time per request, queueing included.", ("kind",))
+POOL_WAIT_SECONDS = Histogram("bot_pool_wait_seconds", "Time spent waiting for a scheduler slot.", ("pool",))
+POOL_BUSY_SECONDS = Histogram("bot_pool_busy_seconds", "Time a scheduler slot was held (the upload pool's is upload time).", ("pool",))
+POOL_QUEUED = Gauge("bot_pool_queued", "Jobs waiting for a scheduler slot.", ("pool",))
+POOL_ACTIVE = Gauge("bot_pool_active", "Scheduler slots in use.", ("pool",))
+POOL_SIZE = Gauge("bot_pool_size", "Scheduler slots available.", ("pool",))
+DOWNLOADED_BYTES = Counter("bot_downloaded_bytes_total", "Bytes downloaded from media sites.")
+UPLOADED_BYTES = Counter("bot_uploaded_bytes_total", "Bytes uploaded, by destination.", ("destination",))
+FFMPEG_CPU_SECONDS = Counter("bot_ffmpeg_cpu_seconds_total", "CPU time used by ffmpeg processes.")
+FFMPEG_SPEED = Histogram("bot_ffmpeg_speed_ratio", "Media seconds processed per wall-clock second.", buckets=SPEED_BUCKETS)
+FFMPEG_FAILURES = Counter("bot_ffmpeg_failures_total", "ffmpeg runs that exited with an error.")
+FFMPEG_KILLED = Counter("bot_ffmpeg_killed_total", "ffmpeg processes killed because their request was abandoned.")
+FFMPEG_LOAD_LEVELS = Counter("bot_ffmpeg_load_level_total", "Encode settings chosen at each load level (0 uses quality presets).", ("load_level",))
+TELEGRAM_REQUESTS = Counter("bot_telegram_requests_total", "Bot API requests by method and HTTP status.", ("method", "status"))
+TELEGRAM_SECONDS = Histogram("bot_telegram_request_duration_seconds", "Bot API request latency.", ("method",))
+CACHE_EVENTS = Counter("bot_cache_events_total", "Cache lookups by cache and outcome.", ("cache", "outcome"))
+CACHE_HIT_RATIO = Gauge("bot_cache_hit_ratio", "Hits over lookups since start.", ("cache",))
+PROGRESS_EDITS = Counter("bot_progress_edits_total", "Progress message edits by outcome.", ("outcome",))
+YTDL_CHECKOUT_SECONDS = Histogram("bot_ytdl_checkout_seconds", "Time to get a YoutubeDL instance for a request, from the pool or built new.", ("source",))
+STARTUP_SECONDS = Gauge("bot_startup_seconds", "Seconds from process start to each start-up milestone.", ("milestone",))
+STORAGE_BYTES = Gauge("bot_storage_bytes", "Bytes tracked by the artifact store, by kind.", ("kind",))
+
+
+def timed(stage: str):
+    # Decorator recording a function's duration in STAGE_SECONDS. Works for plain and async functions.
+    def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with STAGE_SECONDS.time(stage=stage):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with STAGE_SECONDS.time(stage=stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def process_age() -> float:
+    # Seconds since the process started, interpreter start-up and imports included where /proc says so.
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return time.monotonic() - _imported_at
+
+
+def startup_milestone(name: str) -> None:
+    # Records when `name` first happened after process start; later calls are ignored.
+    with _lock:
+        if (name,) in STARTUP_SECONDS._values:
+            return
+    age = process_age()
+    STARTUP_SECONDS.set(age, milestone=name)
+    logger.info(f"Start-up: {name} after {age:.2f}s")
+
+
+def startup_milestones() -> dict[str, float]:
+    with _lock:
+        return {key[0]: value for key, value in STARTUP_SECONDS._values.items()}
+
+
+trace_id: contextvars.ContextVar[str] = contextvars.ContextVar("trace_id", default="-")
+
+
+def traced(kind: str):
+    # Decorator for update handlers: gives the request a fresh trace id (inherited by everything it awaits
+    # and by the scheduler's worker threads) and records its duration in REQUEST_SECONDS.
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            token = trace_id.set(uuid.uuid4().hex[:12])
+            try:
+                with REQUEST_SECONDS.time(kind=kind):
+                    return await fn(*args, **kwargs)
+            finally:
+                trace_id.reset(token)
+        return wrapper
+    return decorator
+
+
+class TraceIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = trace_id.get()
+        return True
+
+
+def install_trace_logging() -> None:
+    # Adds %(trace_id)s to every record that reaches the root handlers, whichever logger emitted it.
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(TraceIdFilter())
+
+
+class MetricsRequest(HTTPXRequest):
+    # Counts every Bot API call by method and status, and the bytes of every file upload.
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        upload_bytes = 0
+        if request_data is not None:
+            for field in request_data.multipart_data.values():
+                content = field[1]
+                if isinstance(content, bytes):
+                    upload_bytes += len(content)
+                elif hasattr(content, "fileno"):
+                    upload_bytes += os.fstat(content.fileno()).st_size
+        started = time.monotonic()
+        status = "error"
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+            status = str(code)
+            return code, payload
+        finally:
+            TELEGRAM_SECONDS.observe(time.monotonic() - started, method=api_method)
+            TELEGRAM_REQUESTS.inc(method=api_method, status=status)
+            if upload_bytes and status == "200":
+                UPLOADED_BYTES.inc(upload_bytes, destination="telegram")
+            if api_method.startswith("send") and status == "200":
+                # For a message sent during a deploy, this is how long the user waited for a first answer.
+                startup_milestone("first_response")
+
+
+def add_collector(fn) -> None:
+    # fn() runs on the event loop before every scrape, to copy state kept elsewhere into gauges.
+    _collectors.append(fn)
+
+
+def render() -> str:
+    for collector in _collectors:
+        try:
+            collector()
+        except Exception as e_collect:
+            logger.warning(f"Metrics collector {collector.__name__} failed: {e_collect}")
+    with _lock:
+        lines = [line for metric in _registry for line in metric.render()]
+    return "\n".join(lines) + "\n"
+
+
+def serve(host: str, port: int, loop: asyncio.AbstractEventLoop) -> ThreadingHTTPServer:
+    # Serves GET /metrics from a background thread. Collectors read scheduler and dispatcher state that the
+    # event loop owns, so rendering is handed to the loop.
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            try:
+                body = asyncio.run_coroutine_threadsafe(_render_async(), loop).result(timeout=10)
+            except Exception as e_render:
+                logger.warning(f"Metrics scrape failed: {e_render}")
+                self.send_error(500)
+                return
+            payload = body.encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Metrics endpoint listening on http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+async def _render_async() -> str:
+    return render()
@@ -0,0 +1,241 @@
+import asyncio
+import functools
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from telegram.error import BadRequest, RetryAfter # type: ignore
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows roughly 30 messages/s per bot, 1/s per private chat and 20/min per group.
+# Progress edits are the least important traffic we send, so they get less than that and leave
+# headroom for uploads and replies.
+GLOBAL_EDITS_PER_SECOND = 20
+PRIVATE_CHAT_EDITS_PER_SECOND = 1 / 2
+GROUP_CHAT_EDITS_PER_SECOND = 15 / 60
+# Items in progress listed by name in a batch status message; the rest are only counted.
+BATCH_ITEM_LINES = 10
+# How long forget() lets an edit already on its way to Telegram finish before cancelling it.
+FORGET_WAIT_SECONDS = 5
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        # Seconds until a token is available (0 if one is available now).
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> bool:
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class ProgressDispatcher:
+    # Keeps only the latest text per message and sends edits at a rate Telegram tolerates.
+    # update() may be called as often as you like; intermediate states are simply overwritten. A message has at
+    # most one edit in flight, so edits cannot overtake each other.
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._pending: OrderedDict[tuple[int, int], str] = OrderedDict()
+        self._last_sent: dict[tuple[int, int], str] = {}
+        self._in_flight: dict[tuple[int, int], asyncio.Task] = {}
+        self._chat_buckets: dict[int, TokenBucket] = {}
+        self._global_bucket = TokenBucket(GLOBAL_EDITS_PER_SECOND, GLOBAL_EDITS_PER_SECOND)
+        self._paused_until = 0.0
+        self._wakeup: asyncio.Event | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._loop_thread: int | None = None
+        self._task: asyncio.Task | None = None
+        self.sent = 0
+        self.coalesced = 0
+        self.unchanged = 0
+        self.rate_limited = 0
+
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._wakeup = asyncio.Event()
+        self._task = self._loop.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        for task in list(self._in_flight.values()):
+            task.cancel()
+
+    def update(self, chat_id: int, message_id: int, text: str) -> None:
+        key = (chat_id, message_id)
+        if self._last_sent.get(key) == text:
+            self._pending.pop(key, None)
+            self.unchanged += 1
+            return
+        if key in self._pending:
+            self.coalesced += 1
+        self._pending[key] = text
+        if self._wakeup:
+            self._wakeup.set()
+
+    def update_threadsafe(self, chat_id: int, message_id: int, text: str) -> None:
+        # For worker threads (yt-dlp hooks, ffmpeg progress readers). On the loop itself the update is made right
+        # away, so a forget() that follows cannot be overtaken by it.
+        if self._loop and not self._loop.is_closed():
+            if threading.get_ident() == self._loop_thread:
+                self.update(chat_id, message_id, text)
+            else:
+                self._loop.call_soon_threadsafe(self.update, chat_id, message_id, text)
+
+    async def forget(self, chat_id: int, message_id: int) -> None:
+        # Call once the message is finished with, before it is deleted or given a final text sent directly: drops
+        # what is pending and waits out an edit already in flight, so neither can land on top of the final text.
+        key = (chat_id, message_id)
+        # Let updates that worker threads posted before this call arrive first.
+        await asyncio.sleep(0)
+        self._pending.pop(key, None)
+        task = self._in_flight.get(key)
+        if task:
+            done, _ = await asyncio.wait({task}, timeout=FORGET_WAIT_SECONDS)
+            if not done:
+                task.cancel()
+                await asyncio.wait({task})
+        # A rate-limited send puts its text back.
+        self._pending.pop(key, None)
+        self._last_sent.pop(key, None)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # Negative ids are groups and channels.
+            rate = GROUP_CHAT_EDITS_PER_SECOND if chat_id < 0 else PRIVATE_CHAT_EDITS_PER_SECOND
+            bucket = self._chat_buckets[chat_id] = TokenBucket(rate, 1)
+        return bucket
+
+    async def _run(self) -> None:
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            global_delay = self._global_bucket.delay()
+            if global_delay > 0:
+                await asyncio.sleep(global_delay)
+                continue
+
+            next_delay = None
+            for key in list(self._pending):
+                if key in self._in_flight:
+                    # Picked up again once the earlier edit is done.
+                    continue
+                bucket = self._chat_bucket(key[0])
+                delay = bucket.delay()
+                if delay > 0:
+                    next_delay = delay if next_delay is None else min(next_delay, delay)
+                    continue
+                bucket.take()
+                self._global_bucket.take()
+                text = self._pending.pop(key)
+                task = self._in_flight[key] = asyncio.create_task(self._send(key, text))
+                task.add_done_callback(functools.partial(self._sent, key))
+                break
+            else:
+                # Every pending chat is waiting on its own bucket; sleep until the first one refills,
+                # or until a new chat shows up.
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=next_delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _send(self, key: tuple[int, int], text: str) -> None:
+        chat_id, message_id = key
+        try:
+            await self.bot.edit_message_text(text=text, chat_id=chat_id, message_id=message_id)
+            self._last_sent[key] = text
+            self.sent += 1
+        except RetryAfter as e_retry:
+            self.rate_limited += 1
+            retry_after = e_retry.retry_after
+            retry_after = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+            logger.warning(f"Progress edits rate limited by Telegram, pausing {retry_after:.0f}s")
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            # Put the text back unless something newer arrived meanwhile.
+            self._pending.setdefault(key, text)
+        except BadRequest as e_bad:
+            # "Message is not modified" or the message is gone; either way there is nothing to retry.
+            logger.debug(f"Progress edit for {key} rejected: {e_bad}")
+        except Exception as e_progress:
+            logger.warning(f"Failed to edit progress message: {e_progress}")
+
+    def _sent(self, key: tuple[int, int], task: asyncio.Task) -> None:
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        if key in self._pending:
+            self._wakeup.set()
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "in_flight": len(self._in_flight),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "unchanged": self.unchanged,
+            "rate_limited": self.rate_limited,
+        }
+
+
+class BatchProgress:
+    # One status message for a whole batch of links: a summary line plus a line per item in progress. Items
+    # report their state from the event loop or from worker threads; every change re-renders the message and
+    # hands it to the dispatcher, which coalesces the edits as usual.
+    def __init__(self, dispatcher: ProgressDispatcher, chat_id: int, message_id: int, total: int):
+        self.dispatcher = dispatcher
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self._states = ["waiting"] * total
+        self._lock = threading.Lock()
+
+    def set(self, index: int, state: str) -> None:
+        with self._lock:
+            self._states[index] = state
+            text = self.render()
+        self.dispatcher.update_threadsafe(self.chat_id, self.message_id, text)
+
+    def count(self, state: str) -> int:
+        return self._states.count(state)
+
+    def render(self) -> str:
+        lines = [f"Batch of {len(self._states)}: {self.count('sent')} sent, {self.count('failed')} failed"]
+        active = [
+            f"#{number}: {state}" for number, state in enumerate(self._states, start=1)
+            if state not in ("waiting", "sent", "failed")
+        ]
+        lines.extend(active[:BATCH_ITEM_LINES])
+        if len(active) > BATCH_ITEM_LINES:
+            lines.append(f"... and {len(active) - BATCH_ITEM_LINES} more in progress")
+        waiting = self.count("waiting")
+        if waiting:
+            lines.append(f"{waiting} waiting")
+        return "\n".join(lines)
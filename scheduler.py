@@ -0,0 +1,220 @@
+import asyncio
+import contextvars
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from metrics import POOL_BUSY_SECONDS, POOL_WAIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Each stage (download, transcode, upload) has a fixed number of slots. Waiters are queued per chat and
+# slots are handed out round-robin across chats, so one chat with a long queue cannot starve the rest.
+
+
+class StagePool:
+    def __init__(self, name: str, size: int, use_threads: bool = True):
+        self.name = name
+        self.size = size
+        # Uploads are coroutines on the event loop and only need the slot accounting.
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix=name) if use_threads else None
+        self.active = 0
+        self.queued = 0 # Plain counter so worker threads can read it (the encode thread budget does)
+        self._waiters: OrderedDict[int, deque[asyncio.Future]] = OrderedDict()
+        # Resolved (and replaced) whenever the queue changes, so waiters can re-check their position.
+        self._moved: asyncio.Future | None = None
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_busy = 0.0
+
+    def position(self, chat_id: int, waiter: asyncio.Future) -> int:
+        # 1-based number of grants before this waiter under round-robin.
+        queue = self._waiters.get(chat_id)
+        if not queue or waiter not in queue:
+            return 0
+        index = queue.index(waiter)
+        ahead = index
+        # Chats before this one in the rotation get a grant more than those after it.
+        before = True
+        for other_chat, other_queue in self._waiters.items():
+            if other_chat == chat_id:
+                before = False
+            else:
+                ahead += min(len(other_queue), index + 1 if before else index)
+        return ahead + 1
+
+    def _grant_next(self) -> None:
+        while self.active < self.size and self._waiters:
+            chat_id, queue = next(iter(self._waiters.items()))
+            waiter = queue.popleft()
+            # Rotate this chat to the back so the next grant goes to someone else.
+            del self._waiters[chat_id]
+            if queue:
+                self._waiters[chat_id] = queue
+            self._queue_moved()
+            if waiter.done():
+                continue
+            self.active += 1
+            waiter.set_result(None)
+
+    def _queue_moved(self) -> None:
+        # Wakes the position reporters of everyone still waiting.
+        if self._moved is not None and not self._moved.done():
+            self._moved.set_result(None)
+        self._moved = None
+
+    async def _report_position(self, chat_id: int, waiter: asyncio.Future, on_wait) -> None:
+        # Reports the waiter's position, then again whenever grants, arrivals or cancellations move it. Ends once
+        # the waiter has its slot. on_wait should hand the text to something that rate-limits its edits.
+        reported = None
+        while True:
+            position = self.position(chat_id, waiter)
+            if position and position != reported:
+                try:
+                    await on_wait(position)
+                except Exception as e_notify:
+                    logger.warning(f"Failed to report {self.name} queue position: {e_notify}")
+                reported = position
+            if waiter.done():
+                return
+            if self._moved is None:
+                self._moved = asyncio.get_running_loop().create_future()
+            await asyncio.wait({waiter, self._moved}, return_when=asyncio.FIRST_COMPLETED)
+
+    async def _acquire(self, chat_id: int, on_wait) -> float:
+        # Returns the time the slot was granted; pass it to _release().
+        queued_at = time.monotonic()
+        if self.active < self.size and not self._waiters:
+            self.active += 1
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.setdefault(chat_id, deque()).append(waiter)
+            self._queue_moved()
+            self.queued += 1
+            reporter = asyncio.create_task(self._report_position(chat_id, waiter, on_wait)) if on_wait else None
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # Granted and cancelled at the same time: hand the slot on.
+                    self.active -= 1
+                    self._grant_next()
+                else:
+                    queue = self._waiters.get(chat_id)
+                    if queue and waiter in queue:
+                        queue.remove(waiter)
+                        if not queue:
+                            del self._waiters[chat_id]
+                        self._queue_moved()
+                raise
+            finally:
+                self.queued -= 1
+                if reporter:
+                    reporter.cancel()
+        waited = time.monotonic() - queued_at
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        POOL_WAIT_SECONDS.observe(waited, pool=self.name)
+        return time.monotonic()
+
+    def _release(self, granted_at: float) -> None:
+        busy = time.monotonic() - granted_at
+        self.total_busy += busy
+        POOL_BUSY_SECONDS.observe(busy, pool=self.name)
+        self.active -= 1
+        self.completed += 1
+        self._grant_next()
+
+    @asynccontextmanager
+    async def slot(self, chat_id: int, on_wait=None):
+        granted_at = await self._acquire(chat_id, on_wait)
+        try:
+            yield
+        finally:
+            self._release(granted_at)
+
+    async def run(self, chat_id: int, fn, *args, on_wait=None):
+        granted_at = await self._acquire(chat_id, on_wait)
+        loop = asyncio.get_running_loop()
+        try:
+            # Carry the caller's context (its trace id) into the worker thread.
+            future = self.executor.submit(contextvars.copy_context().run, fn, *args)
+        except BaseException:
+            self._release(granted_at)
+            raise
+
+        # The slot goes back when the thread is done, not when the caller stops waiting: a cancelled caller's
+        # thread runs on until it notices (or its ffmpeg is killed), and occupies a worker until then.
+        def thread_done(_) -> None:
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(self._release, granted_at)
+        future.add_done_callback(thread_done)
+        return await asyncio.wrap_future(future)
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "active": self.active,
+            "queued": self.queued,
+            "waiting_chats": len(self._waiters),
+            "completed": self.completed,
+            "avg_wait": self.total_wait / self.completed if self.completed else 0.0,
+            "max_wait": self.max_wait,
+            "avg_busy": self.total_busy / self.completed if self.completed else 0.0,
+        }
+
+
+class JobScheduler:
+    def __init__(self, download_workers: int, transcode_workers: int, upload_workers: int, per_user_jobs: int):
+        self.download = StagePool("download", download_workers)
+        self.transcode = StagePool("transcode", transcode_workers)
+        self.upload = StagePool("upload", upload_workers, use_threads=False)
+        self.per_user_jobs = per_user_jobs
+        self._user_slots: dict[int, asyncio.Semaphore] = {}
+        self._user_jobs: dict[int, int] = {} # Jobs running or waiting per user; the semaphore goes when it drops to 0
+        self._user_active: dict[int, int] = {}
+
+    @asynccontextmanager
+    async def job(self, user_id: int, on_wait=None):
+        # Caps how many jobs a single user can have in flight; the rest wait here before touching any pool.
+        semaphore = self._user_slots.setdefault(user_id, asyncio.Semaphore(self.per_user_jobs))
+        self._user_jobs[user_id] = self._user_jobs.get(user_id, 0) + 1
+        try:
+            if semaphore.locked() and on_wait:
+                try:
+                    await on_wait(None)
+                except Exception as e_notify:
+                    logger.warning(f"Failed to report per-user queue state: {e_notify}")
+            async with semaphore:
+                self._user_active[user_id] = self._user_active.get(user_id, 0) + 1
+                try:
+                    yield
+                finally:
+                    self._user_active[user_id] -= 1
+                    if not self._user_active[user_id]:
+                        del self._user_active[user_id]
+        finally:
+            self._user_jobs[user_id] -= 1
+            if not self._user_jobs[user_id]:
+                del self._user_jobs[user_id]
+                del self._user_slots[user_id]
+
+    def stats(self) -> dict:
+        return {
+            "download": self.download.stats(),
+            "transcode": self.transcode.stats(),
+            "upload": self.upload.stats(),
+            "active_users": len(self._user_active),
+        }
+
+    def shutdown(self) -> None:
+        for pool in (self.download, self.transcode):
+            pool.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def default_transcode_workers() -> int:
+    return max(1, os.cpu_count() or 1)
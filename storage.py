@@ -0,0 +1,266 @@
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Every file the bot writes under the download directory is an artifact: the downloaded source, the Telegram
+# re-encode, and conversions (kind "conversion:<action>", linked to the re-encode they came from via parent_id).
+# Artifacts are removed least-recently-used once the directory grows past the quota, and after ttl seconds
+# without access. Artifacts leased by a running job are never evicted. Leases are also written to the database, so
+# worker processes sharing the directory respect each other's.
+# Files of the media cache are tracked as CACHED_KIND, for the artifact ids and leases conversion buttons and
+# uploads need. The media cache alone decides when they go, so they are left out of TTL expiry and the quota.
+
+CACHED_KIND = "cached"
+
+
+class ArtifactStore:
+    def __init__(self, db_path: str, root_dir: str, quota_bytes: int, ttl_seconds: float):
+        self.db_path = db_path
+        self.root_dir = root_dir
+        self.quota_bytes = quota_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._leases: dict[str, int] = {}
+        self._holder = f"{socket.gethostname()}:{os.getpid()}"
+        self.evicted = 0
+        self.evicted_bytes = 0
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        # Shared by the bot's worker processes: WAL lets readers work alongside a writer, and writers wait for the
+        # lock instead of failing with "database is locked".
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS artifacts ("
+                " id TEXT PRIMARY KEY, path TEXT NOT NULL UNIQUE, kind TEXT NOT NULL, size INTEGER NOT NULL,"
+                " owner_id INTEGER, parent_id TEXT, created REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS artifacts_parent ON artifacts (parent_id, kind)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS artifacts_last_access ON artifacts (last_access)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS leases (artifact_id TEXT NOT NULL, holder TEXT NOT NULL, acquired REAL NOT NULL,"
+                " PRIMARY KEY (artifact_id, holder))"
+            )
+            # Left behind by an earlier process that had the same pid.
+            self._conn.execute("DELETE FROM leases WHERE holder = ?", (self._holder,))
+
+    def register(self, path: str, kind: str, owner_id: int | None = None, parent_id: str | None = None) -> str:
+        path = os.path.abspath(path)
+        now = time.time()
+        size = os.path.getsize(path)
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT id FROM artifacts WHERE path = ?", (path,)).fetchone()
+            if row:
+                self._conn.execute(
+                    "UPDATE artifacts SET kind = ?, size = ?, owner_id = COALESCE(?, owner_id), parent_id = COALESCE(?, parent_id),"
+                    " last_access = ? WHERE id = ?",
+                    (kind, size, owner_id, parent_id, now, row[0]),
+                )
+                artifact_id = row[0]
+            else:
+                artifact_id = uuid.uuid4().hex
+                self._conn.execute(
+                    "INSERT INTO artifacts (id, path, kind, size, owner_id, parent_id, created, last_access) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (artifact_id, path, kind, size, owner_id, parent_id, now, now),
+                )
+        return artifact_id
+
+    def retag(self, directory: str, kind: str) -> int:
+        # Gives every tracked file under directory the given kind, e.g. cache files an older version registered
+        # as re-encodes. Returns the number of rows changed.
+        prefix = os.path.join(os.path.abspath(directory), "")
+        with self._lock, self._conn:
+            return self._conn.execute(
+                "UPDATE artifacts SET kind = ? WHERE kind != ? AND substr(path, 1, ?) = ?", (kind, kind, len(prefix), prefix)
+            ).rowcount
+
+    def _path_if_present(self, artifact_id: str, path: str) -> str | None:
+        if os.path.exists(path):
+            self._conn.execute("UPDATE artifacts SET last_access = ? WHERE id = ?", (time.time(), artifact_id))
+            return path
+        self._conn.execute("DELETE FROM artifacts WHERE id = ?", (artifact_id,))
+        return None
+
+    def get(self, artifact_id: str) -> str | None:
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT path FROM artifacts WHERE id = ?", (artifact_id,)).fetchone()
+            return self._path_if_present(artifact_id, row[0]) if row else None
+
+    def find_child(self, parent_id: str, kind: str) -> str | None:
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT id, path FROM artifacts WHERE parent_id = ? AND kind = ? ORDER BY created DESC LIMIT 1", (parent_id, kind)
+            ).fetchone()
+            return self._path_if_present(row[0], row[1]) if row else None
+
+    def id_for_path(self, path: str) -> str | None:
+        with self._lock:
+            row = self._conn.execute("SELECT id FROM artifacts WHERE path = ?", (os.path.abspath(path),)).fetchone()
+            return row[0] if row else None
+
+    def remove(self, artifact_id: str) -> None:
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT path FROM artifacts WHERE id = ?", (artifact_id,)).fetchone()
+            if row:
+                self._delete(artifact_id, row[0])
+
+    def remove_path(self, path: str) -> None:
+        artifact_id = self.id_for_path(path)
+        if artifact_id:
+            self.remove(artifact_id)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def _delete(self, artifact_id: str, path: str) -> int:
+        size = 0
+        try:
+            if os.path.exists(path):
+                size = os.path.getsize(path)
+                os.remove(path)
+        except OSError as e_remove:
+            logger.warning(f"Failed to remove artifact {path}: {e_remove}")
+            return 0
+        self._conn.execute("DELETE FROM artifacts WHERE id = ?", (artifact_id,))
+        return size
+
+    @contextmanager
+    def lease(self, *artifact_ids: str):
+        # Protects artifacts from eviction while a job reads or writes them.
+        with self._lock, self._conn:
+            for artifact_id in artifact_ids:
+                self._leases[artifact_id] = self._leases.get(artifact_id, 0) + 1
+                if self._leases[artifact_id] == 1:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO leases (artifact_id, holder, acquired) VALUES (?, ?, ?)",
+                        (artifact_id, self._holder, time.time()),
+                    )
+        try:
+            yield
+        finally:
+            with self._lock, self._conn:
+                for artifact_id in artifact_ids:
+                    self._leases[artifact_id] -= 1
+                    if not self._leases[artifact_id]:
+                        del self._leases[artifact_id]
+                        self._conn.execute("DELETE FROM leases WHERE artifact_id = ? AND holder = ?", (artifact_id, self._holder))
+
+    def is_leased(self, path: str) -> bool:
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT id FROM artifacts WHERE path = ?", (os.path.abspath(path),)).fetchone()
+            return bool(row) and row[0] in self._leased_ids()
+
+    def _leased_ids(self) -> set[str]:
+        # Leases held by this process and by other live ones. A holder that died without releasing is detected
+        # by pid on this host; on other hosts its leases lapse after ttl_seconds.
+        hostname = socket.gethostname()
+        leased = set(self._leases)
+        for artifact_id, holder, acquired in self._conn.execute("SELECT artifact_id, holder, acquired FROM leases").fetchall():
+            host, _, pid = holder.rpartition(":")
+            if (host == hostname and not _pid_alive(int(pid))) or acquired < time.time() - self.ttl_seconds:
+                self._conn.execute("DELETE FROM leases WHERE artifact_id = ? AND holder = ?", (artifact_id, holder))
+            else:
+                leased.add(artifact_id)
+        return leased
+
+    def enforce(self) -> int:
+        # Drops rows whose files vanished, expires idle artifacts, then evicts LRU down to the quota.
+        # Returns the number of bytes freed.
+        freed = 0
+        with self._lock, self._conn:
+            leased = self._leased_ids()
+            rows = self._conn.execute("SELECT id, path, kind, size, last_access FROM artifacts ORDER BY last_access ASC").fetchall()
+            expire_before = time.time() - self.ttl_seconds
+            live = []
+            for artifact_id, path, kind, size, last_access in rows:
+                if not os.path.exists(path):
+                    self._conn.execute("DELETE FROM artifacts WHERE id = ?", (artifact_id,))
+                elif kind == CACHED_KIND:
+                    continue
+                elif last_access < expire_before and artifact_id not in leased:
+                    freed += self._evict(artifact_id, path, "ttl")
+                else:
+                    live.append((artifact_id, path, size))
+            total = sum(size for _, _, size in live)
+            for artifact_id, path, size in live:
+                if total <= self.quota_bytes:
+                    break
+                if artifact_id in leased:
+                    continue
+                removed = self._evict(artifact_id, path, "quota")
+                freed += removed
+                total -= removed
+        return freed
+
+    def _evict(self, artifact_id: str, path: str, reason: str) -> int:
+        removed = self._delete(artifact_id, path)
+        if removed:
+            self.evicted += 1
+            self.evicted_bytes += removed
+            logger.info(f"Evicted {path} ({removed} bytes, {reason})")
+        return removed
+
+    def cleanup_orphans(self, keep_paths: tuple[str, ...] = (), min_age_seconds: float = 0) -> int:
+        # At startup nothing is in flight: delete files nobody tracks (partial downloads, pre-store leftovers)
+        # and rows whose files are gone. Returns the number of files removed. When other processes share the
+        # directory, min_age_seconds spares files they may still be writing.
+        keep = {os.path.abspath(path) for path in keep_paths}
+        modified_before = time.time() - min_age_seconds
+        with self._lock, self._conn:
+            if not min_age_seconds:
+                self._conn.execute("DELETE FROM leases")
+            tracked = dict(self._conn.execute("SELECT path, id FROM artifacts").fetchall())
+            for path, artifact_id in tracked.items():
+                if not os.path.exists(path):
+                    self._conn.execute("DELETE FROM artifacts WHERE id = ?", (artifact_id,))
+        removed = 0
+        for dirpath, _, filenames in os.walk(self.root_dir):
+            for filename in filenames:
+                path = os.path.abspath(os.path.join(dirpath, filename))
+                if path in tracked or any(path.startswith(kept) for kept in keep):
+                    continue
+                try:
+                    if min_age_seconds and os.path.getmtime(path) > modified_before:
+                        continue
+                    os.remove(path)
+                    removed += 1
+                    logger.info(f"Removed orphaned file {path}")
+                except OSError as e_remove:
+                    logger.warning(f"Failed to remove orphaned file {path}: {e_remove}")
+        return removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            count, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM artifacts WHERE kind != ?", (CACHED_KIND,)
+            ).fetchone()
+            by_kind = dict(self._conn.execute("SELECT kind, COALESCE(SUM(size), 0) FROM artifacts GROUP BY kind").fetchall())
+            leased = self._conn.execute("SELECT COUNT(DISTINCT artifact_id) FROM leases").fetchone()[0]
+        return {
+            "artifacts": count,
+            "bytes": total,
+            "quota_bytes": self.quota_bytes,
+            "bytes_by_kind": by_kind,
+            "leased": leased,
+            "evicted": self.evicted,
+            "evicted_bytes": self.evicted_bytes,
+        }
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
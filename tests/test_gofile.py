@@ -0,0 +1,184 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+
+from gofile import GofileError, GofileUploader
+
+
+class StandIn:
+    # A local stand-in for the gofile API and its upload servers. upload_statuses is consumed one status per
+    # upload request (200 once it runs out); every upload body is kept for inspection.
+    def __init__(self, servers=("store1",), upload_statuses=()):
+        self.servers = list(servers)
+        self.upload_statuses = list(upload_statuses)
+        self.server_requests = 0
+        self.uploads: list[tuple[str, bytes, dict]] = []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status: int, payload: dict) -> None:
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                stand_in.server_requests += 1
+                self._reply(200, {"status": "ok", "data": {"servers": [{"name": name} for name in stand_in.servers]}})
+
+            def do_POST(self):
+                server = self.path.strip("/").split("/")[0]
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                stand_in.uploads.append((server, body, dict(self.headers)))
+                status = stand_in.upload_statuses.pop(0) if stand_in.upload_statuses else 200
+                if status != 200:
+                    self._reply(status, {"status": "error"})
+                    return
+                self._reply(200, {"status": "ok", "data": {"downloadPage": f"https://gofile.io/d/{len(stand_in.uploads)}", "server": server}})
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def uploader(self, **kwargs) -> GofileUploader:
+        kwargs.setdefault("backoff", 0.01)
+        return GofileUploader(api_url=self.url, upload_url=self.url + "/{server}/contents/uploadfile", **kwargs)
+
+
+@pytest.fixture
+def stand_in():
+    servers = []
+
+    def start(**kwargs) -> StandIn:
+        server = StandIn(**kwargs)
+        server.thread.start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.httpd.shutdown()
+        server.httpd.server_close()
+
+
+@pytest.fixture
+def media_file(tmp_path):
+    path = tmp_path / 'clip "one".mp4'
+    path.write_bytes(os.urandom(300_000))
+    return str(path)
+
+
+def _file_part(body: bytes, headers: dict) -> bytes:
+    boundary = headers["Content-Type"].split("boundary=")[1].encode()
+    for part in body.split(b"--" + boundary):
+        head, _, content = part.partition(b"\r\n\r\n")
+        if b'name="file"' in head:
+            return content[:-2] # the CRLF before the next boundary
+    raise AssertionError("no file part in upload body")
+
+
+async def _upload(uploader: GofileUploader, *args, **kwargs):
+    try:
+        return await uploader.upload(*args, **kwargs)
+    finally:
+        await uploader.close()
+
+
+def test_streamed_body_matches_file(stand_in, media_file):
+    server = stand_in()
+    uploader = server.uploader(chunk_size=64 * 1024)
+    progress = []
+    data = asyncio.run(_upload(uploader, media_file, "folder1", lambda sent, total: progress.append((sent, total))))
+
+    assert data["downloadPage"] == "https://gofile.io/d/1"
+    (_, body, headers), = server.uploads
+    assert int(headers["Content-Length"]) == len(body)
+    with open(media_file, "rb") as f:
+        assert hashlib.sha256(_file_part(body, headers)).hexdigest() == hashlib.sha256(f.read()).hexdigest()
+    assert b'name="folderId"\r\n\r\nfolder1\r\n' in body
+    assert b'filename="clip %22one%22.mp4"' in body
+    # One progress call per chunk, ending at the full size.
+    assert len(progress) == 5
+    assert progress[-1] == (300_000, 300_000)
+
+
+def test_retries_server_errors_on_a_new_server(stand_in, media_file):
+    server = stand_in(upload_statuses=[503, 502])
+    uploader = server.uploader(retries=3)
+    data = asyncio.run(_upload(uploader, media_file))
+
+    assert data["downloadPage"] == "https://gofile.io/d/3"
+    assert len(server.uploads) == 3
+    # Each failure drops the cached server, so every attempt looks one up again.
+    assert server.server_requests == 3
+    assert uploader.stats()["retried"] == 2
+    assert uploader.stats()["uploaded"] == 1
+    assert uploader.stats()["failed"] == 0
+
+
+def test_server_lookup_is_cached_for_its_ttl(stand_in, media_file):
+    server = stand_in(servers=["store1", "store2"])
+    uploader = server.uploader(server_ttl=600)
+
+    async def upload_three():
+        try:
+            return [await uploader.upload(media_file) for _ in range(3)]
+        finally:
+            await uploader.close()
+
+    asyncio.run(upload_three())
+    assert server.server_requests == 1
+    assert len({upload[0] for upload in server.uploads}) == 1
+
+    expired = stand_in()
+    uploader = expired.uploader(server_ttl=0)
+    asyncio.run(upload_three())
+    assert expired.server_requests == 3
+
+
+def test_gives_up_when_every_server_fails(stand_in, media_file):
+    server = stand_in(servers=["store1", "store2"], upload_statuses=[500] * 10)
+    uploader = server.uploader(retries=2)
+    with pytest.raises(GofileError, match="after 3 attempts"):
+        asyncio.run(_upload(uploader, media_file))
+    assert len(server.uploads) == 3
+    assert uploader.stats()["failed"] == 1
+    assert uploader.stats()["uploaded"] == 0
+
+
+def test_oversized_delivery_falls_back_when_gofile_fails(stand_in, media_file, monkeypatch):
+    bot = pytest.importorskip("bot")
+    from scheduler import JobScheduler
+
+    server = stand_in(upload_statuses=[500] * 10)
+    forgotten = []
+
+    async def forget(*key):
+        forgotten.append(key)
+    monkeypatch.setattr(bot, "SPLIT_OVERSIZED", False)
+    monkeypatch.setattr(bot, "gofile_uploader", server.uploader(retries=1))
+    monkeypatch.setattr(bot, "progress_dispatcher", SimpleNamespace(forget=forget))
+    status_message = SimpleNamespace(chat_id=1, message_id=2, text=None)
+
+    async def deliver():
+        monkeypatch.setattr(bot, "scheduler", JobScheduler(1, 1, 1, 1))
+        try:
+            return await bot._deliver_oversized(status_message, media_file, 3000.0)
+        finally:
+            await bot.gofile_uploader.close()
+
+    text = asyncio.run(deliver())
+    assert "File saved to local storage" in text
+    assert len(server.uploads) == 2
+    assert forgotten == [(1, 2)]
@@ -0,0 +1,112 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from jobqueue import SQLiteJobQueue
+
+
+def _status(queue: SQLiteJobQueue, job_id: str) -> str:
+    return queue._conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+
+
+def test_a_worker_that_lost_its_lease_cannot_finish_the_job(tmp_path):
+    queue = SQLiteJobQueue(str(tmp_path / "jobs.sqlite3"))
+    job_id, _ = queue.enqueue("url", {"update": {}}, chat_id=1)
+    queue.claim("w1", lease_seconds=-1)
+    # w1 stopped heartbeating: the job goes back to the queue and w2 takes it.
+    assert queue.requeue_expired() == []
+    assert queue.claim("w2", lease_seconds=60).id == job_id
+
+    assert not queue.fail(job_id, "w1", "late failure")
+    assert _status(queue, job_id) == "running"
+    assert queue.complete(job_id, "w2")
+    assert _status(queue, job_id) == "done"
+    assert not queue.complete(job_id, "w2")
+
+
+def test_cancelled_jobs_are_finished_by_their_worker(tmp_path):
+    queue = SQLiteJobQueue(str(tmp_path / "jobs.sqlite3"))
+    job_id, _ = queue.enqueue("url", {"update": {}}, chat_id=1)
+    queue.claim("w1", lease_seconds=60)
+    assert queue.cancel(1) == 1
+    assert queue.heartbeat("w1", [job_id], 60) == [job_id]
+    assert queue.mark_cancelled(job_id, "w1")
+    assert _status(queue, job_id) == "cancelled"
+
+
+
+def _attempts(queue: SQLiteJobQueue, job_id: str) -> int:
+    return queue._conn.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+
+
+def test_jobs_of_a_dead_worker_are_requeued_until_attempts_run_out(tmp_path):
+    queue = SQLiteJobQueue(str(tmp_path / "jobs.sqlite3"), max_attempts=2)
+    job_id, _ = queue.enqueue("url", {"update": {}}, chat_id=1)
+    alive_id, _ = queue.enqueue("url", {"update": {}}, chat_id=2)
+
+    assert queue.claim("w1", lease_seconds=-1).id == job_id
+    assert queue.claim("w2", lease_seconds=60).id == alive_id
+    assert queue.requeue_expired() == []
+    assert (_status(queue, job_id), _attempts(queue, job_id)) == ("queued", 1)
+    assert _status(queue, alive_id) == "running" # Its lease is still good
+
+    assert queue.claim("w3", lease_seconds=-1).id == job_id
+    given_up = queue.requeue_expired()
+    assert [(job.id, job.chat_id, job.attempts) for job in given_up] == [(job_id, 1, 2)]
+    assert _status(queue, job_id) == "failed"
+    assert queue.claim("w4", lease_seconds=60) is None
+
+
+def test_expired_cancelling_jobs_end_cancelled(tmp_path):
+    queue = SQLiteJobQueue(str(tmp_path / "jobs.sqlite3"))
+    job_id, _ = queue.enqueue("url", {"update": {}}, chat_id=1)
+    queue.claim("w1", lease_seconds=-1)
+    queue.cancel(1)
+    assert queue.requeue_expired() == []
+    assert _status(queue, job_id) == "cancelled"
+
+
+def test_release_hands_the_job_back_without_using_an_attempt(tmp_path):
+    queue = SQLiteJobQueue(str(tmp_path / "jobs.sqlite3"))
+    job_id, _ = queue.enqueue("url", {"update": {}}, chat_id=1)
+    queue.claim("w1", lease_seconds=60)
+    queue.release(job_id, "w2") # Not its job
+    assert _status(queue, job_id) == "running"
+    queue.release(job_id, "w1")
+    assert (_status(queue, job_id), _attempts(queue, job_id)) == ("queued", 0)
+    assert queue.claim("w2", lease_seconds=60).id == job_id
+
+
+def test_draining_worker_finishes_quick_jobs_and_releases_the_rest(tmp_path, monkeypatch):
+    worker = pytest.importorskip("worker")
+    queue = SQLiteJobQueue(str(tmp_path / "jobs.sqlite3"))
+    quick_id, _ = queue.enqueue("quick", {"update": {"update_id": 1}}, chat_id=1)
+    slow_id, _ = queue.enqueue("slow", {"update": {"update_id": 2}}, chat_id=1)
+    started = []
+
+    async def quick(update, context):
+        started.append("quick")
+        await asyncio.sleep(0.05)
+
+    async def slow(update, context):
+        started.append("slow")
+        await asyncio.sleep(60)
+
+    monkeypatch.setattr(worker, "HANDLERS", {"quick": quick, "slow": slow})
+    monkeypatch.setattr(worker, "DRAIN_TIMEOUT_SECONDS", 0.3)
+    monkeypatch.setattr(worker.Update, "de_json", staticmethod(lambda data, bot: SimpleNamespace(**data)))
+
+    async def run():
+        w = worker.Worker(queue, tg_bot=None, worker_id="w1", concurrency=2)
+        runner = asyncio.create_task(w.run())
+        while len(started) < 2:
+            await asyncio.sleep(0.01)
+        w.stopping.set()
+        await asyncio.wait_for(runner, timeout=5)
+        return w.stats()
+
+    stats = asyncio.run(run())
+    assert stats == {"running": 0, "completed": 1, "failed": 0, "cancelled": 0}
+    assert _status(queue, quick_id) == "done"
+    assert (_status(queue, slow_id), _attempts(queue, slow_id)) == ("queued", 0)
@@ -0,0 +1,141 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from media_cache import MediaCache, make_cache_key
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return MediaCache(str(tmp_path / "cache.sqlite3"), str(tmp_path / "cache"), max_bytes=10_000)
+
+
+def _write(path: str, size: int) -> str:
+    with open(path, "wb") as f:
+        f.write(b"\0" * size)
+    return path
+
+
+def test_file_id_round_trip_and_invalidation(cache):
+    key = make_cache_key("youtube", "abc", "p")
+    assert cache.get_file_id(key) is None
+    cache.put_file_id(key, "youtube", "abc", "p", "FILE1")
+    assert cache.get_file_id(key) == "FILE1"
+    cache.invalidate_file_id(key)
+    assert cache.get_file_id(key) is None
+    # A new upload replaces it.
+    cache.put_file_id(key, "youtube", "abc", "p", "FILE2")
+    assert cache.get_file_id(key) == "FILE2"
+
+
+def test_counters_move_on_hits_and_misses(cache, tmp_path):
+    cached = cache.put_local("k1", "ex", "v1", "p", _write(str(tmp_path / "v1.mp4"), 3000), source_size=9000)
+    cache.put_file_id("k1", "ex", "v1", "p", "FILE1")
+
+    assert cache.get_file_id("k1") == "FILE1"
+    assert cache.get_local("k1") == cached
+    cache.record_miss()
+    stats = cache.stats()
+    assert (stats["file_id_hits"], stats["local_hits"], stats["misses"]) == (1, 1, 1)
+    # A file_id hit saves the download and the upload, a local hit only the download.
+    assert stats["bytes_saved_download"] == 2 * 9000
+    assert stats["bytes_saved_upload"] == 3000
+    assert stats["hit_rate"] == pytest.approx(2 / 3)
+
+
+def test_lookups_that_do_not_count(cache, tmp_path):
+    cache.put_local("k1", "ex", "v1", "p", _write(str(tmp_path / "v1.mp4"), 3000))
+    cache.put_file_id("k1", "ex", "v1", "p", "FILE1")
+    assert cache.get_file_id("k1", count_hit=False) == "FILE1"
+    assert cache.get_local("k1", count_hit=False)
+    assert cache.get_file_id("unknown") is None
+    stats = cache.stats()
+    assert (stats["file_id_hits"], stats["local_hits"], stats["misses"], stats["bytes_saved_download"]) == (0, 0, 0, 0)
+
+
+def test_missing_local_file_is_forgotten_but_file_id_kept(cache, tmp_path):
+    cached = cache.put_local("k1", "ex", "v1", "p", _write(str(tmp_path / "v1.mp4"), 3000))
+    cache.put_file_id("k1", "ex", "v1", "p", "FILE1")
+    os.remove(cached)
+    assert cache.get_local("k1") is None
+    assert cache.get_file_id("k1") == "FILE1"
+    assert cache.stats()["local_files"] == 0
+
+
+class Chat:
+    # A private chat as the handlers see it: replies are recorded, sent videos get a new file_id.
+    def __init__(self, reject_file_ids: bool = False):
+        self.reject_file_ids = reject_file_ids
+        self.videos = []
+        self.texts = []
+
+    async def reply_text(self, text, **kwargs):
+        self.texts.append(text)
+        return SimpleNamespace(chat_id=5, message_id=len(self.texts), text=text, caption=None, reply_markup=None, edit_text=self.edit_text)
+
+    async def edit_text(self, text, **kwargs):
+        self.texts.append(text)
+
+    async def reply_video(self, video, **kwargs):
+        if isinstance(video, str):
+            if self.reject_file_ids:
+                raise RuntimeError("Wrong file identifier")
+            self.videos.append(video)
+        else:
+            self.videos.append("upload")
+        return SimpleNamespace(video=SimpleNamespace(file_id="FILE2"), document=None, animation=None)
+
+
+@pytest.fixture
+def handler(tmp_path, monkeypatch, cache):
+    bot = pytest.importorskip("bot")
+    from scheduler import JobScheduler
+    from storage import ArtifactStore
+
+    class Dispatcher:
+        def update(self, chat_id, message_id, text):
+            pass
+
+        async def forget(self, chat_id, message_id):
+            pass
+
+    def no_work(*args, **kwargs):
+        raise AssertionError("cached media must not be downloaded or encoded again")
+
+    monkeypatch.setattr(bot, "media_cache", cache)
+    monkeypatch.setattr(bot, "artifact_store", ArtifactStore(str(tmp_path / "storage.sqlite3"), str(tmp_path), 0, 0))
+    monkeypatch.setattr(bot, "progress_dispatcher", Dispatcher())
+    monkeypatch.setattr(bot, "identify_url", lambda url: ("youtube", "abc"))
+    for name in ("_blocking_expand_url", "_blocking_download_video", "_blocking_reencode_video", "_blocking_stream_and_transcode"):
+        monkeypatch.setattr(bot, name, no_work)
+
+    def send(chat: Chat):
+        async def run():
+            monkeypatch.setattr(bot, "scheduler", JobScheduler(1, 1, 1, 1))
+            message = SimpleNamespace(text="https://www.youtube.com/watch?v=abc", reply_text=chat.reply_text, reply_video=chat.reply_video)
+            update = SimpleNamespace(message=message, effective_chat=SimpleNamespace(id=5), effective_user=SimpleNamespace(id=7))
+            await bot.handle_url_message(update, SimpleNamespace(args=[]))
+        asyncio.run(run())
+    return SimpleNamespace(send=send, key=make_cache_key("youtube", "abc", bot.CACHE_FORMAT_PROFILE))
+
+
+def test_file_id_hit_skips_download_encode_and_upload(handler, cache):
+    cache.put_file_id(handler.key, "youtube", "abc", "p", "FILE1")
+    chat = Chat()
+    handler.send(chat)
+    assert chat.videos == ["FILE1"]
+    assert chat.texts[-1] == "Served from cache."
+    assert cache.stats()["file_id_hits"] == 1
+
+
+def test_rejected_file_id_is_dropped_and_the_local_copy_sent(handler, cache, tmp_path):
+    cache.put_local(handler.key, "youtube", "abc", "p", _write(str(tmp_path / "abc_telegram.mp4"), 3000))
+    cache.put_file_id(handler.key, "youtube", "abc", "p", "FILE1")
+    chat = Chat(reject_file_ids=True)
+    handler.send(chat)
+    # Uploaded from the cached file, and the upload's file_id replaces the rejected one.
+    assert chat.videos == ["upload"]
+    assert cache.get_file_id(handler.key, count_hit=False) == "FILE2"
+    assert cache.stats()["local_hits"] == 1
@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import urllib.request
+
+import pytest
+
+import metrics
+from metrics import Counter, Gauge, Histogram, TraceIdFilter, traced, trace_id
+from scheduler import StagePool
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    # A registry of its own, so the bot's metrics don't show up in the output.
+    monkeypatch.setattr(metrics, "_registry", [])
+    monkeypatch.setattr(metrics, "_collectors", [])
+
+
+def test_exposition_format(registry):
+    requests = Counter("test_requests_total", "Requests.", ("method", "status"))
+    queued = Gauge("test_queued", "Queued jobs.")
+    latency = Histogram("test_latency_seconds", "Latency.", ("stage",), buckets=(0.5, 1, 5))
+    requests.inc(method="sendVideo", status="200")
+    requests.inc(2, method="sendVideo", status="200")
+    requests.inc(method='odd"name\\', status="400")
+    metrics.add_collector(lambda: queued.set(3))
+    for value in (0.2, 0.7, 3, 8):
+        latency.observe(value, stage="encode")
+
+    assert metrics.render().splitlines() == [
+        "# HELP test_requests_total Requests.",
+        "# TYPE test_requests_total counter",
+        'test_requests_total{method="odd\\"name\\\\",status="400"} 1',
+        'test_requests_total{method="sendVideo",status="200"} 3',
+        "# HELP test_queued Queued jobs.",
+        "# TYPE test_queued gauge",
+        "test_queued 3",
+        "# HELP test_latency_seconds Latency.",
+        "# TYPE test_latency_seconds histogram",
+        # Buckets are cumulative, and +Inf equals the count.
+        'test_latency_seconds_bucket{stage="encode",le="0.5"} 1',
+        'test_latency_seconds_bucket{stage="encode",le="1"} 2',
+        'test_latency_seconds_bucket{stage="encode",le="5"} 3',
+        'test_latency_seconds_bucket{stage="encode",le="+Inf"} 4',
+        'test_latency_seconds_sum{stage="encode"} 11.9',
+        'test_latency_seconds_count{stage="encode"} 4',
+    ]
+
+
+def test_scrape_over_http(registry):
+    Counter("test_scrapes_total", "Scrapes.").inc()
+
+    async def scrape():
+        server = metrics.serve("127.0.0.1", 0, asyncio.get_running_loop())
+        try:
+            url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+            return await asyncio.to_thread(lambda: urllib.request.urlopen(url, timeout=5).read().decode())
+        finally:
+            server.shutdown()
+
+    assert "test_scrapes_total 1" in asyncio.run(scrape()).splitlines()
+
+
+class Records(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.addFilter(TraceIdFilter())
+        self.records = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.records.append(record)
+
+
+def test_handler_and_its_worker_threads_log_the_same_trace_id():
+    log = logging.getLogger("test_trace")
+    records = Records()
+    log.addHandler(records)
+    log.setLevel(logging.INFO)
+    pool = StagePool("test", 1)
+
+    @traced("test")
+    async def handler(name: str):
+        log.info(f"{name} on the loop")
+        await pool.run(1, log.info, f"{name} in a worker thread")
+
+    async def run():
+        await asyncio.gather(handler("first"), handler("second"))
+
+    try:
+        asyncio.run(run())
+    finally:
+        log.removeHandler(records)
+        pool.executor.shutdown()
+    by_request = {}
+    for record in records.records:
+        by_request.setdefault(record.getMessage().split()[0], set()).add(record.trace_id)
+    assert len(by_request["first"]) == len(by_request["second"]) == 1
+    assert by_request["first"] != by_request["second"]
+    assert trace_id.get() not in by_request["first"] | by_request["second"]
@@ -0,0 +1,115 @@
+import copy
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import pytest
+
+bot = pytest.importorskip("bot")
+from ytdl import yt_dlp
+
+URL = "https://media.example/watch/clip"
+MB = 1024 * 1024
+
+
+def _format(format_id: str, vcodec: str, acodec: str, size: int, width: int | None = None, height: int | None = None, **extra) -> dict:
+    return {
+        "format_id": format_id, "url": f"https://cdn.example/{format_id}", "ext": "mp4" if vcodec != "none" else "m4a",
+        "vcodec": vcodec, "acodec": acodec, "width": width, "height": height, "filesize": size, **extra,
+    }
+
+
+def _raw_info(formats: list[dict]) -> dict:
+    # What an extractor returns, before yt-dlp has selected anything.
+    return {
+        "id": "clip", "title": "Clip", "duration": 60, "formats": formats,
+        "extractor": "example", "extractor_key": "Example", "webpage_url": URL, "original_url": URL,
+    }
+
+
+# bestvideo+bestaudio picks the 1080p pair; the preflight prefers the muxed 720p H.264/AAC format.
+MERGE_BY_DEFAULT = [
+    _format("a", "none", "mp4a.40.2", 2 * MB, abr=128),
+    _format("m720", "avc1.64001f", "mp4a.40.2", 20 * MB, 1280, 720),
+    _format("v1080", "avc1.640028", "none", 50 * MB, 1920, 1080),
+]
+
+
+@pytest.fixture
+def ydl(monkeypatch):
+    monkeypatch.setattr(bot, "metadata_cache", bot.MetadataCache(600))
+    with yt_dlp.YoutubeDL({**bot._ydl_params(), "logger": None, "quiet": True}) as instance:
+        yield instance
+
+
+@pytest.fixture
+def site(ydl, monkeypatch):
+    # Stands in for the extractor: extract_info returns the raw result, processed unless process=False.
+    extractions = []
+
+    def serve(formats: list[dict]) -> list:
+        def extract_info(url, download=True, ie_key=None, extra_info=None, process=True, **kwargs):
+            extractions.append(url)
+            info = _raw_info(copy.deepcopy(formats))
+            return ydl.process_ie_result(info, download) if process else info
+        monkeypatch.setattr(ydl, "extract_info", extract_info)
+        return extractions
+    return serve
+
+
+def test_preflight_choice_replaces_the_default_selection(ydl, site):
+    extractions = site(MERGE_BY_DEFAULT)
+    for _ in range(2):
+        info = ydl.process_ie_result(bot._preflight(ydl, URL), download=False)
+        assert info["format_id"] == "m720"
+        assert "requested_formats" not in info
+        assert info["url"] == "https://cdn.example/m720"
+    # The second run used the metadata cache.
+    assert extractions == [URL]
+
+
+def test_preflight_logs_what_the_default_would_have_fetched(ydl, site, caplog):
+    site(MERGE_BY_DEFAULT)
+    with caplog.at_level("INFO", logger="bot"):
+        bot._preflight(ydl, URL)
+    line = next(record.getMessage() for record in caplog.records if "Preflight format" in record.getMessage())
+    assert "expected 20.00MiB vs default 52.00MiB, saved 32.00MiB" in line
+
+
+def test_without_a_choice_the_default_selection_applies(ydl, site):
+    site([_format("v1080", "avc1.640028", "none", 50 * MB, 1920, 1080), _format("a", "none", "mp4a.40.2", 2 * MB, abr=128)])
+    info = ydl.process_ie_result(bot._preflight(ydl, URL, audio_only=True), download=False)
+    assert info["format_id"] == "a"
+    info = ydl.process_ie_result(bot._preflight(ydl, URL), download=False)
+    assert info["format_id"] == "v1080+a"
+
+
+def test_streaming_sees_the_chosen_format(ydl, site):
+    site(MERGE_BY_DEFAULT)
+    assert bot._is_streamable(ydl.process_ie_result(bot._preflight(ydl, URL), download=False))
+
+
+def test_merges_and_fragmented_streams_are_not_streamed(ydl, site, monkeypatch):
+    # A choice that needs a merge, or a fragmented protocol, goes through yt-dlp's own downloaders.
+    monkeypatch.setattr(bot, "LOCAL_SAVE_LIMIT_MB", 30)
+    site([_format("a", "none", "mp4a.40.2", 2 * MB, abr=128), _format("v720", "avc1.64001f", "none", 20 * MB, 1280, 720)])
+    info = ydl.process_ie_result(bot._preflight(ydl, URL), download=False)
+    assert info["format_id"] == "v720+a"
+    assert not bot._is_streamable(info)
+
+    monkeypatch.setattr(bot, "metadata_cache", bot.MetadataCache(600))
+    site([_format("hls720", "avc1.64001f", "mp4a.40.2", 20 * MB, 1280, 720, protocol="m3u8_native")])
+    assert not bot._is_streamable(ydl.process_ie_result(bot._preflight(ydl, URL), download=False))
+
+
+def test_expanded_single_video_keeps_the_preflight_choice(ydl, site, monkeypatch):
+    @contextmanager
+    def checkout(progress_hook=None, **params):
+        yield ydl
+    monkeypatch.setattr(bot, "ytdl_pool", SimpleNamespace(checkout=checkout))
+    extractions = site(MERGE_BY_DEFAULT)
+
+    assert bot._blocking_expand_url(URL) is None
+    info = ydl.process_ie_result(bot._preflight(ydl, URL), download=False)
+    assert info["format_id"] == "m720"
+    assert "requested_formats" not in info
+    assert extractions == [URL]
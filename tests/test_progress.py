@@ -0,0 +1,106 @@
+import asyncio
+import threading
+
+import progress
+from progress import BatchProgress, ProgressDispatcher
+
+
+class SlowBot:
+    # Records the text of each message in the order Telegram would apply the edits.
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.texts: dict[tuple[int, int], str] = {}
+        self.started: list[str] = []
+
+    async def edit_message_text(self, text: str, chat_id: int, message_id: int) -> None:
+        self.started.append(text)
+        await asyncio.sleep(self.delay)
+        self.texts[(chat_id, message_id)] = text
+
+
+async def _until(condition, timeout: float = 2.0) -> None:
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline
+        await asyncio.sleep(0.01)
+
+
+def test_final_text_is_not_overwritten_by_an_edit_in_flight():
+    async def scenario():
+        bot = SlowBot(delay=0.2)
+        dispatcher = ProgressDispatcher(bot)
+        dispatcher.start()
+        batch = BatchProgress(dispatcher, 1, 10, 2)
+        batch.set(0, "downloading")
+        await _until(lambda: bot.started)
+        batch.set(0, "sent")
+
+        await dispatcher.forget(1, 10)
+        await bot.edit_message_text("Batch finished", 1, 10)
+        await asyncio.sleep(0.3)
+        await dispatcher.stop()
+        return bot, dispatcher
+
+    bot, dispatcher = asyncio.run(scenario())
+    assert bot.texts[(1, 10)] == "Batch finished"
+    # The queued update was dropped, and the one in flight was not put back.
+    assert bot.started == ["Batch of 2: 0 sent, 0 failed\n#1: downloading\n1 waiting", "Batch finished"]
+    assert dispatcher.stats()["in_flight"] == 0
+    assert dispatcher.stats()["pending"] == 0
+
+
+def test_forget_cancels_an_edit_that_hangs(monkeypatch):
+    monkeypatch.setattr(progress, "FORGET_WAIT_SECONDS", 0.05)
+
+    async def scenario():
+        bot = SlowBot(delay=60)
+        dispatcher = ProgressDispatcher(bot)
+        dispatcher.start()
+        dispatcher.update(1, 10, "Encoding: 5%")
+        await _until(lambda: bot.started)
+        await asyncio.wait_for(dispatcher.forget(1, 10), timeout=1)
+        stats = dispatcher.stats()
+        await dispatcher.stop()
+        return bot, stats
+
+    bot, stats = asyncio.run(scenario())
+    assert (1, 10) not in bot.texts
+    assert stats["in_flight"] == 0
+
+
+def test_one_edit_in_flight_per_message():
+    async def scenario():
+        bot = SlowBot(delay=0.1)
+        dispatcher = ProgressDispatcher(bot)
+        dispatcher.start()
+        # The chat's bucket is refilled by hand, so only the in-flight rule can hold the second edit back.
+        dispatcher.update(1, 10, "first")
+        await _until(lambda: bot.started)
+        dispatcher._chat_bucket(1).tokens = 1
+        dispatcher.update(1, 10, "second")
+        await asyncio.sleep(0.05)
+        in_flight_while_first_runs = list(bot.started)
+        await _until(lambda: bot.texts.get((1, 10)) == "second")
+        await dispatcher.stop()
+        return in_flight_while_first_runs
+
+    assert asyncio.run(scenario()) == ["first"]
+
+
+def test_updates_made_just_before_forget_are_dropped():
+    async def scenario():
+        bot = SlowBot(delay=0)
+        dispatcher = ProgressDispatcher(bot)
+        dispatcher.start()
+        batch = BatchProgress(dispatcher, 1, 10, 2)
+        worker = threading.Thread(target=batch.set, args=(0, "encoding"))
+        worker.start()
+        worker.join()
+        batch.set(1, "sent")
+        await dispatcher.forget(1, 10)
+        await bot.edit_message_text("Batch finished", 1, 10)
+        await asyncio.sleep(0.1)
+        await dispatcher.stop()
+        return bot.texts[(1, 10)]
+
+    assert asyncio.run(scenario()) == "Batch finished"
@@ -0,0 +1,107 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from progress import ProgressDispatcher
+from scheduler import JobScheduler, StagePool
+
+
+def test_waiters_hear_when_their_position_changes():
+    async def scenario():
+        pool = StagePool("test", 1, use_threads=False)
+        reports: dict[str, list[int]] = {"b": [], "c": []}
+        release = {name: asyncio.Event() for name in "abc"}
+
+        async def job(name: str, chat_id: int):
+            async def on_wait(position):
+                reports[name].append(position)
+            async with pool.slot(chat_id, on_wait):
+                await release[name].wait()
+
+        tasks = [asyncio.create_task(job(name, chat_id)) for name, chat_id in (("a", 1), ("b", 2), ("c", 3))]
+        for name in "abc":
+            await asyncio.sleep(0.05)
+            release[name].set()
+        await asyncio.gather(*tasks)
+        return reports
+
+    reports = asyncio.run(scenario())
+    assert reports["b"] == [1]
+    assert reports["c"] == [2, 1]
+
+
+def test_idle_users_are_forgotten():
+    async def scenario():
+        jobs = JobScheduler(1, 1, 1, per_user_jobs=1)
+        waits = []
+
+        async def job(user_id: int):
+            async def on_wait(position):
+                waits.append(user_id)
+            async with jobs.job(user_id, on_wait):
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(*(job(user_id) for user_id in (1, 1, 2)))
+        jobs.shutdown()
+        return jobs, waits
+
+    jobs, waits = asyncio.run(scenario())
+    assert waits == [1]
+    assert not jobs._user_slots and not jobs._user_jobs and not jobs._user_active
+
+
+def test_cancelled_run_holds_the_slot_until_the_thread_is_done():
+    async def scenario():
+        pool = StagePool("test", 1)
+        finish = threading.Event()
+        caller = asyncio.create_task(pool.run(1, finish.wait))
+        await asyncio.sleep(0.05)
+        caller.cancel()
+        await asyncio.gather(caller, return_exceptions=True)
+        busy_after_cancel = pool.active
+        finish.set()
+        await asyncio.sleep(0.05)
+        pool.executor.shutdown()
+        return busy_after_cancel, pool.active, pool.completed
+
+    assert asyncio.run(scenario()) == (1, 0, 1)
+
+
+def test_queue_notices_share_the_chats_edit_budget(monkeypatch):
+    bot = pytest.importorskip("bot")
+
+    class RecordingBot:
+        def __init__(self):
+            self.edits = []
+
+        async def edit_message_text(self, text: str, chat_id: int, message_id: int) -> None:
+            self.edits.append((message_id, text))
+
+    async def scenario():
+        telegram = RecordingBot()
+        dispatcher = ProgressDispatcher(telegram)
+        dispatcher.start()
+        monkeypatch.setattr(bot, "progress_dispatcher", dispatcher)
+        pool = StagePool("test", 1, use_threads=False)
+        release = asyncio.Event()
+
+        async def job(message_id: int):
+            message = SimpleNamespace(chat_id=1, message_id=message_id, text="status")
+            async with pool.slot(1, bot._queue_notifier(message, "download")):
+                await release.wait()
+
+        tasks = [asyncio.create_task(job(message_id)) for message_id in (10, 11, 12)]
+        dispatcher.update(1, 13, "Downloading: 5%")
+        await asyncio.sleep(0.3)
+        sent, stats = list(telegram.edits), dispatcher.stats()
+        release.set()
+        await asyncio.gather(*tasks)
+        await dispatcher.stop()
+        return sent, stats
+
+    sent, stats = asyncio.run(scenario())
+    # Two queue notices and a progress edit for one private chat: one edit goes out, the rest wait their turn.
+    assert len(sent) == 1
+    assert stats["pending"] == 2
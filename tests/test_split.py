@@ -0,0 +1,119 @@
+import asyncio
+import os
+import shutil
+import subprocess
+import time
+from types import SimpleNamespace
+
+import pytest
+
+bot = pytest.importorskip("bot")
+import transcode
+from progress import BatchProgress
+from scheduler import JobScheduler
+
+pytestmark = pytest.mark.skipif(not (shutil.which("ffmpeg") and shutil.which("ffprobe")), reason="needs ffmpeg and ffprobe")
+
+
+@pytest.fixture(scope="module")
+def long_video(tmp_path_factory):
+    # 60s with a keyframe every second, about 15 MB: 2 MB parts give a couple of media groups.
+    path = str(tmp_path_factory.mktemp("media") / "long.mp4")
+    subprocess.run(
+        ["ffmpeg", "-loglevel", "error", "-f", "lavfi", "-i", "testsrc2=size=320x240:rate=25", "-f", "lavfi", "-i", "sine",
+         "-t", "60", "-c:v", "libx264", "-preset", "ultrafast", "-g", "25", "-b:v", "2M", "-c:a", "aac", "-shortest", path],
+        check=True,
+    )
+    return path
+
+
+class StatusMessage:
+    chat_id = 5
+    message_id = 7
+    text = "status"
+
+    def __init__(self, fail: bool):
+        self.fail = fail
+        self.groups = 0
+
+    async def reply_media_group(self, media, **kwargs):
+        self.groups += 1
+        if self.fail:
+            raise RuntimeError("Request Entity Too Large")
+
+    async def reply_document(self, **kwargs):
+        pass
+
+
+class Dispatcher:
+    def __init__(self):
+        self.texts = []
+
+    def update(self, chat_id, message_id, text):
+        self.texts.append(text)
+
+    update_threadsafe = update
+
+    async def forget(self, chat_id, message_id):
+        self.texts.append("<forget>")
+
+
+@pytest.fixture
+def delivery(long_video, tmp_path, monkeypatch):
+    cut = []
+
+    def slow_disk_split(input_filepath, output_prefix, max_bytes, on_segment):
+        def on_part(part):
+            cut.append(part)
+            time.sleep(0.05)
+            on_segment(part)
+        return transcode.split_media(input_filepath, output_prefix, max_bytes, on_part)
+
+    monkeypatch.setattr(bot, "split_media", slow_disk_split)
+    monkeypatch.setattr(bot, "DOWNLOAD_DIR", str(tmp_path))
+    monkeypatch.setattr(bot, "LOCAL_SAVE_LIMIT_MB", 2)
+    monkeypatch.setattr(bot, "SPLIT_OVERSIZED", True)
+    monkeypatch.setattr(bot, "gofile_uploader", None)
+    monkeypatch.setattr(bot, "progress_dispatcher", Dispatcher())
+    source = str(tmp_path / "source.mp4")
+    shutil.copy(long_video, source)
+
+    def deliver(status_message, report=None) -> str:
+        async def run():
+            monkeypatch.setattr(bot, "scheduler", JobScheduler(1, 1, 1, 1))
+            return await bot._deliver_oversized(status_message, source, os.path.getsize(source) / (1024 * 1024), report)
+        return asyncio.run(run())
+    return SimpleNamespace(deliver=deliver, cut=cut, dir=tmp_path)
+
+
+def _parts_left(directory) -> list[str]:
+    return [name for name in os.listdir(directory) if "_part" in name]
+
+
+def test_parts_are_sent_in_media_groups(delivery):
+    status_message = StatusMessage(fail=False)
+    text = delivery.deliver(status_message)
+    assert f"sent in {len(delivery.cut)} parts" in text
+    assert status_message.groups == -(-len(delivery.cut) // bot.MEDIA_GROUP_SIZE)
+    assert delivery.cut and not _parts_left(delivery.dir)
+
+
+def test_failed_send_stops_the_split(delivery):
+    status_message = StatusMessage(fail=True)
+    text = delivery.deliver(status_message)
+    assert "File saved to local storage" in text
+    assert status_message.groups == 1
+    # Cutting stopped soon after the first group was refused instead of running to the end of the file.
+    assert len(delivery.cut) < 2 * bot.MEDIA_GROUP_SIZE
+    assert not _parts_left(delivery.dir)
+    first, last = bot.progress_dispatcher.texts
+    assert first.startswith("Sending parts 1-") and last == "<forget>"
+
+
+def test_batch_item_reports_through_the_batch_status(delivery):
+    batch = BatchProgress(bot.progress_dispatcher, 5, 7, 2)
+    delivery.deliver(StatusMessage(fail=False), lambda text: batch.set(0, text))
+    # Every text is the batch's own rendering, and the shared message is left to the batch to finish.
+    assert bot.progress_dispatcher.texts
+    assert all(text.startswith("Batch of 2:") for text in bot.progress_dispatcher.texts)
+    assert "#1: Sending parts 1-" in bot.progress_dispatcher.texts[0]
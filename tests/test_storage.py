@@ -0,0 +1,73 @@
+import os
+import sqlite3
+import time
+
+from media_cache import MediaCache
+from storage import CACHED_KIND, ArtifactStore
+
+
+def _write(path: str, size: int) -> str:
+    with open(path, "wb") as f:
+        f.write(b"\0" * size)
+    return path
+
+
+def _age(store: ArtifactStore, artifact_id: str, seconds: float) -> None:
+    with store._conn:
+        store._conn.execute("UPDATE artifacts SET last_access = ? WHERE id = ?", (time.time() - seconds, artifact_id))
+
+
+def test_store_leaves_cached_files_to_the_media_cache(tmp_path):
+    cache_dir = tmp_path / "cache"
+    store = ArtifactStore(str(tmp_path / "storage.sqlite3"), str(tmp_path), quota_bytes=1000, ttl_seconds=60)
+    cache = MediaCache(str(tmp_path / "cache.sqlite3"), str(cache_dir), max_bytes=10_000, in_use=store.is_leased)
+    cached = cache.put_local("k1", "ex", "v1", "p", _write(str(tmp_path / "v1.mp4"), 3000))
+    cached_id = store.register(cached, CACHED_KIND)
+    reencode_id = store.register(_write(str(tmp_path / "other.mp4"), 500), "reencode")
+    _age(store, cached_id, 3600)
+
+    # Past the TTL and, counted together, over the quota: the store still leaves the cached file alone.
+    assert store.enforce() == 0
+    assert os.path.exists(cached)
+    assert store.get(reencode_id)
+    assert store.stats()["bytes"] == 500
+    assert store.stats()["bytes_by_kind"][CACHED_KIND] == 3000
+
+
+def test_media_cache_skips_leased_files(tmp_path):
+    store = ArtifactStore(str(tmp_path / "storage.sqlite3"), str(tmp_path), quota_bytes=10_000, ttl_seconds=60)
+    cache = MediaCache(str(tmp_path / "cache.sqlite3"), str(tmp_path / "cache"), max_bytes=5000, in_use=store.is_leased)
+    first = cache.put_local("k1", "ex", "v1", "p", _write(str(tmp_path / "v1.mp4"), 3000))
+    second = cache.put_local("k2", "ex", "v2", "p", _write(str(tmp_path / "v2.mp4"), 1000))
+
+    with store.lease(store.register(first, CACHED_KIND)):
+        cache.put_local("k3", "ex", "v3", "p", _write(str(tmp_path / "v3.mp4"), 2000))
+        # The least recently used file is being uploaded, so the next one goes instead.
+        assert os.path.exists(first)
+        assert not os.path.exists(second)
+
+    cache.put_local("k4", "ex", "v4", "p", _write(str(tmp_path / "v4.mp4"), 1000))
+    assert not os.path.exists(first)
+    assert cache.get_local("k1") is None
+
+
+def test_retag_adopts_cache_files_registered_as_reencodes(tmp_path):
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    store = ArtifactStore(str(tmp_path / "storage.sqlite3"), str(tmp_path), quota_bytes=0, ttl_seconds=60)
+    cached_id = store.register(_write(str(cache_dir / "k1.mp4"), 100), "reencode")
+    other_id = store.register(_write(str(tmp_path / "cache-like.mp4"), 100), "reencode")
+
+    assert store.retag(str(cache_dir), CACHED_KIND) == 1
+    store.enforce()
+    assert store.get(cached_id)
+    assert store.get(other_id) is None
+
+
+def test_sqlite_stores_use_wal(tmp_path):
+    ArtifactStore(str(tmp_path / "storage.sqlite3"), str(tmp_path), quota_bytes=1000, ttl_seconds=60)
+    MediaCache(str(tmp_path / "cache.sqlite3"), str(tmp_path / "cache"), max_bytes=1000)
+    for name in ("storage.sqlite3", "cache.sqlite3"):
+        conn = sqlite3.connect(str(tmp_path / name))
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        conn.close()
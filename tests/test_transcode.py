@@ -0,0 +1,195 @@
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+import pytest
+
+import transcode
+from metrics import trace_id
+from transcode import EncodeAbandoned, EncodeSettings, FFmpegRunner, run_ffmpeg, runner, wait_ffmpeg
+
+needs_ffmpeg = pytest.mark.skipif(not (shutil.which("ffmpeg") and shutil.which("ffprobe")), reason="needs ffmpeg and ffprobe")
+
+
+def _open_fds() -> int:
+    return len(os.listdir("/proc/self/fd"))
+
+
+def _encode(seconds: int) -> list[str]:
+    return ["ffmpeg", "-loglevel", "error", "-f", "lavfi", "-i", "testsrc2=size=320x240:rate=25", "-t", str(seconds), "-f", "null", "-"]
+
+
+@needs_ffmpeg
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="needs /proc")
+def test_pipes_are_closed_whatever_happens_to_ffmpeg():
+    run_ffmpeg(_encode(1), duration=1)
+    before = _open_fds()
+    run_ffmpeg(_encode(1), duration=1)
+    with pytest.raises(RuntimeError):
+        run_ffmpeg(_encode(30), duration=30, on_progress=lambda fraction, speed: (_ for _ in ()).throw(RuntimeError("stop")))
+    # ffmpeg that stops reading its input halfway through what we write.
+    with runner.popen(["ffmpeg", "-loglevel", "quiet", "-f", "rawvideo", "-s", "2x2", "-i", "pipe:0", "-frames:v", "1", "-f", "null", "-"],
+                      stdin=subprocess.PIPE, stdout=subprocess.DEVNULL) as process:
+        with pytest.raises(BrokenPipeError):
+            for _ in range(1000):
+                process.stdin.write(b"\0" * 65536)
+        wait_ffmpeg(process, time.monotonic())
+    assert _open_fds() == before
+
+
+@needs_ffmpeg
+def test_abandon_kills_the_requests_ffmpeg():
+    local = FFmpegRunner()
+    started = threading.Event()
+    outcome = {}
+
+    def encode():
+        trace_id.set("req-1")
+        with local.popen(_encode(60), stdout=subprocess.DEVNULL) as process:
+            started.set()
+            try:
+                local.reap(process)
+            finally:
+                outcome["killed"] = local.was_killed(process)
+
+    thread = threading.Thread(target=encode)
+    thread.start()
+    started.wait()
+    assert local.abandon("req-1") == 1
+    thread.join(timeout=10)
+    assert outcome == {"killed": True}
+    assert local.stats()["running"] == 0 and local.killed == 1
+    # Nothing new starts for the abandoned request.
+    token = trace_id.set("req-1")
+    try:
+        with pytest.raises(EncodeAbandoned):
+            with local.popen(["ffmpeg", "-version"], stdout=subprocess.DEVNULL):
+                pass
+    finally:
+        trace_id.reset(token)
+
+
+def _settings(cores: int, active: int, queued: int, size: int, **kwargs) -> EncodeSettings:
+    local = FFmpegRunner()
+    local.configure(cores, lambda: (active, queued, size), **kwargs)
+    return local.settings()
+
+
+@pytest.mark.parametrize("cores, active, queued, size, threads, load_level", [
+    (8, 0, 0, 4, 8, 0), # First encode of an idle pool gets every core
+    (8, 2, 0, 4, 4, 0),
+    (8, 3, 1, 4, 2, 1), # The pool is about to fill up: share as if it were full
+    (8, 4, 2, 4, 2, 1),
+    (8, 4, 4, 4, 2, 2), # A full pool's worth queued
+    (8, 4, 9, 4, 2, 2),
+    (3, 4, 0, 4, 1, 0), # Fewer cores than encodes: one thread each, never zero
+])
+def test_thread_share_and_load_level(cores, active, queued, size, threads, load_level):
+    assert _settings(cores, active, queued, size) == EncodeSettings(threads, load_level)
+
+
+def test_budget_and_presets_switch_off_separately():
+    assert _settings(8, 2, 4, 4, share_threads=False) == EncodeSettings(None, 2)
+    assert _settings(8, 2, 4, 4, adaptive_presets=False) == EncodeSettings(2, 0)
+    assert FFmpegRunner().settings() == EncodeSettings()
+    assert EncodeSettings().thread_args() == []
+    assert EncodeSettings(3).thread_args() == ["-threads", "3"]
+
+
+@pytest.mark.parametrize("quality_preset, load_level, preset", [
+    ("fast", 0, "fast"),
+    ("fast", 1, "veryfast"),
+    ("fast", 2, "superfast"),
+    ("medium", 1, "faster"),
+    ("medium", 2, "superfast"),
+    ("veryfast", 2, "superfast"), # Floored at superfast
+    ("ultrafast", 2, "ultrafast"), # Already faster than the floor: left alone
+])
+def test_presets_step_faster_under_load(quality_preset, load_level, preset):
+    assert EncodeSettings(load_level=load_level).preset(quality_preset) == preset
+
+
+MB = 1024 * 1024
+
+
+def _probe(video: str | None = "h264", width: int = 1280, height: int = 720, audio: str | None = "aac", audio_kbps: int | None = 128,
+           format_name: str = "mov,mp4,m4a,3gp,3g2,mj2", duration: float | None = 100.0, pix_fmt: str = "yuv420p") -> dict:
+    # Shaped like `ffprobe -show_format -show_streams -of json`, with only the fields the planner reads.
+    streams = []
+    if video:
+        streams.append({"codec_type": "video", "codec_name": video, "width": width, "height": height, "pix_fmt": pix_fmt})
+    if audio:
+        stream = {"codec_type": "audio", "codec_name": audio}
+        if audio_kbps:
+            stream["bit_rate"] = str(audio_kbps * 1000)
+        streams.append(stream)
+    fmt = {"format_name": format_name}
+    if duration:
+        fmt["duration"] = str(duration)
+    return {"streams": streams, "format": fmt}
+
+
+@pytest.mark.parametrize("probe, file_size, faststart, mode, copy_audio", [
+    (_probe(), 5 * MB, True, "none", False),
+    (_probe(), 5 * MB, False, "remux", False),
+    (_probe(format_name="matroska,webm"), 5 * MB, True, "remux", False),
+    (_probe(audio=None), 5 * MB, True, "none", False),
+    (_probe(audio="opus"), 5 * MB, True, "audio", False),
+    (_probe(audio="mp3"), 5 * MB, False, "audio", False),
+    (_probe(video=None, audio="aac"), 5 * MB, False, "remux", False),
+    (_probe(video=None, audio="opus"), 5 * MB, False, "audio", False),
+    (_probe(video="vp9", audio="opus"), 5 * MB, False, "encode", False),
+    (_probe(width=1920, height=1080), 5 * MB, True, "encode", True),
+    (_probe(width=720, height=1280), 5 * MB, True, "none", False), # Portrait 720p fits
+    (_probe(pix_fmt="yuv444p"), 5 * MB, True, "encode", True),
+    (_probe(), 20 * MB, True, "encode", True), # Copyable but over budget
+    (_probe(audio_kbps=256), 20 * MB, True, "encode", False), # Too rich to copy into a tight budget
+])
+def test_plan_mode(probe, file_size, faststart, mode, copy_audio):
+    plan = transcode.plan_transcode(probe, file_size, 10 * MB, faststart)
+    assert (plan.mode, plan.copy_audio) == (mode, copy_audio)
+
+
+@pytest.mark.parametrize("probe, video_kbps, width", [
+    # 10 MB over 100 s is 813 kbps after container overhead, minus the audio, spread over 102 s to leave room for the VBV buffer.
+    (_probe(width=1920, height=1080), 672, 1280), # AAC 128k copied
+    (_probe(video="vp9", audio="opus"), 734, 1280), # Opus re-encoded at AUDIO_KBPS
+    (_probe(video="vp9", audio=None), 797, 1280),
+    (_probe(video="vp9", duration=200), 276, 640), # Below LOW_RES_BELOW_KBPS: smaller picture
+    (_probe(video="vp9", duration=50), 1000, 1280), # Capped at MAX_VIDEO_KBPS
+    (_probe(video="vp9", duration=None), 1000, 1280), # Unknown duration: the quality ceiling
+])
+def test_encode_bitrate_fits_the_budget(probe, video_kbps, width):
+    plan = transcode.plan_transcode(probe, 50 * MB, 10 * MB)
+    assert (plan.mode, plan.video_kbps, plan.width) == ("encode", video_kbps, width)
+
+
+def test_falls_back_to_the_hard_limit_below_the_minimum_bitrate():
+    probe = _probe(video="vp9", duration=1000)
+    # 10 MB over 1000 s leaves 17 kbps of video, not worth it: aim for 50 MB instead.
+    assert transcode.plan_transcode(probe, 100 * MB, 10 * MB).video_kbps < transcode.MIN_VIDEO_KBPS
+    plan = transcode.plan_for_limits(probe, 100 * MB, False, 10 * MB, 50 * MB)
+    assert (plan.mode, plan.video_kbps, plan.width, plan.copy_audio) == ("encode", 278, 640, True)
+    # Plans that need no encode are never re-planned.
+    assert transcode.plan_for_limits(_probe(), 5 * MB, True, 10 * MB, 50 * MB).mode == "none"
+
+
+@needs_ffmpeg
+def test_encode_output_stays_under_the_budget(tmp_path):
+    # Noise is about the hardest thing to compress, so the source is far over the budget and x264's crf alone
+    # would not get it there; the -maxrate/-bufsize cap has to.
+    source = str(tmp_path / "noise.mp4")
+    subprocess.run(
+        ["ffmpeg", "-loglevel", "error", "-f", "lavfi", "-i", "testsrc2=size=1920x1080:rate=25", "-f", "lavfi", "-i", "sine",
+         "-t", "8", "-vf", "noise=alls=60:allf=t", "-c:v", "libx264", "-preset", "ultrafast", "-crf", "18",
+         "-c:a", "aac", "-b:a", "128k", "-shortest", source],
+        check=True,
+    )
+    max_bytes = 500 * 1024
+    plan = transcode.plan_transcode(transcode.probe_media(source), os.path.getsize(source), max_bytes)
+    assert plan.mode == "encode" and os.path.getsize(source) > 4 * max_bytes
+    output = str(tmp_path / "out.mp4")
+    run_ffmpeg(transcode.build_command(source, output, plan), duration=8)
+    assert os.path.getsize(output) <= max_bytes
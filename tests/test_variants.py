@@ -0,0 +1,169 @@
+import asyncio
+import os
+import shutil
+import subprocess
+from types import SimpleNamespace
+
+import pytest
+
+bot = pytest.importorskip("bot")
+import transcode
+from scheduler import JobScheduler
+from storage import ArtifactStore
+from transcode import EncodeSettings, TranscodePlan
+
+needs_ffmpeg = pytest.mark.skipif(not (shutil.which("ffmpeg") and shutil.which("ffprobe")), reason="needs ffmpeg and ffprobe")
+
+
+def _make_source(path: str, audio_codec: str | None = "libmp3lame", seconds: int = 3) -> str:
+    command = ["ffmpeg", "-loglevel", "error", "-f", "lavfi", "-i", "testsrc2=size=1920x1080:rate=25"]
+    if audio_codec:
+        command += ["-f", "lavfi", "-i", "sine", "-c:a", audio_codec, "-shortest"]
+    command += ["-t", str(seconds), "-c:v", "libx264", "-preset", "ultrafast", "-y", path]
+    subprocess.run(command, check=True)
+    return path
+
+
+def _codecs(path: str) -> list[str]:
+    return [stream["codec_name"] for stream in transcode.probe_media(path)["streams"]]
+
+
+def test_one_command_decodes_once_for_every_output():
+    settings = EncodeSettings(threads=2, load_level=1)
+    plan = TranscodePlan("encode", "test", width=1280, video_kbps=800)
+    command = transcode.build_multi_output_command("in.mkv", [
+        transcode.telegram_output_args("out_telegram.mp4", plan, settings),
+        transcode.conversion_output_args("mp3", "out_mp3.mp3", "mp3", settings),
+        transcode.conversion_output_args("mp4_low", "out_mp4_low.mp4", "mp3", settings),
+    ], settings)
+
+    assert command[:5] == ["ffmpeg", "-threads", "2", "-i", "in.mkv"]
+    assert command.count("-i") == 1
+    # Outputs follow in order, each closed by its own file name.
+    ends = [command.index(name) for name in ("out_telegram.mp4", "out_mp3.mp3", "out_mp4_low.mp4")]
+    assert ends == sorted(ends) and ends[-1] == len(command) - 1
+    mp3_args = command[ends[0] + 1:ends[1] + 1]
+    assert mp3_args == ["-map", "0:a:0", "-vn", "-c:a", "copy", "-y", "out_mp3.mp3"]
+    assert "veryfast" in command[:ends[0]] and "faster" in command[ends[1]:]
+
+
+def test_mp3_is_encoded_unless_the_source_already_is_mp3():
+    assert "copy" not in transcode.conversion_output_args("mp3", "out.mp3", "aac")
+    assert "copy" not in transcode.conversion_output_args("mp3", "out.mp3", None)
+    with pytest.raises(ValueError):
+        transcode.conversion_output_args("gif", "out.gif")
+
+
+@pytest.fixture
+def ffmpeg_runs(monkeypatch):
+    runs = []
+
+    def counting_run_ffmpeg(command, duration=None, on_progress=None):
+        runs.append(command)
+        return transcode.run_ffmpeg(command, duration, on_progress)
+
+    monkeypatch.setattr(bot, "run_ffmpeg", counting_run_ffmpeg)
+    return runs
+
+
+@needs_ffmpeg
+def test_telegram_mp4_and_both_variants_come_from_one_run(tmp_path, ffmpeg_runs):
+    source = _make_source(str(tmp_path / "clip.mkv"))
+    reencoded, size, variants = bot._blocking_reencode_video(source, None, ("mp3", "mp4_low"))
+
+    assert len(ffmpeg_runs) == 1
+    assert reencoded == str(tmp_path / "clip_telegram.mp4") and size == os.path.getsize(reencoded)
+    assert variants == {"mp3": str(tmp_path / "clip_mp3.mp3"), "mp4_low": str(tmp_path / "clip_mp4_low.mp4")}
+    assert _codecs(reencoded) == ["h264", "aac"]
+    # The MP3 stream was copied out of the source, not re-encoded.
+    assert _codecs(variants["mp3"]) == ["mp3"]
+    source_audio = transcode._first_stream(transcode.probe_media(source), "audio")
+    assert transcode._first_stream(transcode.probe_media(variants["mp3"]), "audio")["bit_rate"] == source_audio["bit_rate"]
+    low = transcode._first_stream(transcode.probe_media(variants["mp4_low"]), "video")
+    assert (low["width"], low["height"]) == (640, 360)
+
+
+@needs_ffmpeg
+def test_variants_are_skipped_without_audio_or_when_too_long(tmp_path, ffmpeg_runs, monkeypatch):
+    silent = _make_source(str(tmp_path / "silent.mkv"), audio_codec=None)
+    assert bot._blocking_reencode_video(silent, None, ("mp3", "mp4_low"))[2] == {}
+
+    monkeypatch.setattr(bot, "PREPARE_VARIANTS_MAX_SECONDS", 2)
+    long = _make_source(str(tmp_path / "long.mkv"))
+    assert bot._blocking_reencode_video(long, None, ("mp3", "mp4_low"))[2] == {}
+    assert not [name for name in os.listdir(tmp_path) if "_mp3" in name or "_mp4_low" in name]
+
+
+@needs_ffmpeg
+def test_failed_run_removes_every_output(tmp_path, monkeypatch):
+    source = _make_source(str(tmp_path / "clip.mkv"))
+
+    def failing_run_ffmpeg(command, duration=None, on_progress=None):
+        # ffmpeg got some way into every output before it failed.
+        for path in (str(tmp_path / "clip_telegram.mp4"), str(tmp_path / "clip_mp3.mp3"), str(tmp_path / "clip_mp4_low.mp4")):
+            open(path, "wb").close()
+        raise subprocess.CalledProcessError(1, command)
+
+    monkeypatch.setattr(bot, "run_ffmpeg", failing_run_ffmpeg)
+    with pytest.raises(subprocess.CalledProcessError):
+        bot._blocking_reencode_video(source, None, ("mp3", "mp4_low"))
+    assert os.listdir(tmp_path) == ["clip.mkv"]
+
+
+class ResultMessage:
+    chat_id = 5
+    message_id = 7
+    caption = None
+    reply_markup = None
+    text = "Here is your video"
+
+    def __init__(self):
+        self.documents = []
+        self.texts = []
+
+    async def reply_document(self, document, **kwargs):
+        self.documents.append(document.filename)
+
+    async def edit_text(self, text, **kwargs):
+        self.texts.append(text)
+
+
+class Dispatcher:
+    def update(self, chat_id, message_id, text):
+        pass
+
+    async def forget(self, chat_id, message_id):
+        pass
+
+
+def test_convert_button_sends_the_prepared_variant(tmp_path, monkeypatch):
+    original = str(tmp_path / "clip_telegram.mp4")
+    prepared = str(tmp_path / "clip_mp3.mp3")
+    for path in (original, prepared):
+        with open(path, "wb") as f:
+            f.write(b"\0" * 1000)
+    store = ArtifactStore(str(tmp_path / "storage.sqlite3"), str(tmp_path), quota_bytes=0, ttl_seconds=0)
+    artifact_id = store.register(original, "reencode", 1)
+    store.register(prepared, "conversion:mp3", 1, parent_id=artifact_id)
+
+    def no_ffmpeg(*args, **kwargs):
+        raise AssertionError("ffmpeg must not run for a prepared variant")
+
+    monkeypatch.setattr(bot, "artifact_store", store)
+    monkeypatch.setattr(bot, "progress_dispatcher", Dispatcher())
+    monkeypatch.setattr(bot, "run_ffmpeg", no_ffmpeg)
+    monkeypatch.setattr(bot, "_blocking_convert_media", no_ffmpeg)
+    message = ResultMessage()
+
+    async def press():
+        monkeypatch.setattr(bot, "scheduler", JobScheduler(1, 1, 1, 1))
+
+        async def answer():
+            pass
+        query = SimpleNamespace(data=f"mp3:{artifact_id}", message=message, from_user=SimpleNamespace(id=1), answer=answer)
+        update = SimpleNamespace(callback_query=query, effective_user=SimpleNamespace(id=1))
+        await bot.convert_media(update, SimpleNamespace())
+
+    asyncio.run(press())
+    assert message.documents == ["clip_mp3.mp3"]
+    assert message.texts == ["✅ Conversion to MP3 complete! New file sent."]
@@ -0,0 +1,118 @@
+import http.cookiejar
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+import ytdl
+from ytdl import LazyModule, YoutubeDLPool
+
+
+class StubYoutubeDL:
+    # Keeps what the pool touches: params, the progress hooks, the format selector and close().
+    def __init__(self, params: dict):
+        self.params = params
+        self.format_selector = ("default", params.get("format"))
+        self.cookiejar = None
+        self.hooks = []
+        self.closed = False
+
+    def add_progress_hook(self, hook) -> None:
+        self.hooks.append(hook)
+
+    def report(self, d: dict) -> None:
+        for hook in self.hooks:
+            hook(d)
+
+    def close(self) -> None:
+        self.closed = True
+
+
+@pytest.fixture
+def stub_ytdlp(monkeypatch):
+    monkeypatch.setattr(ytdl, "yt_dlp", SimpleNamespace(
+        YoutubeDL=StubYoutubeDL, cookies=SimpleNamespace(YoutubeDLCookieJar=http.cookiejar.MozillaCookieJar),
+    ))
+
+
+@pytest.fixture
+def pool(stub_ytdlp):
+    return YoutubeDLPool({"outtmpl": {"default": "%(id)s.%(ext)s", "chapter": "c"}, "format": "best", "playlistend": None}, size=1)
+
+
+def test_job_params_and_hooks_do_not_leak_into_the_next_checkout(pool):
+    seen = []
+    with pool.checkout(progress_hook=seen.append, outtmpl="job1/%(id)s.%(ext)s", playlistend=5) as ydl:
+        assert ydl.params["outtmpl"] == {"default": "job1/%(id)s.%(ext)s", "chapter": "c"}
+        assert ydl.params["playlistend"] == 5
+        ydl.format_selector = "chosen for job 1"
+        ydl.report({"status": "downloading"})
+    first = ydl
+
+    with pool.checkout() as ydl:
+        assert ydl is first
+        assert ydl.params["outtmpl"] == {"default": "%(id)s.%(ext)s", "chapter": "c"}
+        assert ydl.params["playlistend"] is None
+        assert ydl.format_selector == ("default", "best")
+        ydl.report({"status": "downloading"})
+    # Job 1's hook only heard job 1.
+    assert seen == [{"status": "downloading"}]
+    assert pool.stats()["reused"] == 1
+
+
+def test_concurrent_checkouts_get_their_own_instances(pool):
+    with pool.checkout(outtmpl="a") as first, pool.checkout(outtmpl="b") as second:
+        assert first is not second
+        assert (first.params["outtmpl"]["default"], second.params["outtmpl"]["default"]) == ("a", "b")
+    # The pool keeps `size` instances: the one given back last finds it full and is closed.
+    assert pool.stats()["idle"] == 1
+    assert first.closed and not second.closed
+
+
+def test_instances_retire_after_max_uses(pool, monkeypatch):
+    monkeypatch.setattr(ytdl, "MAX_USES", 3)
+    instances = []
+    for _ in range(4):
+        with pool.checkout() as ydl:
+            instances.append(ydl)
+    assert instances[0] is instances[1] is instances[2]
+    assert instances[0].closed
+    assert instances[3] is not instances[0]
+    assert pool.stats()["created"] == 2
+
+
+def _write_cookies(path: str, value: str) -> None:
+    with open(path, "w") as f:
+        f.write("# Netscape HTTP Cookie File\n")
+        f.write(f".example.com\tTRUE\t/\tFALSE\t2147483647\tsession\t{value}\n")
+
+
+def test_instances_share_one_cookie_jar_reloaded_when_the_file_changes(stub_ytdlp, tmp_path, monkeypatch):
+    cookie_file = str(tmp_path / "cookies.txt")
+    _write_cookies(cookie_file, "one")
+    pool = YoutubeDLPool({"outtmpl": {"default": "x"}}, size=2, cookie_file=cookie_file)
+    with pool.checkout() as first, pool.checkout() as second:
+        assert first.cookiejar is second.cookiejar
+        assert [cookie.value for cookie in first.cookiejar] == ["one"]
+
+    monkeypatch.setattr(ytdl, "COOKIE_CHECK_SECONDS", 0)
+    _write_cookies(cookie_file, "two-and-longer")
+    with pool.checkout() as ydl:
+        assert ydl.cookiejar is first.cookiejar
+        assert [cookie.value for cookie in ydl.cookiejar] == ["two-and-longer"]
+    assert pool.stats()["cookie_loads"] == 2
+
+    os.remove(cookie_file)
+    with pool.checkout() as ydl:
+        assert list(ydl.cookiejar) == []
+
+
+def test_lazy_module_imports_on_first_use(tmp_path, monkeypatch):
+    (tmp_path / "lazy_probe.py").write_text("VALUE = 42\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    module = LazyModule("lazy_probe")
+    assert "lazy_probe" not in sys.modules
+    assert module.VALUE == 42
+    assert "lazy_probe" in sys.modules
+    monkeypatch.delitem(sys.modules, "lazy_probe")
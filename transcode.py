@@ -0,0 +1,503 @@
+import glob
+import json
+import logging
+import os
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+from metrics import FFMPEG_CPU_SECONDS, FFMPEG_FAILURES, FFMPEG_KILLED, FFMPEG_LOAD_LEVELS, FFMPEG_SPEED, trace_id
+
+logger = logging.getLogger(__name__)
+
+MAX_WIDTH = 1280
+LOW_RES_WIDTH = 640
+MAX_SHORT_SIDE = 720
+MAX_VIDEO_KBPS = 1000 # Quality ceiling, same as the old fixed -maxrate
+LOW_RES_BELOW_KBPS = 500 # Below this a 1280px picture falls apart, drop to 640px instead
+MIN_VIDEO_KBPS = 150 # Below this the size budget is not worth hitting
+AUDIO_KBPS = 64
+MAX_COPY_AUDIO_KBPS = 160
+CONTAINER_OVERHEAD = 0.97
+VBV_BUFFER_SECONDS = 2 # x264 starts with this buffer nearly full and may spend it on top of -maxrate, so budget for it
+SEGMENT_HEADROOM = 0.85 # Segments can only end on a keyframe, so they run long; aim this far under the limit
+
+# Fastest first. Under load each encode moves PRESET_STEP places towards the front per load level, but not past
+# FASTEST_PRESET (ultrafast turns off CABAC and deblocking, which costs too much quality at our bitrates).
+X264_PRESETS = ("ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow", "slower", "veryslow")
+PRESET_STEP = 2
+FASTEST_PRESET = "superfast"
+ABANDONED_TTL = 3600
+
+COPYABLE_VIDEO_CODECS = {"h264"}
+COPYABLE_AUDIO_CODECS = {"aac"}
+COPYABLE_PIX_FMTS = {"yuv420p", "yuvj420p", None}
+
+
+@dataclass
+class TranscodePlan:
+    mode: str # "none", "remux", "audio", "encode"
+    reason: str
+    width: int | None = None
+    video_kbps: int | None = None
+    copy_audio: bool = False
+
+
+@dataclass
+class EncodeSettings:
+    threads: int | None = None # None leaves the choice to ffmpeg (every core)
+    load_level: int = 0 # 0 idle, 1 encodes queued, 2 a full pool's worth queued
+
+    def preset(self, quality_preset: str) -> str:
+        index = X264_PRESETS.index(quality_preset)
+        floor = min(index, X264_PRESETS.index(FASTEST_PRESET))
+        return X264_PRESETS[max(floor, index - PRESET_STEP * self.load_level)]
+
+    def thread_args(self) -> list[str]:
+        return ["-threads", str(self.threads)] if self.threads else []
+
+
+class EncodeAbandoned(Exception):
+    pass
+
+
+class FFmpegRunner:
+    # Starts every ffmpeg process. Once configured, it shares the cores between the encodes the transcode pool
+    # runs at once (each gets a -threads budget instead of all cores), and picks faster x264 presets while
+    # encodes are queued. Processes are registered under the request's trace id, so abandon() can kill the
+    # ones belonging to a request nobody is waiting for.
+
+    def __init__(self):
+        self.cores = available_cores()
+        self._load = None
+        self.share_threads = True
+        self.adaptive_presets = True
+        self._lock = threading.Lock()
+        self._running: dict[str, set[subprocess.Popen]] = {}
+        self._abandoned: dict[str, float] = {}
+        self.started = 0
+        self.killed = 0
+
+    def configure(self, cores: int, load, share_threads: bool = True, adaptive_presets: bool = True) -> None:
+        # load() -> (active, queued, size) of the transcode pool. It is called from worker threads. The thread
+        # budget and the preset stepping can be switched off separately, so each can be measured on its own.
+        self.cores = cores
+        self._load = load
+        self.share_threads = share_threads
+        self.adaptive_presets = adaptive_presets
+
+    def settings(self) -> EncodeSettings:
+        if not self._load:
+            return EncodeSettings()
+        active, queued, size = self._load()
+        # Expect the pool to fill up while encodes are waiting, so early starters don't take every core.
+        concurrent = max(1, min(size, active + queued))
+        load_level = 0 if not queued else 1 if queued < size else 2
+        FFMPEG_LOAD_LEVELS.inc(load_level=load_level)
+        return EncodeSettings(
+            max(1, self.cores // concurrent) if self.share_threads else None, load_level if self.adaptive_presets else 0
+        )
+
+    @contextmanager
+    def popen(self, command: list[str], **kwargs):
+        owner = trace_id.get()
+        with self._lock:
+            if owner in self._abandoned:
+                raise EncodeAbandoned(f"Request {owner} was abandoned, not starting ffmpeg")
+            process = subprocess.Popen(command, **kwargs)
+            self._running.setdefault(owner, set()).add(process)
+            self.started += 1
+        try:
+            yield process
+        finally:
+            # Whatever happened to the process, its pipes are ours to close.
+            for pipe in (process.stdin, process.stdout, process.stderr):
+                if pipe:
+                    try:
+                        pipe.close()
+                    except OSError:
+                        pass # BrokenPipeError flushing a stdin ffmpeg stopped reading; the fd is closed regardless
+            with self._lock:
+                processes = self._running.get(owner)
+                if processes:
+                    processes.discard(process)
+                    if not processes:
+                        del self._running[owner]
+
+    @staticmethod
+    def was_killed(process: subprocess.Popen) -> bool:
+        return getattr(process, "abandoned", False)
+
+    def reap(self, process: subprocess.Popen) -> None:
+        # Waits for the process to exit without reaping it, then reaps it under the lock. abandon() signals
+        # processes under the same lock, so it never sends a signal to a pid that was reaped (and maybe reused).
+        try:
+            os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        except ChildProcessError:
+            pass # Already reaped by Popen.kill()'s poll in abandon()
+        with self._lock:
+            if process.returncode is None:
+                _, status, usage = os.wait4(process.pid, 0)
+                process.returncode = os.waitstatus_to_exitcode(status)
+                FFMPEG_CPU_SECONDS.inc(usage.ru_utime + usage.ru_stime)
+
+    def abandon(self, owner: str) -> int:
+        # Kills the request's running ffmpeg processes and refuses to start new ones for it. The threads that
+        # ran them see the failure and remove their partial output. Returns the number of processes killed.
+        now = time.monotonic()
+        with self._lock:
+            self._abandoned = {key: at for key, at in self._abandoned.items() if at > now - ABANDONED_TTL}
+            self._abandoned[owner] = now
+            processes = list(self._running.get(owner, ()))
+            for process in processes:
+                if process.returncode is None:
+                    process.abandoned = True
+                    # Polls first, so a process that has just exited is reaped here instead of signalled.
+                    process.kill()
+                    if process.returncode is None:
+                        self.killed += 1
+                        FFMPEG_KILLED.inc()
+        if processes:
+            logger.info(f"Killed {len(processes)} ffmpeg processes of abandoned request {owner}")
+        return len(processes)
+
+    def stats(self) -> dict:
+        with self._lock:
+            running = sum(len(processes) for processes in self._running.values())
+        return {"cores": self.cores, "adaptive": self._load is not None and self.share_threads, "running": running, "started": self.started, "killed": self.killed}
+
+
+def available_cores() -> int:
+    # Cores this process may run on, which inside a container can be fewer than the host has.
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+runner = FFmpegRunner()
+
+
+def probe_media(filepath: str) -> dict:
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_format", "-show_streams", "-of", "json", filepath],
+        check=True, capture_output=True,
+    )
+    return json.loads(result.stdout)
+
+
+def probe_duration(probe: dict) -> float | None:
+    return _to_float(probe.get("format", {}).get("duration"))
+
+
+def media_duration(filepath: str) -> float | None:
+    try:
+        return probe_duration(probe_media(filepath))
+    except (subprocess.CalledProcessError, ValueError, OSError):
+        return None
+
+
+def wait_ffmpeg(process: subprocess.Popen, started: float, duration: float | None = None) -> int:
+    # Reaps an ffmpeg process and records its CPU time and speed. Returns the exit code.
+    runner.reap(process)
+    elapsed = time.monotonic() - started
+    if process.returncode != 0:
+        if runner.was_killed(process):
+            return process.returncode
+        FFMPEG_FAILURES.inc()
+    elif duration and elapsed > 0:
+        FFMPEG_SPEED.observe(duration / elapsed)
+    return process.returncode
+
+
+def _raise_failure(process: subprocess.Popen, stderr: str):
+    if runner.was_killed(process):
+        raise EncodeAbandoned(f"ffmpeg was killed, its request was abandoned: {' '.join(process.args)}")
+    _log_failure(process.args, process.returncode, stderr)
+    raise subprocess.CalledProcessError(process.returncode, process.args, stderr=stderr)
+
+
+def _log_failure(command: list[str], returncode: int, stderr: str) -> None:
+    # Successful runs stay quiet; a failure gets the tail of ffmpeg's output, which is where the error is.
+    logger.error(f"ffmpeg exited with {returncode}: {' '.join(command)}\n{stderr[-4000:]}")
+
+
+def run_ffmpeg(command: list[str], duration: float | None = None, on_progress=None) -> str:
+    # Runs an ffmpeg command with machine-readable progress on stdout. on_progress(fraction, speed) is called
+    # from this thread at every progress report; fraction is None when the duration is unknown.
+    # Returns ffmpeg's stderr, raises CalledProcessError (with stderr attached) on failure.
+    command = [command[0], "-progress", "pipe:1", "-nostats", *command[1:]]
+    started = time.monotonic()
+    with tempfile.TemporaryFile() as stderr_file, runner.popen(command, stdout=subprocess.PIPE, stderr=stderr_file, text=True) as process:
+        state = {}
+        try:
+            for line in process.stdout:
+                key, _, value = line.strip().partition("=")
+                state[key] = value
+                if key != "progress":
+                    continue
+                if on_progress:
+                    out_time_us = _to_float(state.get("out_time_us"))
+                    fraction = None
+                    if duration and out_time_us is not None:
+                        fraction = min(1.0, max(0.0, out_time_us / 1_000_000 / duration))
+                    if value == "end":
+                        fraction = 1.0
+                    on_progress(fraction, state.get("speed", "N/A").strip())
+                state = {}
+        except BaseException:
+            process.kill()
+            raise
+        finally:
+            wait_ffmpeg(process, started, duration)
+        stderr_file.seek(0)
+        stderr = stderr_file.read().decode(errors="replace")
+    if process.returncode != 0:
+        _raise_failure(process, stderr)
+    return stderr
+
+
+def _codec_from_ytdlp(codec: str | None) -> str:
+    codec = (codec or "unknown").lower()
+    if codec.startswith(("avc1", "avc3", "h264")):
+        return "h264"
+    if codec.startswith(("mp4a", "aac")):
+        return "aac"
+    return codec.split(".")[0]
+
+
+def probe_from_info(info: dict) -> dict:
+    # Build an ffprobe-shaped dict from yt-dlp format metadata, for planning before any bytes exist on disk.
+    # yt-dlp uses 'none' for an absent stream and None for an unknown codec.
+    streams = []
+    if info.get("vcodec") != "none":
+        streams.append({
+            "codec_type": "video",
+            "codec_name": _codec_from_ytdlp(info.get("vcodec")),
+            "width": info.get("width"),
+            "height": info.get("height"),
+        })
+    if info.get("acodec") != "none":
+        audio = {"codec_type": "audio", "codec_name": _codec_from_ytdlp(info.get("acodec"))}
+        if info.get("abr"):
+            audio["bit_rate"] = str(int(info["abr"] * 1000))
+        streams.append(audio)
+    fmt = {"format_name": "mov,mp4,m4a" if info.get("ext") == "mp4" else (info.get("ext") or "")}
+    if info.get("duration"):
+        fmt["duration"] = str(info["duration"])
+    return {"streams": streams, "format": fmt}
+
+
+def _first_stream(probe: dict, codec_type: str) -> dict | None:
+    for stream in probe.get("streams", []):
+        if stream.get("codec_type") == codec_type and not stream.get("disposition", {}).get("attached_pic"):
+            return stream
+    return None
+
+
+def _to_float(value) -> float | None:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_faststart_mp4(filepath: str) -> bool:
+    # Walk the top-level MP4 boxes: Telegram can only stream the file if 'moov' comes before 'mdat'.
+    try:
+        with open(filepath, "rb") as f:
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    return False
+                size, box_type = struct.unpack(">I4s", header)
+                if box_type == b"moov":
+                    return True
+                if box_type == b"mdat":
+                    return False
+                if size == 1:
+                    size = struct.unpack(">Q", f.read(8))[0]
+                    f.seek(size - 16, os.SEEK_CUR)
+                elif size == 0:
+                    return False
+                else:
+                    f.seek(size - 8, os.SEEK_CUR)
+    except (OSError, struct.error):
+        return False
+
+
+def plan_transcode(probe: dict, file_size: int, max_bytes: int, faststart: bool = False) -> TranscodePlan:
+    video = _first_stream(probe, "video")
+    audio = _first_stream(probe, "audio")
+    fmt = probe.get("format", {})
+    duration = _to_float(fmt.get("duration"))
+
+    audio_kbps = None
+    if audio:
+        audio_bit_rate = _to_float(audio.get("bit_rate"))
+        audio_kbps = audio_bit_rate / 1000 if audio_bit_rate else None
+    audio_ok = audio is None or audio.get("codec_name") in COPYABLE_AUDIO_CODECS
+    video_ok = False
+    if video:
+        width, height = video.get("width") or 0, video.get("height") or 0
+        video_ok = (
+            video.get("codec_name") in COPYABLE_VIDEO_CODECS
+            and video.get("pix_fmt") in COPYABLE_PIX_FMTS
+            and max(width, height) <= MAX_WIDTH
+            and min(width, height) <= MAX_SHORT_SIDE
+        )
+
+    if not video:
+        return TranscodePlan("remux" if audio_ok else "audio", "no video stream")
+    if video_ok and file_size <= max_bytes:
+        if audio_ok:
+            is_mp4 = "mp4" in fmt.get("format_name", "")
+            if is_mp4 and faststart:
+                return TranscodePlan("none", "already H.264/AAC faststart MP4 within budget")
+            return TranscodePlan("remux", "H.264/AAC within budget, container needs rewrite")
+        return TranscodePlan("audio", f"video copyable, audio is {audio.get('codec_name')}")
+
+    copy_audio = bool(audio) and audio_ok and audio_kbps is not None and audio_kbps <= MAX_COPY_AUDIO_KBPS
+    spent_audio_kbps = audio_kbps if copy_audio else (AUDIO_KBPS if audio else 0)
+    video_kbps = MAX_VIDEO_KBPS
+    if duration:
+        total_kbps = max_bytes * 8 * CONTAINER_OVERHEAD / 1000 / duration
+        video_kbps = int(min(MAX_VIDEO_KBPS, (total_kbps - spent_audio_kbps) * duration / (duration + VBV_BUFFER_SECONDS)))
+    width = MAX_WIDTH if video_kbps >= LOW_RES_BELOW_KBPS else LOW_RES_WIDTH
+    return TranscodePlan(
+        "encode",
+        f"video needs encode ({video.get('codec_name')}), budget {max_bytes} bytes",
+        width=width,
+        video_kbps=max(video_kbps, 1),
+        copy_audio=copy_audio,
+    )
+
+
+def plan_for_limits(probe: dict, file_size: int, faststart: bool, upload_limit_bytes: int, hard_limit_bytes: int) -> TranscodePlan:
+    # Aim for the upload limit; if that would need an unwatchable bitrate, aim for the hard limit instead
+    # and let the caller handle the oversized result as before.
+    plan = plan_transcode(probe, file_size, upload_limit_bytes, faststart)
+    if plan.mode == "encode" and plan.video_kbps < MIN_VIDEO_KBPS:
+        logger.info(f"Upload budget needs {plan.video_kbps} kbps video, planning for the hard limit instead")
+        plan = plan_transcode(probe, file_size, hard_limit_bytes, faststart)
+    return plan
+
+
+CONVERSION_EXTENSIONS = {"mp3": ".mp3", "mp4_low": ".mp4"}
+
+
+def telegram_output_args(output_filepath: str, plan: TranscodePlan, settings: EncodeSettings | None = None) -> list[str]:
+    settings = settings or EncodeSettings()
+    args = ["-map", "0:v:0?", "-map", "0:a:0?", *settings.thread_args()]
+    if plan.mode == "remux":
+        args += ["-c", "copy"]
+    elif plan.mode == "audio":
+        args += ["-c:v", "copy", "-c:a", "aac", "-b:a", f"{AUDIO_KBPS}k"]
+    elif plan.mode == "encode":
+        args += [
+            "-vf", f"scale='min({plan.width},iw)':-2",
+            "-c:v", "libx264", "-preset", settings.preset("fast"), "-pix_fmt", "yuv420p",
+            "-crf", "28", "-maxrate", f"{plan.video_kbps}k", "-bufsize", f"{plan.video_kbps * VBV_BUFFER_SECONDS}k",
+        ]
+        args += ["-c:a", "copy"] if plan.copy_audio else ["-c:a", "aac", "-b:a", f"{AUDIO_KBPS}k"]
+    else:
+        raise ValueError(f"No ffmpeg command for plan mode: {plan.mode}")
+    return args + ["-movflags", "faststart", "-y", output_filepath]
+
+
+def conversion_output_args(action: str, output_filepath: str, audio_codec: str | None = None, settings: EncodeSettings | None = None) -> list[str]:
+    settings = settings or EncodeSettings()
+    if action == "mp3":
+        if audio_codec == "mp3":
+            # Already MP3: extract the stream instead of decoding and re-encoding it.
+            return ["-map", "0:a:0", "-vn", "-c:a", "copy", "-y", output_filepath]
+        return ["-map", "0:a:0", "-vn", "-ab", "128k", "-ar", "44100", "-y", output_filepath]
+    if action == "mp4_low":
+        return [
+            "-map", "0:v:0?", "-map", "0:a:0?", *settings.thread_args(), "-vf", "scale=640:-2",
+            "-c:v", "libx264", "-preset", settings.preset("medium"), "-crf", "28", "-y", output_filepath,
+        ]
+    raise ValueError(f"Unsupported conversion type: {action}")
+
+
+def audio_codec_of(probe: dict) -> str | None:
+    audio = _first_stream(probe, "audio")
+    return audio.get("codec_name") if audio else None
+
+
+def build_command(input_filepath: str, output_filepath: str, plan: TranscodePlan, settings: EncodeSettings | None = None) -> list[str]:
+    settings = settings or EncodeSettings()
+    return ["ffmpeg", *settings.thread_args(), "-i", input_filepath, *telegram_output_args(output_filepath, plan, settings)]
+
+
+def build_multi_output_command(input_filepath: str, outputs: list[list[str]], settings: EncodeSettings | None = None) -> list[str]:
+    # One decode of the input feeds every output; each output still runs its own encoder.
+    settings = settings or EncodeSettings()
+    command = ["ffmpeg", *settings.thread_args(), "-i", input_filepath]
+    for output_args in outputs:
+        command += output_args
+    return command
+
+
+def build_segment_command(input_filepath: str, output_pattern: str, segment_seconds: float) -> list[str]:
+    # Stream copy, cut at the first keyframe after every segment_seconds. ffmpeg prints each finished
+    # segment's file name on stdout.
+    command = [
+        "ffmpeg", "-i", input_filepath, "-map", "0", "-c", "copy",
+        "-f", "segment", "-segment_time", f"{segment_seconds:.3f}", "-reset_timestamps", "1",
+    ]
+    if output_pattern.endswith(".mp4"):
+        command += ["-segment_format_options", "movflags=+faststart"]
+    return command + ["-segment_list", "pipe:1", "-segment_list_type", "flat", "-y", output_pattern]
+
+
+def split_media(input_filepath: str, output_prefix: str, max_bytes: int, on_segment=None) -> list[str]:
+    # Splits without re-encoding into parts of at most max_bytes. on_segment(path) is called from this thread
+    # as soon as each part is complete, so the caller can start sending it while later parts are being cut.
+    # Raises ValueError when a part comes out too large (a sparse keyframe interval) or the duration is unknown.
+    duration = media_duration(input_filepath)
+    if not duration:
+        raise ValueError(f"Cannot split {input_filepath}: unknown duration")
+    file_size = os.path.getsize(input_filepath)
+    segment_seconds = duration * max_bytes * SEGMENT_HEADROOM / file_size
+    ext = os.path.splitext(input_filepath)[1]
+    output_pattern = f"{output_prefix}_part%03d{ext}"
+    output_dir = os.path.dirname(output_pattern)
+    parts = []
+    started = time.monotonic()
+    try:
+        with tempfile.TemporaryFile() as stderr_file, runner.popen(
+            build_segment_command(input_filepath, output_pattern, segment_seconds),
+            stdout=subprocess.PIPE, stderr=stderr_file, text=True,
+        ) as process:
+            try:
+                for line in process.stdout:
+                    name = line.strip()
+                    if not name:
+                        continue
+                    part = os.path.join(output_dir, name)
+                    part_size = os.path.getsize(part)
+                    if part_size > max_bytes:
+                        raise ValueError(f"Part {part} is {part_size} bytes, over the {max_bytes} byte limit")
+                    parts.append(part)
+                    if on_segment:
+                        on_segment(part)
+            except BaseException:
+                process.kill()
+                raise
+            finally:
+                wait_ffmpeg(process, started, duration)
+            stderr_file.seek(0)
+            stderr = stderr_file.read().decode(errors="replace")
+        if process.returncode != 0:
+            _raise_failure(process, stderr)
+    except BaseException:
+        for part in glob.glob(glob.escape(f"{output_prefix}_part") + "*"):
+            os.remove(part)
+        raise
+    logger.info(f"Split {input_filepath} ({file_size} bytes) into {len(parts)} parts of ~{segment_seconds:.0f}s")
+    return parts
@@ -0,0 +1,219 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import time
+import uuid
+from types import SimpleNamespace
+
+from telegram import Bot, Update # type: ignore
+
+import bot
+import metrics
+from jobqueue import Job, open_queue
+
+# The processing half of worker mode: claims jobs that frontend.py queued and runs them through the same
+# handlers bot.py registers. Start several (or use --processes) to spread the work over more cores or machines.
+
+logger = logging.getLogger(__name__)
+
+JOB_QUEUE_URL = os.getenv("JOB_QUEUE_URL", "sqlite:///downloads/jobs.sqlite3")
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "4"))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "60"))
+DRAIN_TIMEOUT_SECONDS = int(os.getenv("DRAIN_TIMEOUT_SECONDS", "120"))
+# Also how quickly a /cancel sent to the front end reaches a running job.
+HEARTBEAT_SECONDS = min(JOB_LEASE_SECONDS / 3, 5)
+POLL_INTERVAL_SECONDS = 1.0
+# Untracked files younger than this may belong to a job running in another worker.
+ORPHAN_MIN_AGE_SECONDS = 6 * 3600
+RESTART_DELAY_SECONDS = 5
+
+HANDLERS = {
+    "url": bot.handle_url_message,
+    "mp3": bot.handle_mp3_command,
+    "convert": bot.convert_media,
+    "cachestats": bot.cache_stats,
+    "queuestats": bot.queue_stats,
+    "storagestats": bot.storage_stats,
+}
+
+
+class Worker:
+    def __init__(self, job_queue, tg_bot: Bot, worker_id: str, concurrency: int):
+        self.job_queue = job_queue
+        self.bot = tg_bot
+        self.worker_id = worker_id
+        self.concurrency = concurrency
+        self.stopping = asyncio.Event()
+        self._running: dict[str, asyncio.Task] = {}
+        self._cancelled: set[str] = set()
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+
+    async def run(self) -> None:
+        heartbeat = asyncio.create_task(self._heartbeat())
+        try:
+            while not self.stopping.is_set():
+                if len(self._running) >= self.concurrency:
+                    await self._wait_for(set(self._running.values()))
+                    continue
+                job = await asyncio.to_thread(self.job_queue.claim, self.worker_id, JOB_LEASE_SECONDS)
+                if job is None:
+                    await self._wait_for(set(), timeout=POLL_INTERVAL_SECONDS)
+                    continue
+                self._running[job.id] = asyncio.create_task(self._run_job(job))
+            await self._drain()
+        finally:
+            heartbeat.cancel()
+
+    async def _wait_for(self, tasks: set, timeout: float | None = None) -> None:
+        # Returns when a task finishes, the timeout passes, or shutdown begins.
+        stop = asyncio.create_task(self.stopping.wait())
+        try:
+            await asyncio.wait(tasks | {stop}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            stop.cancel()
+
+    async def _run_job(self, job: Job) -> None:
+        logger.info(f"Running {job.kind} job {job.id} (attempt {job.attempts})")
+        try:
+            update = Update.de_json(job.payload["update"], self.bot)
+            context = SimpleNamespace(bot=self.bot, args=job.payload.get("args") or [])
+            await HANDLERS[job.kind](update, context)
+        except asyncio.CancelledError:
+            if job.id not in self._cancelled:
+                raise
+            # Cancelled by its user: the handler has cleaned up and its ffmpeg processes are killed.
+            logger.info(f"Job {job.id} ({job.kind}) cancelled by its user")
+            self.cancelled += 1
+            await asyncio.to_thread(self.job_queue.mark_cancelled, job.id, self.worker_id)
+        except Exception as e_job:
+            logger.error(f"Job {job.id} ({job.kind}) failed: {e_job}", exc_info=True)
+            self.failed += 1
+            await asyncio.to_thread(self.job_queue.fail, job.id, self.worker_id, str(e_job))
+        else:
+            self.completed += 1
+            await asyncio.to_thread(self.job_queue.complete, job.id, self.worker_id)
+        finally:
+            self._running.pop(job.id, None)
+            self._cancelled.discard(job.id)
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(HEARTBEAT_SECONDS)
+            try:
+                cancelled = await asyncio.to_thread(self.job_queue.heartbeat, self.worker_id, list(self._running), JOB_LEASE_SECONDS)
+                for job_id in cancelled:
+                    task = self._running.get(job_id)
+                    if task and job_id not in self._cancelled:
+                        self._cancelled.add(job_id)
+                        task.cancel()
+                for job in await asyncio.to_thread(self.job_queue.requeue_expired):
+                    await self._report_lost(job)
+            except Exception as e_heartbeat:
+                logger.error(f"Job queue heartbeat failed: {e_heartbeat}", exc_info=True)
+
+    async def _report_lost(self, job: Job) -> None:
+        if job.chat_id is None:
+            return
+        try:
+            await self.bot.send_message(job.chat_id, "Sorry, your request was interrupted several times and has been dropped. Please send it again.")
+        except Exception as e_report:
+            logger.warning(f"Could not tell chat {job.chat_id} about dropped job {job.id}: {e_report}")
+
+    async def _drain(self) -> None:
+        # Lets running jobs finish for up to DRAIN_TIMEOUT_SECONDS, then hands the rest back to the queue.
+        if self._running:
+            logger.info(f"Draining {len(self._running)} running jobs (up to {DRAIN_TIMEOUT_SECONDS}s)")
+            await asyncio.wait(set(self._running.values()), timeout=DRAIN_TIMEOUT_SECONDS)
+        unfinished = dict(self._running)
+        for job_id, task in unfinished.items():
+            task.cancel()
+        if unfinished:
+            await asyncio.wait(set(unfinished.values()))
+        for job_id in unfinished:
+            await asyncio.to_thread(self.job_queue.release, job_id, self.worker_id)
+            logger.warning(f"Released unfinished job {job_id} back to the queue")
+
+    def stats(self) -> dict:
+        return {"running": len(self._running), "completed": self.completed, "failed": self.failed, "cancelled": self.cancelled}
+
+
+async def run_worker(index: int = 0) -> None:
+    job_queue = open_queue(JOB_QUEUE_URL)
+    keep_paths = (job_queue.db_path,) if hasattr(job_queue, "db_path") else ()
+    bot.init_runtime(keep_paths=keep_paths, orphan_min_age_seconds=ORPHAN_MIN_AGE_SECONDS)
+    tg_bot = Bot(bot.TELEGRAM_BOT_TOKEN, request=metrics.MetricsRequest(connection_pool_size=256))
+    await tg_bot.initialize()
+    # One metrics port per worker process on the same host.
+    await bot.start_services(tg_bot, metrics_port=bot.METRICS_PORT + index if bot.METRICS_PORT else 0)
+    worker = Worker(job_queue, tg_bot, f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}", WORKER_CONCURRENCY)
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, worker.stopping.set)
+    logger.info(f"Worker {worker.worker_id} taking jobs from {JOB_QUEUE_URL}, {WORKER_CONCURRENCY} at a time")
+    try:
+        await worker.run()
+    finally:
+        logger.info(f"Worker {worker.worker_id} stopping: {worker.stats()}")
+        await bot.stop_services()
+        await tg_bot.shutdown()
+        bot.scheduler.shutdown()
+
+
+def _process_main(index: int) -> None:
+    asyncio.run(run_worker(index))
+
+
+def supervise(processes: int) -> None:
+    # Runs `processes` workers and restarts any that crash. SIGTERM/SIGINT are passed on, and each worker
+    # drains before exiting.
+    context = multiprocessing.get_context("spawn")
+    children: dict[int, multiprocessing.Process] = {}
+    stopping = False
+
+    def start_child(index: int) -> None:
+        child = context.Process(target=_process_main, args=(index,), name=f"worker-{index}")
+        child.start()
+        children[index] = child
+        logger.info(f"Started worker process {index} (pid {child.pid})")
+
+    def forward(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for child in children.values():
+            if child.is_alive():
+                os.kill(child.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    for index in range(processes):
+        start_child(index)
+    while children:
+        for index, child in list(children.items()):
+            child.join(timeout=0.5)
+            if child.exitcode is None:
+                continue
+            del children[index]
+            if not stopping:
+                logger.error(f"Worker process {index} exited with code {child.exitcode}, restarting in {RESTART_DELAY_SECONDS}s")
+                time.sleep(RESTART_DELAY_SECONDS)
+                start_child(index)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run jobs queued by frontend.py.")
+    parser.add_argument("--processes", type=int, default=int(os.getenv("WORKER_PROCESSES", "1")), help="worker processes to run on this host")
+    args = parser.parse_args()
+    if args.processes > 1:
+        supervise(args.processes)
+    else:
+        asyncio.run(run_worker())
+
+
+if __name__ == "__main__":
+    main()
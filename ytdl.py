@@ -0,0 +1,165 @@
+import importlib
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import YTDL_CHECKOUT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# yt-dlp takes about half a second to import and a new YoutubeDL instance another 0.1-0.2s (extractor list,
+# network stack, cookie jar), before its extractors have fetched anything they cache. This module imports it on
+# first use and keeps a pool of instances that requests borrow and give back.
+
+COOKIE_CHECK_SECONDS = 30
+MAX_USES = 200 # Instances are replaced after this many checkouts, so per-instance state cannot pile up
+
+
+class LazyModule:
+    # Stands in for a module and imports it on first attribute access. Concurrent first uses wait on the
+    # import lock for the same import.
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr: str):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+yt_dlp = LazyModule("yt_dlp")
+
+
+def _file_stamp(path: str) -> tuple[int, int] | None:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class YoutubeDLPool:
+    # Reusable YoutubeDL instances built from the same params. Each checkout may override params for the job
+    # (output template, playlist limits) and attach a progress hook; both are undone, and the format selector
+    # reset, when the instance comes back. All instances share one cookie jar, loaded once and reloaded when
+    # the cookie file changes.
+
+    def __init__(self, params: dict, size: int, cookie_file: str | None = None):
+        self.params = params
+        self.size = size
+        self.cookie_file = cookie_file
+        self._idle: list = []
+        self._lock = threading.Lock()
+        self._cookie_lock = threading.Lock()
+        self._cookie_jar = None
+        self._cookie_stamp = None
+        self._cookie_checked = 0.0
+        self.created = 0
+        self.reused = 0
+        self.cookie_loads = 0
+        self.checkouts = 0
+        self.checkout_seconds = 0.0
+
+    def _cookies(self):
+        with self._cookie_lock:
+            now = time.monotonic()
+            if self._cookie_jar is not None and now - self._cookie_checked < COOKIE_CHECK_SECONDS:
+                return self._cookie_jar
+            self._cookie_checked = now
+            if self._cookie_jar is None:
+                self._cookie_jar = yt_dlp.cookies.YoutubeDLCookieJar()
+            stamp = _file_stamp(self.cookie_file) if self.cookie_file else None
+            if stamp == self._cookie_stamp:
+                return self._cookie_jar
+            self._cookie_stamp = stamp
+            if stamp is None:
+                self._cookie_jar.clear()
+                if self.cookie_file:
+                    logger.warning(f"{self.cookie_file} not found. Downloads requiring authentication may fail.")
+                return self._cookie_jar
+            # Load into a fresh jar first, so a half-written file leaves the current cookies in place.
+            loaded = yt_dlp.cookies.YoutubeDLCookieJar()
+            try:
+                loaded.load(self.cookie_file)
+            except Exception as e_cookies:
+                logger.error(f"Could not load cookies from {self.cookie_file}, keeping the previous ones: {e_cookies}")
+                return self._cookie_jar
+            self._cookie_jar.clear()
+            for cookie in loaded:
+                self._cookie_jar.set_cookie(cookie)
+            self.cookie_loads += 1
+            logger.info(f"Loaded {len(loaded)} cookies from {self.cookie_file} ({stamp[1]} bytes)")
+            return self._cookie_jar
+
+    def _create(self):
+        ydl = yt_dlp.YoutubeDL(dict(self.params))
+        # Replaces the jar yt-dlp would load from 'cookiefile' (and write back on close) with the shared one.
+        ydl.cookiejar = self._cookies()
+        ydl.job_progress_hook = None
+        ydl.add_progress_hook(lambda d: ydl.job_progress_hook and ydl.job_progress_hook(d))
+        ydl.default_format_selector = ydl.format_selector
+        ydl.uses = 0
+        with self._lock:
+            self.created += 1
+        return ydl
+
+    def warm_up(self) -> None:
+        # Fills the pool ahead of the first request. Meant for a background thread at startup.
+        instances = [self._create() for _ in range(self.size - len(self._idle))]
+        with self._lock:
+            self._idle.extend(instances)
+
+    @contextmanager
+    def checkout(self, progress_hook=None, **params):
+        started = time.monotonic()
+        self._cookies()
+        with self._lock:
+            ydl = self._idle.pop() if self._idle else None
+        source = "pool" if ydl is not None else "new"
+        if ydl is None:
+            ydl = self._create()
+        saved = {key: ydl.params.get(key) for key in params}
+        for key, value in params.items():
+            # YoutubeDL keeps the output template as a dict of templates by kind.
+            ydl.params[key] = {**ydl.params['outtmpl'], 'default': value} if key == 'outtmpl' else value
+        ydl.job_progress_hook = progress_hook
+        elapsed = time.monotonic() - started
+        YTDL_CHECKOUT_SECONDS.observe(elapsed, source=source)
+        with self._lock:
+            self.checkouts += 1
+            self.checkout_seconds += elapsed
+            if source == "pool":
+                self.reused += 1
+        try:
+            yield ydl
+        finally:
+            ydl.params.update(saved)
+            ydl.job_progress_hook = None
+            ydl.format_selector = ydl.default_format_selector
+            ydl.uses += 1
+            with self._lock:
+                keep = ydl.uses < MAX_USES and len(self._idle) < self.size
+                if keep:
+                    self._idle.append(ydl)
+            if not keep:
+                ydl.close()
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for ydl in idle:
+            ydl.close()
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "idle": len(self._idle),
+            "created": self.created,
+            "checkouts": self.checkouts,
+            "reused": self.reused,
+            "cookie_loads": self.cookie_loads,
+            "avg_checkout": self.checkout_seconds / self.checkouts if self.checkouts else 0.0,
+        }